@@ -3,6 +3,7 @@ from __future__ import print_function
 
 """
     Requirements: Python 2.6 or higher or Python 3.x
+                  NumPy
                   Antechamber (from AmberTools preferably)
                   OpenBabel (optional, but strongly recommended)
 
@@ -69,17 +70,27 @@ from datetime import datetime
 from shutil import copy2
 from shutil import rmtree
 import traceback
-import signal
+import threading
+import multiprocessing
 import time
 import optparse
 import math
 import os
 #import cPickle as pickle
 import pickle
+import json
+import tempfile
 #import string
 import sys
 import subprocess as sub
 import re
+import numpy as np
+
+from gromacs.dihedrals import amber_to_rb
+from gromacs import packcheck
+from gromacs.fileformats import pdb as pdbfile
+from gromacs.molgraph import read_molecule, read_mol2, graph_hash, match_atoms
+from gromacs.fileformats import topstore
 
 # List of Topology Formats created by acpype so far:
 outTopols = ['gmx', 'cns', 'charmm']
@@ -105,6 +116,7 @@ minDist = 0.5
 maxDist2 = maxDist ** 2 #squared Ang.
 minDist2 = minDist ** 2 #squared Ang.
 diffTol = 0.01
+cacheVersion = 2 # antechamber cache layout, bump to invalidate old entries
 
 dictAmbAtomType2AmbGmxCode = \
 {'BR':'1', 'C':'2', 'CA':'3', 'CB':'4', 'CC':'5', 'CK':'6', 'CM':'7', 'CN':'8', 'CQ':'9',
@@ -250,9 +262,6 @@ a2oD = {'amber99_2': ['opls_235', 'opls_271'],
         'amber99_48': ['opls_200'],
  }
 
-global pid
-pid = 0
-
 head = "%s created by acpype (Rev: " + svnRev + ") on %s\n"
 
 date = datetime.now().ctime()
@@ -260,7 +269,9 @@ date = datetime.now().ctime()
 usage = \
 """
     acpype -i _file_ [-c _string_] [-n _int_] [-m _int_] [-a _string_] [-f] etc. or
-    acpype -p _prmtop_ -x _inpcrd_ [-d]"""
+    acpype -p _prmtop_ -x _inpcrd_ [-d] or
+    acpype -T _tps_ [-b _string_] [-r] [-g] or
+    acpype -B _folder_or_list_ [-j _int_] [-D _folder_] [-c _string_] etc."""
 
 epilog = \
 """
@@ -272,6 +283,8 @@ epilog = \
     root_AC.prmtop    :  topology and parameter file for AMBER
     root_AC.lib       :  residue library file for AMBER
     root_AC.frcmod    :  modified force field parameters
+    root.tps          :  topology store (numpy arrays + JSON header, see gromacs.fileformats.topstore),
+                         read back by 'acpype -T' and itp_match.py
     root_GMX.gro      :  coord file for GROMACS
     root_GMX.top      :  topology file for GROMACS
     root_GMX.itp      :  molecule unit topology and parameter file for GROMACS
@@ -485,16 +498,213 @@ def parmMerge(fdat1, fdat2, frcmod = False):
 
     return mname
 
+def getCacheDir():
+    """
+        Folder of the antechamber cache: $ACPYPE_CACHE or ~/.acpype/cache
+    """
+    return os.getenv('ACPYPE_CACHE') or os.path.join(os.path.expanduser('~'), '.acpype', 'cache')
+
 def _getoutput(cmd):
     '''to simulate commands.getoutput in order to work with python 2.6 up to 3.x'''
     out = sub.Popen(cmd, shell = True, stderr = sub.STDOUT, stdout = sub.PIPE).communicate()[0][:-1]
     o = str(out.decode())
     return o
 
+def fixedWidthArray(lines, width, perLine, kind = 'E'):
+    """
+        Decode a block of fixed-width records (FORTRAN style, e.g. 5E16.8) at
+        once with numpy.
+        kind: 'I' integer, 'E' or 'F' float, 'a' string (stripped)
+        Returns a numpy array (int64, float64 or unicode).
+    """
+    lineWidth = width * perLine
+    data = ''.join([line.rstrip('\r\n').ljust(lineWidth) for line in lines])
+    raw = np.frombuffer(data.encode('ascii'), dtype = 'S%i' % width)
+    # drop the padding of the last (incomplete) line
+    filled = np.flatnonzero(raw != b' ' * width)
+    raw = raw[:filled[-1] + 1] if len(filled) else raw[:0]
+    if kind == 'I':
+        return raw.astype(np.int64)
+    if kind in 'EFD':
+        return raw.astype(np.float64)
+    return np.char.strip(raw.astype('U%i' % width))
+
+class PrmtopIndex(object):
+    """
+        Index of an AMBER prmtop file built in a single pass over its lines.
+
+        For every %FLAG it keeps the %FORMAT (items per line, kind, width)
+        and the range of data lines, so any flag can be reached without
+        rescanning the file. Data are only decoded when first asked for
+        (see getArray) and the resulting numpy array is kept.
+    """
+    formatPattern = re.compile(r'\((\d+)([aAIEFD])(\d+)')
+
+    def __init__(self, lines):
+        self.lines = lines
+        self.flags = {} # flag: [perLine, kind, width, firstLine, lastLine]
+        self._arrays = {}
+        flag = None
+        for n, line in enumerate(lines):
+            if not line.startswith('%'):
+                continue
+            if line.startswith('%FLAG'):
+                if flag:
+                    self.flags[flag][4] = n
+                flag = line.split()[1]
+                self.flags[flag] = [1, 'a', 80, n + 1, len(lines)]
+            elif line.startswith('%FORMAT') and flag:
+                perLine, kind, width = self.formatPattern.search(line).groups()
+                self.flags[flag][:4] = [int(perLine), kind.replace('A', 'a'), int(width), n + 1]
+            elif line.startswith('%COMMENT') and flag:
+                self.flags[flag][3] = n + 1
+            elif flag: # anything else closes the current block
+                self.flags[flag][4] = n
+                flag = None
+    def __contains__(self, flag):
+        return flag in self.flags
+
+    def getFormat(self, flag):
+        """
+            Returns (items per line, kind, width) of a flag
+        """
+        return tuple(self.flags[flag][:3])
+
+    def getArray(self, flag):
+        """
+            For a given prmtop flag, return its data as a numpy array
+        """
+        if flag not in self._arrays:
+            if flag not in self.flags:
+                raise Exception("FLAG '%s' not found in PRMTOP file" % flag)
+            perLine, kind, width, first, last = self.flags[flag]
+            self._arrays[flag] = fixedWidthArray(self.lines[first:last], width, perLine, kind)
+        return self._arrays[flag]
+
+def formatRows(fmt, *columns):
+    """
+        Apply a %-format to whole columns (numpy arrays or lists) at once.
+        Returns a list with a formatted string per row.
+    """
+    columns = [c.tolist() if isinstance(c, np.ndarray) else c for c in columns]
+    return list(map(fmt.__mod__, zip(*columns)))
+
+class BondedArrays(object):
+    """
+        Structure of arrays for one kind of bonded term (bonds, angles or
+        dihedrals) as given in prmtop.
+        attributes: atoms, int32 array with a row of atom indexes (starting
+        from 0, prmtop order) per term; typeIds, int32 array with the
+        parameter type of each term; params, dict of arrays with the
+        parameters per type.
+    """
+    def __init__(self, atoms, typeIds, **params):
+        self.atoms = atoms
+        self.typeIds = typeIds
+        self.params = params
+
+    def __len__(self):
+        return len(self.typeIds)
+
+    def get(self, param):
+        """
+            Array of a parameter for each term
+        """
+        return self.params[param][self.typeIds]
+
+class LegacyTerms(object):
+    """
+        Lists of Bond, Angle and Dihedral objects of a topology.
+        The topology works on BondedArrays; the objects are only built, by
+        the given method, if a caller asks for them.
+    """
+    def __init__(self, name, builder):
+        self.key = '_' + name
+        self.name = name
+        self.builder = builder
+
+    def __get__(self, obj, objType = None):
+        if obj is None:
+            return self
+        if self.name in obj.__dict__: # restored from an old pickle file
+            return obj.__dict__[self.name]
+        if self.key not in obj.__dict__:
+            getattr(obj, self.builder)()
+        return obj.__dict__[self.key]
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.key] = value
+
+def properGroups(quartets, skip14):
+    """
+        For each proper dihedral, the id of its quartet in the condensed list
+        of proper dihedrals: a term with 1-4 interactions to be ignored and
+        the same quartet of the previous term is condensed with it
+    """
+    repeated = np.zeros(len(quartets), bool)
+    repeated[1:] = (quartets[1:] == quartets[:-1]).all(axis = 1)
+    repeated &= skip14
+    return np.cumsum(~repeated) - 1
+
+def gromacsAtomOrder(masses, bonds):
+    """
+        Order of atoms expected by gromacs: every heavy atom followed by the
+        hydrogens bonded to it, all in the same charge group.
+        masses: mass of each atom (mass < 1.2 is taken to denote a proton)
+        bonds: array with a pair of atom indexes per bond
+        Returns the array of atom indexes in the new order and the array of
+        charge group numbers (by old atom index), each heavy atom having its
+        own charge group.
+        Hydrogens go with the first heavy atom (in the old order) they are
+        bonded to, in the order of the bonds; the remaining atoms go at the
+        end, each in its own charge group. Linear in atoms plus bonds.
+    """
+    nAtoms = len(masses)
+    isHydrogen = np.asarray(masses) < 1.2
+    bonds = np.asarray(bonds).reshape(-1, 2)
+    bondIds = np.arange(len(bonds))
+    # (hydrogen, heavy atom, bond) for every heavy-hydrogen bond
+    hFirst = isHydrogen[bonds[:, 0]] & ~isHydrogen[bonds[:, 1]]
+    hSecond = isHydrogen[bonds[:, 1]] & ~isHydrogen[bonds[:, 0]]
+    hydrogens = np.concatenate((bonds[hFirst, 0], bonds[hSecond, 1]))
+    heavies = np.concatenate((bonds[hFirst, 1], bonds[hSecond, 0]))
+    hBonds = np.concatenate((bondIds[hFirst], bondIds[hSecond]))
+    # each hydrogen is visited by its first heavy atom only
+    first = np.lexsort((hBonds, heavies, hydrogens))
+    hydrogens, heavies, hBonds = hydrogens[first], heavies[first], hBonds[first]
+    visited = np.ones(len(hydrogens), bool)
+    visited[1:] = hydrogens[1:] != hydrogens[:-1]
+    hydrogens, heavies, hBonds = hydrogens[visited], heavies[visited], hBonds[visited]
+
+    # sort keys: heavy atoms by themselves, hydrogens after their heavy atom
+    # (by bond), the remaining atoms at the end
+    key = np.arange(nAtoms) + nAtoms
+    key[~isHydrogen] -= nAtoms
+    key[hydrogens] = heavies
+    subKey = np.full(nAtoms, -1)
+    subKey[hydrogens] = hBonds
+    order = np.lexsort((subKey, key))
+
+    cgnrs = np.zeros(nAtoms, dtype = int)
+    heavyIds = np.flatnonzero(~isHydrogen)
+    cgnrs[heavyIds] = np.arange(1, len(heavyIds) + 1)
+    cgnrs[hydrogens] = cgnrs[heavies]
+    rest = order[key[order] >= nAtoms]
+    cgnrs[rest] = np.arange(len(heavyIds) + 1, len(heavyIds) + len(rest) + 1)
+    return order, cgnrs
+
 class AbstractTopol(object):
     """
         Super class to build topologies
     """
+    # objects built from BondedArrays only on demand
+    bonds = LegacyTerms('bonds', 'buildBondObjects')
+    angles = LegacyTerms('angles', 'buildAngleObjects')
+    properDihedrals = LegacyTerms('properDihedrals', 'buildDihedralObjects')
+    improperDihedrals = LegacyTerms('improperDihedrals', 'buildDihedralObjects')
+    condensedProperDihedrals = LegacyTerms('condensedProperDihedrals', 'buildDihedralObjects')
+    atomPairs = LegacyTerms('atomPairs', 'buildDihedralObjects')
+
     def __init__(self):
         if self.__class__ is AbstractTopol:
             raise TypeError("Attempt to create istance of abstract class AbstractTopol")
@@ -626,54 +836,46 @@ class AbstractTopol(object):
                 rmtree(self.tmpDir)
                 raise
 
-        tmpData = tmpFile.readlines()
-        residues = set()
-        coords = {}
-        for line in tmpData:
-            if 'ATOM  ' in line or 'HETATM' in line:
-                residues.add(line[17:20])
-                at = line[0:17]
-                cs = line[30:54]
-                if cs in coords:
-                    coords[cs].append(at)
-                else:
-                    coords[cs] = [at]
-        #self.printDebug(coords)
+        atomLines = [line for line in tmpFile if line.startswith(('ATOM  ', 'HETATM'))]
+        tmpFile.close()
+        atoms = pdbfile.parse(atomLines)
+        residues = set(atoms['resname'].tolist())
+        labels = [line[0:17] for line in atomLines]
 
         if len(residues) > 1:
             self.printError("more than one residue detected '%s'" % str(residues))
             self.printError("verify your input file '%s'. Aborting ..." % self.inputFile)
             sys.exit(1)
 
+        # atoms grouped by coordinates, groups in order of first appearance
+        coords, first, inverse = np.unique(atoms['coords'], axis=0, return_index=True, return_inverse=True)
+        order = np.argsort(first)
+        rank = np.empty_like(order)
+        rank[order] = np.arange(len(order))
+        inverse = rank[np.ravel(inverse)]
+        coords = coords[order]
+        groups = [[] for _ in range(len(coords))]
+        for index, group in enumerate(inverse.tolist()):
+            groups[group].append(index)
+        names = [[labels[index] for index in group] for group in groups]
+
         dups = ""
         shortd = ""
         longd = ""
-        longSet = set()
-        id = 0
-        items = list(coords.items())
-        l = len(items)
-        for item in items:
-            id += 1
-            if len(item[1]) > 1: # if True means atoms with same coordinates
-                for i in item[1]:
-                    dups += "%s %s\n" % (i, item[0])
-
-#        for i in xrange(0,len(data),f):
-#            fdata += (data[i:i+f])+' '
-
-            for id2 in range(id, l):
-                item2 = items[id2]
-                c1 = list(map(float, [item[0][i:i + 8] for i in range(0, 24, 8)]))
-                c2 = list(map(float, [item2[0][i:i + 8] for i in range(0, 24, 8)]))
-                dist2 = self.distance(c1, c2)
-                if dist2 < minDist2:
-                    dist = math.sqrt(dist2)
-                    shortd += "%8.5f       %s %s\n" % (dist, item[1], item2[1])
-                if dist2 < maxDist2: # and not longOK:
-                    longSet.add(str(item[1]))
-                    longSet.add(str(item2[1]))
-            if str(item[1]) not in longSet and l > 1:
-                longd += "%s\n" % item[1]
+        for group in groups:
+            if len(group) > 1: # atoms with same coordinates
+                for index in group:
+                    dups += "%s %s\n" % (labels[index], atomLines[index][30:54])
+
+        i, j, dist = packcheck.close_pairs(coords, maxDist)
+        pairs = np.lexsort((j, i))
+        for k in pairs[dist[pairs] < minDist].tolist():
+            shortd += "%8.5f       %s %s\n" % (dist[k], names[i[k]], names[j[k]])
+        near = np.zeros(len(groups), dtype=bool)
+        near[i] = near[j] = True
+        if len(groups) > 1:
+            for group in np.flatnonzero(~near).tolist():
+                longd += "%s\n" % names[group]
 
         if dups:
             self.printError("Atoms with same coordinates in '%s'!" % self.inputFile)
@@ -745,13 +947,6 @@ class AbstractTopol(object):
         os.chdir(localDir)
         self.printDebug("setResNameCheckCoords done")
 
-    def distance(self, c1, c2):
-        #print c1, c2
-        dist2 = (c1[0] - c2[0]) ** 2 + (c1[1] - c2[1]) ** 2 + (c1[0] - c2[0]) ** 2 + \
-                (c1[2] - c2[2]) ** 2
-        #dist2 = math.sqrt(dist2)
-        return dist2
-
     def readMol2TotalCharge(self, mol2File):
         """Reads the charges in given mol2 file and returns the total
         """
@@ -851,8 +1046,6 @@ Usage: antechamber -i  input file name
         Write out charge   wc       9  |  Delete Charge      dc     10
         ----------------------------------------------------------------
 a        """
-        global pid
-
         self.printMess("Executing Antechamber...")
 
         self.makeDir()
@@ -863,9 +1056,26 @@ a        """
         exten = self.ext[1:]
         if exten == 'mol': exten = 'mdl'
 
-        cmd = '%s -i %s -fi %s -o %s -fo mol2 -c %s -nc %s -m %s -s 2 -df %i -at\
+        self.cacheEntry = self.getCacheEntry()
+        self.cacheHit = False
+        charges = None
+        if self.cacheEntry and not self.force:
+            cached = self.loadCacheEntry(self.cacheEntry)
+            if cached is not None:
+                self.cacheFolder, charges = cached
+        chargeFlag = '-c %s' % ct
+        if charges is not None:
+            self.printMess("Reusing charges from cache entry %s" % self.cacheFolder)
+            chargeFile = self.acBaseName + '.crg'
+            fp = open(chargeFile, 'w')
+            for i in range(0, len(charges), 8):
+                fp.write(''.join(['%10.6f' % q for q in charges[i:i + 8]]) + '\n')
+            fp.close()
+            chargeFlag = '-c rc -cf %s' % chargeFile
+
+        cmd = '%s -i %s -fi %s -o %s -fo mol2 %s -nc %s -m %s -s 2 -df %i -at\
  %s -pf y %s' % (self.acExe, self.inputFile, exten, self.acMol2FileName,
-                     ct, self.chargeVal, self.multiplicity, self.qFlag, at,
+                     chargeFlag, self.chargeVal, self.multiplicity, self.qFlag, at,
                      self.ekFlag)
 
         if self.debug:
@@ -879,30 +1089,143 @@ a        """
         else:
             try: os.remove(self.acMol2FileName)
             except: pass
-            signal.signal(signal.SIGALRM, self.signal_handler)
-            signal.alarm(self.timeTol)
-            p = sub.Popen(cmd, shell = True, stderr = sub.STDOUT, stdout = sub.PIPE)
-            pid = p.pid
-
-            out = str(p.communicate()[0].decode()) #p.stdout.read()
-            self.acLog = out
+            self.acLog = self.execCmd(cmd, 'Semi-QM')
 
         if os.path.exists(self.acMol2FileName):
+            if charges is not None:
+                copy2(os.path.join(self.cacheFolder, 'parm.frcmod'), self.acFrcmodFileName)
+                self.cacheHit = True
             self.printMess("* Antechamber OK *")
         else:
             self.printQuoted(self.acLog)
             return True
 
-    def signal_handler(self, _signum, _frame):#, pid = 0):
-        global pid
-        pids = self.job_pids_family(pid)
-        self.printDebug("PID: %s, PIDS: %s" % (pid, pids))
-        self.printMess("Timed out! Process %s killed, max exec time (%ss) exceeded" \
-                        % (pids, self.timeTol))
-        #os.system('kill -15 %s' % pids)
-        for i in pids.split():
-            os.kill(int(i), 15)
-        raise Exception("Semi-QM taking too long to finish... aborting!")
+    def getCacheEntry(self):
+        """
+            (key, bucket folder, molecule) of the antechamber cache for the
+            input molecule, or None if caching is off or the input can't be
+            read. The key hashes elements, connectivity, net charge,
+            multiplicity, charge method, atom type and QM program; it only
+            picks the bucket, since different molecules may share a hash.
+        """
+        if not getattr(self, 'cache', False) or self.chargeType == 'user':
+            return None
+        try:
+            mol = read_molecule(self.inputFile)
+        except Exception:
+            self.printDebug("cache: can't read molecule graph of %s" % self.inputFile)
+            return None
+        if not mol['elements']:
+            return None
+        extra = (int(self.chargeVal), int(self.multiplicity), self.chargeType,
+                 self.atomType, self.qFlag, cacheVersion)
+        key = graph_hash(mol['elements'], mol['bonds'], extra)
+        return key, os.path.join(getCacheDir(), key[:2], key), mol
+
+    def findCacheEntry(self, entry):
+        """
+            (folder, meta, mapping) of the entry of the bucket which holds
+            the input molecule, or None; mapping is the index in the stored
+            molecule of each input atom, from match_atoms, which checks
+            the bonds
+        """
+        key, bucket, mol = entry
+        try:
+            folders = sorted(os.listdir(bucket))
+        except OSError:
+            return None
+        for name in folders:
+            if name.startswith('.'): # being stored
+                continue
+            folder = os.path.join(bucket, name)
+            try:
+                meta = json.load(open(os.path.join(folder, 'meta.json')))
+                if meta['version'] != cacheVersion or meta['key'] != key:
+                    continue
+                mapping = match_atoms(meta['elements'], meta['bonds'], mol['elements'], mol['bonds'])
+            except (IOError, OSError, ValueError, KeyError):
+                continue
+            return folder, meta, mapping
+        return None
+
+    def loadCacheEntry(self, entry):
+        """
+            (folder, charges in the atom order of the input) of a valid
+            cache entry, or None
+        """
+        found = self.findCacheEntry(entry)
+        if found is None:
+            return None
+        folder, meta, mapping = found
+        if len(meta['charges']) != len(mapping) or not os.path.exists(os.path.join(folder, 'parm.frcmod')):
+            return None
+        return folder, [meta['charges'][i] for i in mapping]
+
+    def storeCacheEntry(self, entry):
+        """
+            Store the charged mol2 and the frcmod of this run in the bucket
+            of the cache, replacing an entry of the same molecule; the entry
+            is moved in place whole, so concurrent runs never see a partial
+            one
+        """
+        key, bucket, mol = entry
+        try:
+            charges = read_mol2(self.acMol2FileName)['charges']
+            if len(charges) != len(mol['elements']):
+                self.printWarn("cache: atoms of %s don't match the input, not cached" % self.acMol2FileName)
+                return
+            if not os.path.exists(bucket):
+                os.makedirs(bucket)
+            tmp = tempfile.mkdtemp(prefix = '.', dir = bucket)
+            copy2(self.acMol2FileName, os.path.join(tmp, 'charged.mol2'))
+            copy2(self.acFrcmodFileName, os.path.join(tmp, 'parm.frcmod'))
+            meta = {'version' : cacheVersion, 'key' : key, 'elements' : list(mol['elements']),
+                    'bonds' : np.asarray(mol['bonds']).tolist(),
+                    'charges' : charges.tolist(), 'input' : self.absInputFile,
+                    'netCharge' : int(self.chargeVal), 'multiplicity' : int(self.multiplicity),
+                    'chargeType' : self.chargeType, 'atomType' : self.atomType,
+                    'date' : datetime.now().ctime()}
+            json.dump(meta, open(os.path.join(tmp, 'meta.json'), 'w'), indent = 1)
+            old = self.findCacheEntry(entry)
+            if old is not None:
+                rmtree(old[0])
+            try:
+                os.rename(tmp, os.path.join(bucket, os.path.basename(tmp)[1:]))
+            except OSError:
+                rmtree(tmp)
+            self.printMess("Charges and frcmod stored in cache entry %s" % key)
+        except (IOError, OSError):
+            self.printWarn("cache: couldn't store entry %s: %s" % (key, sys.exc_info()[1]))
+
+    def execCmd(self, cmd, what = 'Process'):
+        """
+            Run cmd in a shell and return its output. The process family is
+            killed from a timer thread after self.timeTol seconds, so no
+            process-global signal handler is needed and concurrent jobs
+            (e.g. batch mode) don't step on each other.
+        """
+        p = sub.Popen(cmd, shell = True, stderr = sub.STDOUT, stdout = sub.PIPE)
+        expired = []
+
+        def kill():
+            expired.append(self.job_pids_family(p.pid))
+            for i in expired[0].split():
+                try: os.kill(int(i), 15)
+                except OSError: pass
+
+        timer = threading.Timer(self.timeTol, kill)
+        timer.daemon = True
+        timer.start()
+        try:
+            out = str(p.communicate()[0].decode())
+        finally:
+            timer.cancel()
+        if expired:
+            self.printDebug("PID: %s, PIDS: %s" % (p.pid, expired[0]))
+            self.printMess("Timed out! Process %s killed, max exec time (%ss) exceeded" \
+                            % (expired[0], self.timeTol))
+            raise Exception("%s taking too long to finish... aborting!" % what)
+        return out
 
     def job_pids_family(self, jpid):
         '''INTERNAL: Return all job processes (PIDs)'''
@@ -945,7 +1268,6 @@ a        """
         return False
 
     def execSleap(self):
-        global pid
         self.makeDir()
 
         if self.ext == '.mol2':
@@ -976,14 +1298,7 @@ a        """
             self.printMess("Executing Sleap...")
             self.printDebug(cmd)
 
-            p = sub.Popen(cmd, shell = True, stderr = sub.STDOUT, stdout = sub.PIPE)
-            pid = p.pid
-            signal.signal(signal.SIGALRM, self.signal_handler)
-            signal.alarm(self.timeTol)
-
-            out = str(p.communicate()[0].decode()) #p.stdout.read()
-
-            self.sleapLog = out
+            self.sleapLog = self.execCmd(cmd, 'Sleap')
             self.checkLeapLog(self.sleapLog)
 
             if self.checkXyzAndTopFiles():
@@ -1010,7 +1325,9 @@ a        """
             fail = True
             #sys.exit(1)
 
-        if self.execParmchk():
+        if self.cacheHit:
+            self.printMess("* Parmchk skipped, frcmod from cache *")
+        elif self.execParmchk():
             self.printError("Parmchk failed")
             fail = True
             #sys.exit(1)
@@ -1018,6 +1335,9 @@ a        """
         if fail:
             return True
 
+        if self.cacheEntry and not self.cacheHit:
+            self.storeCacheEntry(self.cacheEntry)
+
         tleapScpt = TLEAP_TEMPLATE % self.acParDict
 
         fp = open('tleap.in', 'w')
@@ -1033,7 +1353,7 @@ a        """
             except: pass
             self.printMess("Executing Tleap...")
             self.printDebug(cmd)
-            self.tleapLog = _getoutput(cmd)
+            self.tleapLog = self.execCmd(cmd, 'Tleap')
             self.checkLeapLog(self.tleapLog)
 
         if self.checkXyzAndTopFiles():
@@ -1085,7 +1405,7 @@ a        """
 
             cmd += ' -p %s' % parm99gaffff99SBFile # Ignoring parm10.dat and BSC0
 
-        self.parmchkLog = _getoutput(cmd)
+        self.parmchkLog = self.execCmd(cmd, 'Parmchk')
 
         self.printDebug(cmd)
 
@@ -1180,11 +1500,11 @@ a        """
                 self.molTopol.writeGromacsTopolFiles()
             if 'charmm' in self.outTopols:
                 self.writeCharmmTopolFiles()
-        self.pickleSave()
+        self.topStoreSave()
 
     def pickleSave(self):
         """
-            To restore:
+            Superseded by topStoreSave, kept to restore old .pkl files:
                 from acpype import *
                 #import cPickle as pickle
                 import pickle
@@ -1210,44 +1530,148 @@ a        """
                 else:
                     pickle.dump(self, f, protocol = 2)
 
-    def getFlagData(self, flag):
+    def topStoreSave(self):
         """
-            For a given acFileTop flag, return a list of the data related
+            Save the molecule topology (self.molTopol) in a versioned,
+            memory-mappable store (see gromacs.fileformats.topstore).
+            Replaces the pickle dump, to restore:
+                from gromacs.fileformats import topstore
+                o = topstore.load('DDD.tps')
+                o.meta['resName'], o['charges'], o['bond_atoms']
+            or rewrite its GROMACS files ('acpype -T DDD.tps', see
+            MolTopol.loadTopStore); itp_match.py also reads it as a fragment
+            topology.
         """
-        block = False
-        tFlag = '%FLAG ' + flag
-        data = ''
+        tpsFile = self.baseName + ".tps"
+        dumpFlag = False
+        if not os.path.exists(tpsFile):
+            mess = "Writing topology store file %s" % tpsFile
+            dumpFlag = True
+        elif self.force:
+            mess = "Overwriting topology store file %s" % tpsFile
+            dumpFlag = True
+        else:
+            mess = "Topology store file %s already present... doing nothing" % tpsFile
+        self.printMess(mess)
+        if dumpFlag:
+            arrays, meta = self.molTopol.getTopStoreData()
+            topstore.save(tpsFile, arrays, meta)
 
-        if len(self.topFileData) == 0:
-            raise Exception("PRMTOP file empty?")
+    def getTopStoreData(self):
+        """
+            Arrays (prmtop atom order, AMBER units: kcal/mol, Ang., rad and
+            electron charge) and header meta data of the topology store
+        """
+        atoms = self.prmtopAtoms
+        atomTypes = self.atomTypes
+        typeIndex = dict((t.atomTypeName, i) for i, t in enumerate(atomTypes))
+        bondArrays, angleArrays, dihArrays = self.bondArrays, self.angleArrays, self.dihedralArrays
+        arrays = {
+            'atom_names' : np.array([a.atomName for a in atoms]),
+            'atom_types' : np.array([typeIndex[a.atomType.atomTypeName] for a in atoms], dtype = np.int32),
+            'atom_resids' : np.array([a.resid for a in atoms], dtype = np.int32),
+            'atom_ids' : np.array([a.id for a in atoms], dtype = np.int32),
+            'atom_cgnrs' : np.array([a.cgnr for a in atoms], dtype = np.int32),
+            'masses' : np.array([a.mass for a in atoms]),
+            'charges' : np.array([a.charge for a in atoms]),
+            'coords' : np.array([a.coords for a in atoms]).reshape(-1, 3),
+            'residue_labels' : np.array(self.residueLabel),
+            'atomtype_names' : np.array([t.atomTypeName for t in atomTypes]),
+            'atomtype_masses' : np.array([t.mass for t in atomTypes]),
+            'atomtype_acoef' : np.array([t.ACOEF for t in atomTypes]),
+            'atomtype_bcoef' : np.array([t.BCOEF for t in atomTypes]),
+            'bond_atoms' : bondArrays.atoms,
+            'bond_kb' : bondArrays.get('kBond'),
+            'bond_req' : bondArrays.get('rEq'),
+            'angle_atoms' : angleArrays.atoms,
+            'angle_ktheta' : angleArrays.get('kTheta'),
+            'angle_theta' : angleArrays.get('thetaEq'),
+            'dihedral_atoms' : dihArrays.atoms,
+            'dihedral_kphi' : dihArrays.get('kPhi'),
+            'dihedral_period' : dihArrays.get('period').astype(np.int32),
+            'dihedral_phase' : dihArrays.get('phase'),
+            'dihedral_improper' : dihArrays.improper,
+            'dihedral_skip14' : dihArrays.skip14,
+            'pair_atoms' : np.asarray(dihArrays.pairs, dtype = np.int32).reshape(-1, 2),
+        }
+        meta = {'source' : 'acpype', 'rev' : svnRev, 'date' : date,
+                'baseName' : self.baseName, 'resName' : self.residueLabel[0],
+                'atomTypeSystem' : self.atomTypeSystem, 'totalCharge' : self.totalCharge,
+                'pbc' : self.pbc, 'sorted' : bool(self.sorted),
+                'units' : {'length' : 'Ang', 'energy' : 'kcal/mol', 'angle' : 'rad',
+                           'charge' : 'e', 'mass' : 'amu'}}
+        return arrays, meta
+
+    def loadTopStore(self, tpsFile):
+        """
+            Set the topology from a store written by topStoreSave, instead of
+            parsing prmtop and inpcrd (the inverse of getTopStoreData): residue
+            labels, atoms (in GROMACS order if sorted when saved), atom types
+            and the arrays of bonded terms, enough for writeGromacsTopolFiles.
+        """
+        store = topstore.load(tpsFile)
+        meta = store.meta
+        self.residueLabel = store['residue_labels'].tolist()
+        # same coefficient -> same object, as from getABCOEFs, which
+        # setAtomType4Gromacs relies on to merge lower and uppercase types
+        coefs = {}
+        atomTypes = [AtomType(name, mass, coefs.setdefault(A, A), coefs.setdefault(B, B)) for
+                     name, mass, A, B in zip(store['atomtype_names'].tolist(),
+                     store['atomtype_masses'].tolist(), store['atomtype_acoef'].tolist(),
+                     store['atomtype_bcoef'].tolist())]
+        atoms = []
+        for name, typeId, id, resid, cgnr, mass, charge, coords in zip(
+                store['atom_names'].tolist(), store['atom_types'].tolist(),
+                store['atom_ids'].tolist(), store['atom_resids'].tolist(),
+                store['atom_cgnrs'].tolist(), store['masses'].tolist(),
+                store['charges'].tolist(), store['coords'].tolist()):
+            atom = Atom(name, atomTypes[typeId], id, resid, mass, charge, coords)
+            atom.cgnr = cgnr
+            atoms.append(atom)
+        self.prmtopAtoms = atoms
+        self.atoms = sorted(atoms, key = lambda a: a.id)
+        self.atomTypes = atomTypes
+        self.atomTypeSystem = meta['atomTypeSystem']
+        self.totalCharge = meta['totalCharge']
+        self.pbc = meta['pbc']
+        self.sorted = meta['sorted']
+        self.baseName = meta['baseName']
+
+        # one parameter type per term
+        def terms(name, **params):
+            atoms = np.asarray(store[name + '_atoms'], dtype = np.int32)
+            return BondedArrays(atoms, np.arange(len(atoms), dtype = np.int32),
+                                **dict((k, np.asarray(store[v])) for k, v in params.items()))
+        self.bondArrays = terms('bond', kBond = 'bond_kb', rEq = 'bond_req')
+        self.angleArrays = terms('angle', kTheta = 'angle_ktheta', thetaEq = 'angle_theta')
+        dihedrals = terms('dihedral', kPhi = 'dihedral_kphi', period = 'dihedral_period',
+                          phase = 'dihedral_phase')
+        dihedrals.improper = np.asarray(store['dihedral_improper'], dtype = bool)
+        dihedrals.skip14 = np.asarray(store['dihedral_skip14'], dtype = bool)
+        proper = ~dihedrals.improper
+        dihedrals.groups = properGroups(dihedrals.atoms[proper], dihedrals.skip14[proper])
+        dihedrals.pairs = np.asarray(store['pair_atoms'], dtype = np.int32)
+        self.dihedralArrays = dihedrals
+        self.printDebug("loadTopStore done")
+
+    def getFlagArray(self, flag):
+        """
+            For a given acFileTop flag, return a numpy array of the data related
+            acFileTop is indexed only once (see PrmtopIndex)
+        """
+        index = getattr(self, 'topFlagIndex', None)
+        if index is None or index.lines is not self.topFileData:
+            if len(self.topFileData) == 0:
+                raise Exception("PRMTOP file empty?")
+            index = PrmtopIndex(self.topFileData)
+            self.topFlagIndex = index
+        return index.getArray(flag)
 
-        for rawLine in self.topFileData:
-            line = rawLine[:-1]
-            if tFlag in line:
-                block = True
-                continue
-            if block and '%FLAG ' in line: break
-            if block:
-                if '%FORMAT' in line:
-                    line = line.strip().strip('%FORMAT()').split('.')[0]
-                    for c in line:
-                        if c.isalpha():
-                            f = int(line.split(c)[1])
-                            break
-                    continue
-                data += line
-        # data need format
-        sdata = [data[i:i + f].strip() for i in range(0, len(data), f)]
-        if '+' and '.' in data: # it's a float
-            ndata = list(map(float, sdata))
-        elif flag != 'RESIDUE_LABEL':
-            try: # try if it's integer
-                ndata = list(map(int, sdata))
-            except: # it's string
-                ndata = sdata
-        else:
-            ndata = sdata
-        return ndata # a list
+    def getFlagData(self, flag):
+        """
+            For a given acFileTop flag, return a list of the data related
+        """
+        return self.getFlagArray(flag).tolist() # a list
 
     def getResidueLabel(self):
         """
@@ -1269,16 +1693,8 @@ a        """
         """
         if len(self.xyzFileData) == 0:
             raise Exception("INPCRD file empty?")
-        data = ''
-        for rawLine in self.xyzFileData[2:]:
-            line = rawLine[:-1]
-            data += line
-        l = len(data)
-        ndata = list(map(float, [data[i:i + 12] for i in range(0, l, 12)]))
-
-        gdata = []
-        for i in range(0, len(ndata), 3):
-            gdata.append([ndata[i], ndata[i + 1], ndata[i + 2]])
+        ndata = fixedWidthArray(self.xyzFileData[2:], 12, 6, 'F')
+        gdata = ndata.reshape(-1, 3).tolist()
 
         self.printDebug("getCoords done")
 
@@ -1292,61 +1708,44 @@ a        """
             Set also resid
             Set also molTopol total charge
         """
-        atomNameList = self.getFlagData('ATOM_NAME')
+        atomNames = self.getFlagArray('ATOM_NAME')
         atomTypeNameList = self.getFlagData('AMBER_ATOM_TYPE')
         self._atomTypeNameList = atomTypeNameList
         massList = self.getFlagData('MASS')
-        chargeList = self.getFlagData('CHARGE')
-#        totalCharge = sum(chargeList)
-#        self.printDebug('charge to be balanced: total %13.10f' % (totalCharge/qConv))
-
-        resIds = self.getFlagData('RESIDUE_POINTER') + [0]
-        # to guess the resId of the last residue before ion or water
-#        for resTemp in self.residueLabel:
-#            if resTemp in ionOrWaterResNameList:
-#                lastSoluteResId = self.residueLabel.index(resTemp) - 1
-#                break
-        #print lastSoluteResId, self.residueLabel[lastSoluteResId]
-        #uniqAtomTypeId = self.getFlagData('ATOM_TYPE_INDEX') # for LJ
-#        balanceChargeList = self.balanceCharges(chargeList)
+        charges = self.getFlagArray('CHARGE')
+        chargeList = charges.tolist()
+        totalCharge = sum(chargeList)
+        nAtoms = len(atomNames)
+
+        # resid of every atom from the pointers to the first atom of each residue
+        resIds = self.getFlagArray('RESIDUE_POINTER')
+        resids = np.searchsorted(resIds, np.arange(1, nAtoms + 1), side = 'right') - 1
+        # first atom (not the very first one) of an ion or solvent residue
+        resNames = np.array(self.residueLabel)[resids]
+        nonSoluteIds = np.flatnonzero(np.isin(resNames, ionOrSolResNameList))
+        nonSoluteIds = nonSoluteIds[nonSoluteIds > 0]
+        FirstNonSoluteId = int(nonSoluteIds[0]) if len(nonSoluteIds) else None
+
+        upperNames = np.char.upper(atomNames)
+        for atomName in atomNames[upperNames != atomNames]:
+            self.printDebug("atom name '%s' HAS to be all UPPERCASE... Applying this here." %
+                           atomName)
+
         coords = self.getCoords()
         ACOEFs, BCOEFs = self.getABCOEFs()
+        chargesConverted = (charges / qConv).tolist()
 
         atoms = []
         atomTypes = []
-        tmpList = [] # a list with unique atom types
-        totalCharge = 0.0
-        countRes = 0
-        id = 0
-        FirstNonSoluteId = None
-        for atomName in atomNameList:
-            if atomName != atomName.upper():
-                self.printDebug("atom name '%s' HAS to be all UPPERCASE... Applying this here." %
-                               atomName)
-                atomName = atomName.upper()
-            atomTypeName = atomTypeNameList[id]
-            if id + 1 == resIds[countRes]:
-                resid = countRes #self.residueLabel[countRes]
-                countRes += 1
-            resName = self.residueLabel[resid]
-            if resName in ionOrSolResNameList and not FirstNonSoluteId:
-                FirstNonSoluteId = id
-                #print id, resid, resName
-            mass = massList[id]
-            #charge = balanceChargeList[id]
-            charge = chargeList[id]
-            chargeConverted = charge / qConv
-            totalCharge += charge
-            coord = coords[id]
-            ACOEF = ACOEFs[id]
-            BCOEF = BCOEFs[id]
-            atomType = AtomType(atomTypeName, mass, ACOEF, BCOEF)
+        tmpList = set() # unique atom types
+        for id, (atomName, atomTypeName, resid, mass, charge) in enumerate(zip(
+                upperNames.tolist(), atomTypeNameList, resids.tolist(), massList, chargesConverted)):
+            atomType = AtomType(atomTypeName, mass, ACOEFs[id], BCOEFs[id])
             if atomTypeName not in tmpList:
-                tmpList.append(atomTypeName)
+                tmpList.add(atomTypeName)
                 atomTypes.append(atomType)
-            atom = Atom(atomName, atomType, id + 1, resid, mass, chargeConverted, coord)
+            atom = Atom(atomName, atomType, id + 1, resid, mass, charge, coords[id])
             atoms.append(atom)
-            id += 1
 
         balanceChargeList, balanceValue, balanceIds = self.balanceCharges(chargeList, FirstNonSoluteId)
 
@@ -1354,7 +1753,7 @@ a        """
             atoms[id].charge = balanceValue / qConv
         #self.printDebug("atom ids and balanced charges: %s, %3f10" % (balanceIds, balanceValue/qConv))
 
-        if atomTypeName[0].islower():
+        if atomTypeNameList[-1][0].islower():
             self.atomTypeSystem = 'gaff'
         else:
             self.atomTypeSystem = 'amber'
@@ -1363,6 +1762,7 @@ a        """
         self.totalCharge = int(totalCharge)
 
         self.atoms = atoms
+        self.prmtopAtoms = atoms
         self.atomTypes = atomTypes
 
         self.pbc = None
@@ -1371,109 +1771,118 @@ a        """
         self.printDebug("PBC = '%s" % self.pbc)
         self.printDebug("getAtoms done")
 
+    def getBondedCodes(self, flag, size):
+        """
+            Join the INC_HYDROGEN and WITHOUT_HYDROGEN lists of a bonded term
+            (BONDS, ANGLES or DIHEDRALS) in an array with a row per term, i.e.
+            'size' columns of atom codes plus the parameter type
+        """
+        codes = np.concatenate((self.getFlagArray(flag + '_INC_HYDROGEN'),
+                                self.getFlagArray(flag + '_WITHOUT_HYDROGEN')))
+        return codes.reshape(-1, size + 1)
+
     def getBonds(self):
-        uniqKbList = self.getFlagData('BOND_FORCE_CONSTANT')
-        uniqReqList = self.getFlagData('BOND_EQUIL_VALUE')
-        bondCodeHList = self.getFlagData('BONDS_INC_HYDROGEN')
-        bondCodeNonHList = self.getFlagData('BONDS_WITHOUT_HYDROGEN')
-        bondCodeList = bondCodeHList + bondCodeNonHList
-        bonds = []
-        for i in range(0, len(bondCodeList), 3):
-            idAtom1 = bondCodeList[i] // 3 # remember python starts with id 0
-            idAtom2 = bondCodeList[i + 1] // 3
-            bondTypeId = bondCodeList[i + 2] - 1
-            atom1 = self.atoms[idAtom1]
-            atom2 = self.atoms[idAtom2]
-            kb = uniqKbList[bondTypeId]
-            req = uniqReqList[bondTypeId]
-            atoms = [atom1, atom2]
-            bond = Bond(atoms, kb, req)
-            bonds.append(bond)
-        self.bonds = bonds
+        """
+            Set bondArrays (see BondedArrays) from acFileTop
+        """
+        bondCodes = self.getBondedCodes('BONDS', 2)
+        self.bondArrays = BondedArrays((bondCodes[:, :2] // 3).astype(np.int32),
+                                       (bondCodes[:, 2] - 1).astype(np.int32),
+                                       kBond = self.getFlagArray('BOND_FORCE_CONSTANT'),
+                                       rEq = self.getFlagArray('BOND_EQUIL_VALUE'))
         self.printDebug("getBonds done")
 
     def getAngles(self):
-        uniqKtList = self.getFlagData('ANGLE_FORCE_CONSTANT')
-        uniqTeqList = self.getFlagData('ANGLE_EQUIL_VALUE')
-        # for list below, true atom number = index/3 + 1
-        angleCodeHList = self.getFlagData('ANGLES_INC_HYDROGEN')
-        angleCodeNonHList = self.getFlagData('ANGLES_WITHOUT_HYDROGEN')
-        angleCodeList = angleCodeHList + angleCodeNonHList
-        angles = []
-        for i in range(0, len(angleCodeList), 4):
-            idAtom1 = angleCodeList[i] // 3 # remember python starts with id 0
-            idAtom2 = angleCodeList[i + 1] // 3
-            idAtom3 = angleCodeList[i + 2] // 3
-            angleTypeId = angleCodeList[i + 3] - 1
-            atom1 = self.atoms[idAtom1]
-            atom2 = self.atoms[idAtom2]
-            atom3 = self.atoms[idAtom3]
-            kt = uniqKtList[angleTypeId]
-            teq = uniqTeqList[angleTypeId] # angle given in rad in prmtop
-            atoms = [atom1, atom2, atom3]
-            angle = Angle(atoms, kt, teq)
-            angles.append(angle)
-        self.angles = angles
+        """
+            Set angleArrays (see BondedArrays) from acFileTop
+        """
+        # true atom number = index/3 + 1
+        angleCodes = self.getBondedCodes('ANGLES', 3)
+        self.angleArrays = BondedArrays((angleCodes[:, :3] // 3).astype(np.int32),
+                                        (angleCodes[:, 3] - 1).astype(np.int32),
+                                        kTheta = self.getFlagArray('ANGLE_FORCE_CONSTANT'),
+                                        thetaEq = self.getFlagArray('ANGLE_EQUIL_VALUE')) # rad
         self.printDebug("getAngles done")
 
     def getDihedrals(self):
         """
-            Get dihedrals (proper and imp), condensed list of prop dih and
-            atomPairs
-        """
-        uniqKpList = self.getFlagData('DIHEDRAL_FORCE_CONSTANT')
-        uniqPeriodList = self.getFlagData('DIHEDRAL_PERIODICITY')
-        uniqPhaseList = self.getFlagData('DIHEDRAL_PHASE')
-        # for list below, true atom number = abs(index)/3 + 1
-        dihCodeHList = self.getFlagData('DIHEDRALS_INC_HYDROGEN')
-        dihCodeNonHList = self.getFlagData('DIHEDRALS_WITHOUT_HYDROGEN')
-        dihCodeList = dihCodeHList + dihCodeNonHList
-        properDih = []
-        improperDih = []
+            Set dihedralArrays (see BondedArrays) from acFileTop, with also:
+                improper: if term is an improper dihedral
+                skip14: if 1-4 interactions of term are to be ignored
+                groups: for each proper dihedral, the id of its quartet in the
+                        condensed list of proper dihedrals
+                pairs: unique pairs of atoms for 1-4 interactions
+        """
+        uniqKpList = self.getFlagArray('DIHEDRAL_FORCE_CONSTANT') # already divided by IDIVF
+        uniqPhaseList = self.getFlagArray('DIHEDRAL_PHASE') # angle given in rad in prmtop
+        uniqPeriodList = self.getFlagArray('DIHEDRAL_PERIODICITY').astype(int)
+        uniqPeriodList[(uniqPhaseList == 0) & (uniqKpList == 0)] = 0 # period is set to 0
+        # true atom number = abs(index)/3 + 1
+        dihCodes = self.getBondedCodes('DIHEDRALS', 4)
+        # 3 and 4 indexes can be negative: if id3 < 0, end group interations
+        # in amber are to be ignored; if id4 < 0, dihedral is improper
+        idAtomsRaw = dihCodes[:, :4] // 3
+        dihedrals = BondedArrays(np.abs(idAtomsRaw).astype(np.int32),
+                                 (dihCodes[:, 4] - 1).astype(np.int32),
+                                 kPhi = uniqKpList, period = uniqPeriodList,
+                                 phase = uniqPhaseList)
+        dihedrals.improper = idAtomsRaw[:, 3] < 0
+        dihedrals.skip14 = idAtomsRaw[:, 2] < 0
+        # a proper dihedral with id3 < 0 and the same quartet of the previous
+        # proper is condensed with it
+        proper = ~dihedrals.improper
+        quartets = dihedrals.atoms[proper]
+        dihedrals.groups = properGroups(quartets, dihedrals.skip14[proper])
+        pairs = quartets[idAtomsRaw[proper, 2] > 0][:, [0, 3]]
+        if len(pairs):
+            pairs = np.unique(pairs, axis = 0)
+        dihedrals.pairs = pairs
+        self.dihedralArrays = dihedrals
+        self.printDebug("getDihedrals done")
+
+    def buildBondObjects(self):
+        """
+            Set bonds, a list of Bond objects, from bondArrays
+        """
+        bondArrays = self.bondArrays
+        atoms = self.prmtopAtoms
+        self.bonds = [Bond([atoms[i] for i in ids], kb, req) for ids, kb, req in
+                      zip(bondArrays.atoms.tolist(), bondArrays.get('kBond').tolist(),
+                          bondArrays.get('rEq').tolist())]
+
+    def buildAngleObjects(self):
+        """
+            Set angles, a list of Angle objects, from angleArrays
+        """
+        angleArrays = self.angleArrays
+        atoms = self.prmtopAtoms
+        self.angles = [Angle([atoms[i] for i in ids], kt, teq) for ids, kt, teq in
+                       zip(angleArrays.atoms.tolist(), angleArrays.get('kTheta').tolist(),
+                           angleArrays.get('thetaEq').tolist())]
+
+    def buildDihedralObjects(self):
+        """
+            Set properDihedrals, improperDihedrals, condensedProperDihedrals
+            and atomPairs from dihedralArrays
+        """
+        dihedrals = self.dihedralArrays
+        atoms = self.prmtopAtoms
+        dihObjects = [Dihedral([atoms[i] for i in ids], kPhi, period, phase) for
+                      ids, kPhi, period, phase in zip(dihedrals.atoms.tolist(),
+                      dihedrals.get('kPhi').tolist(), dihedrals.get('period').tolist(),
+                      dihedrals.get('phase').tolist())]
+        improper = dihedrals.improper.tolist()
+        properDih = [d for d, imp in zip(dihObjects, improper) if not imp]
         condProperDih = [] # list of dihedrals condensed by the same quartet
-        #atomPairs = []
-        atomPairs = set()
-        for i in range(0, len(dihCodeList), 5):
-            idAtom1 = dihCodeList[i] // 3 # remember python starts with id 0
-            idAtom2 = dihCodeList[i + 1] // 3
-            # 3 and 4 indexes can be negative: if id3 < 0, end group interations
-            # in amber are to be ignored; if id4 < 0, dihedral is improper
-            idAtom3raw = dihCodeList[i + 2] // 3 # can be negative -> exclude from 1-4vdw
-            idAtom4raw = dihCodeList[i + 3] // 3 # can be negative -> Improper
-            idAtom3 = abs(idAtom3raw)
-            idAtom4 = abs(idAtom4raw)
-            dihTypeId = dihCodeList[i + 4] - 1
-            atom1 = self.atoms[idAtom1]
-            atom2 = self.atoms[idAtom2]
-            atom3 = self.atoms[idAtom3]
-            atom4 = self.atoms[idAtom4]
-            kPhi = uniqKpList[dihTypeId] # already divided by IDIVF
-            period = int(uniqPeriodList[dihTypeId]) # integer
-            phase = uniqPhaseList[dihTypeId]# angle given in rad in prmtop
-            if phase == kPhi == 0: period = 0 # period is set to 0
-            atoms = [atom1, atom2, atom3, atom4]
-            dihedral = Dihedral(atoms, kPhi, period, phase)
-            if idAtom4raw > 0:
-                try: atomsPrev = properDih[-1].atoms
-                except: atomsPrev = []
-                properDih.append(dihedral)
-                if idAtom3raw < 0 and atomsPrev == atoms:
-                    condProperDih[-1].append(dihedral)
-                else:
-                    condProperDih.append([dihedral])
-                pair = (atom1, atom4)
-                #if atomPairs.count(pair) == 0 and idAtom3raw > 0:
-                if idAtom3raw > 0:
-                    atomPairs.add(pair)
-            else:
-                improperDih.append(dihedral)
-        try: atomPairs = sorted(atomPairs)
-        except: pass
+        for dih, group in zip(properDih, dihedrals.groups.tolist()):
+            if group == len(condProperDih):
+                condProperDih.append([])
+            condProperDih[group].append(dih)
+        atomPairs = [(atoms[i], atoms[j]) for i, j in dihedrals.pairs.tolist()]
         self.properDihedrals = properDih
-        self.improperDihedrals = improperDih
+        self.improperDihedrals = [d for d, imp in zip(dihObjects, improper) if imp]
         self.condensedProperDihedrals = condProperDih # [[],[],...]
-        self.atomPairs = atomPairs # set((atom1, atom2), ...)
-        self.printDebug("getDihedrals done")
+        self.atomPairs = atomPairs # [(atom1, atom2), ...]
 
     def sortAtomsForGromacs(self):
         """
@@ -1481,55 +1890,22 @@ a        """
             follow the heavy atom they are bonded to and belong to the same charge
             group.
 
-            Currently, atom mass < 1.2 is taken to denote a proton.  This behavior
-            may be changed by modifying the 'is_hydrogen' function within.
+            Currently, atom mass < 1.2 is taken to denote a proton (see
+            gromacsAtomOrder).
 
             JDC 2011-02-03
         """
+        atoms = self.atoms
+        masses = np.array([atom.mass for atom in atoms])
+        # bonds as positions in the current list of atoms
+        positions = np.array([atom.id for atom in self.prmtopAtoms]) - 1
+        order, cgnrs = gromacsAtomOrder(masses, positions[self.bondArrays.atoms])
 
-        # Build dictionary of bonded atoms.
-        bonded_atoms = dict()
-        for atom in self.atoms:
-            bonded_atoms[atom] = list()
-        for bond in self.bonds:
-            [atom1, atom2] = bond.atoms
-            bonded_atoms[atom1].append(atom2)
-            bonded_atoms[atom2].append(atom1)
-
-        # Define hydrogen and heavy atom classes.
-        def is_hydrogen(atom):
-            return (atom.mass < 1.2)
-
-        def is_heavy(atom):
-            return not is_hydrogen(atom)
-
-        # Build list of sorted atoms, assigning charge groups by heavy atom.
-        sorted_atoms = list()
-        cgnr = 1 # charge group number: each heavy atoms is assigned its own charge group
-        # First pass: add heavy atoms, followed by the hydrogens bonded to them.
-        for atom in self.atoms:
-            if is_heavy(atom):
-                # Append heavy atom.
-                atom.cgnr = cgnr
-                sorted_atoms.append(atom)
-                # Append all hydrogens.
-                for bonded_atom in bonded_atoms[atom]:
-                    if is_hydrogen(bonded_atom) and not (bonded_atom in sorted_atoms):
-                        # Append bonded hydrogen.
-                        bonded_atom.cgnr = cgnr
-                        sorted_atoms.append(bonded_atom)
-                cgnr += 1
-
-        # Second pass: Add any remaining atoms.
-        if len(sorted_atoms) < len(self.atoms):
-            for atom in self.atoms:
-                if not (atom in sorted_atoms):
-                    atom.cgnr = cgnr
-                    sorted_atoms.append(atom)
-                    cgnr += 1
+        for atom, cgnr in zip(atoms, cgnrs.tolist()):
+            atom.cgnr = cgnr
 
         # Replace current list of atoms with sorted list.
-        self.atoms = sorted_atoms
+        self.atoms = [atoms[i] for i in order.tolist()]
 
         # Renumber atoms in sorted list, starting from 1.
         for (index, atom) in enumerate(self.atoms):
@@ -1542,15 +1918,15 @@ a        """
             Set a list of pair of atoms pertinent to interaction 1-4 for vdw.
             WRONG: Deprecated
         """
-        atomPairs = []
-        for item in self.condensedProperDihedrals:
-            dih = item[0]
-            atom1 = dih.atoms[0]
-            atom2 = dih.atoms[3]
-            pair = [atom1, atom2]
-            if atomPairs.count(pair) == 0:
-                atomPairs.append(pair)
-        self.atomPairs = atomPairs # [[atom1, atom2], ...]
+        dihedrals = self.dihedralArrays
+        quartets = dihedrals.atoms[~dihedrals.improper]
+        starts = np.flatnonzero(np.diff(dihedrals.groups, prepend = -1))
+        pairs = quartets[starts][:, [0, 3]]
+        if len(pairs): # unique pairs, in order of appearance
+            pairs = pairs[np.sort(np.unique(pairs, axis = 0, return_index = True)[1])]
+        dihedrals.pairs = pairs
+        atoms = self.prmtopAtoms
+        self.atomPairs = [[atoms[i], atoms[j]] for i, j in pairs.tolist()] # [[atom1, atom2], ...]
         self.printDebug("atomPairs done")
 
     def getExcludedAtoms(self):
@@ -1608,36 +1984,35 @@ a        """
         return chargeList, fix, limIds
 
     def getABCOEFs(self):
-        uniqAtomTypeIdList = self.getFlagData('ATOM_TYPE_INDEX')
-        nonBonIdList = self.getFlagData('NONBONDED_PARM_INDEX')
+        uniqAtomTypeIdList = self.getFlagArray('ATOM_TYPE_INDEX')
+        nonBonIdList = self.getFlagArray('NONBONDED_PARM_INDEX')
         rawACOEFs = self.getFlagData('LENNARD_JONES_ACOEF')
         rawBCOEFs = self.getFlagData('LENNARD_JONES_BCOEF')
-        #print nonBonIdList, len(nonBonIdList), rawACOEFs, len(rawACOEFs)
-        ACOEFs = []
-        BCOEFs = []
-        ntypes = max(uniqAtomTypeIdList)
-        #id = 0
-        #for atName in self._atomTypeNameList:
-        for id in range(len(self._atomTypeNameList)):
-            #id = self._atomTypeNameList.index(atName)
-            atomTypeId = uniqAtomTypeIdList[id]
-            index = ntypes * (atomTypeId - 1) + atomTypeId
-            nonBondId = nonBonIdList[index - 1]
-            #print "*****", index, ntypes, atName, id, atomTypeId, nonBondId
-            ACOEFs.append(rawACOEFs[nonBondId - 1])
-            BCOEFs.append(rawBCOEFs[nonBondId - 1])
-            #id += 1
-        #print ACOEFs
+        ntypes = uniqAtomTypeIdList.max()
+        # diagonal (i == j) entry of the LJ matrix for each atom
+        index = ntypes * (uniqAtomTypeIdList - 1) + uniqAtomTypeIdList
+        nonBondIds = (nonBonIdList[index - 1] - 1).tolist()
+        # same atom type -> same coef object
+        ACOEFs = [rawACOEFs[i] for i in nonBondIds]
+        BCOEFs = [rawBCOEFs[i] for i in nonBondIds]
         self.printDebug("getABCOEFs done")
         return ACOEFs, BCOEFs
 
     def setProperDihedralsCoef(self):
         """
-            It takes self.condensedProperDihedrals and returns
-            self.properDihedralsCoefRB, a reduced list of quartet atoms + RB.
-            Coeficients ready for GMX (multiplied by 4.184)
+            It takes the condensed proper dihedrals (dihedralArrays.groups) and
+            sets self.properDihedralsCoefRB, a reduced array of quartet atoms
+            + RB coeficients, ready for GMX (multiplied by 4.184)
+
+            self.properDihedralsCoefRB = [quartets (n, 4), C (n, 6)]
+
+            and, for the dihedrals that can't be (phase not 0 or 180) or won't
+            be (gmx45) converted to RB, with phase in degree:
+
+            self.properDihedralsAlphaGamma = [quartets, phase, kPhi, period]
+            self.properDihedralsGmx45 = [quartets, phase, kPhi, period]
 
-            self.properDihedralsCoefRB = [ [atom1,..., atom4], C[0:5] ]
+            Quartets are atom indexes in prmtop order (see prmtopAtoms).
 
             For proper dihedrals: a quartet of atoms may appear with more than
             one set of parameters and to convert to GMX they are treated as RBs.
@@ -1647,66 +2022,46 @@ a        """
             number from prmtop and not rounded numbers from rdparm.out as
             amb2gmx.pl does.
         """
-        properDihedralsCoefRB = []
-        properDihedralsAlphaGamma = []
-        properDihedralsGmx45 = []
-        for item in self.condensedProperDihedrals:
-            V = 6 * [0.0]
-            C = 6 * [0.0]
-            for dih in item:
-                period = dih.period # Pn
-                kPhi = dih.kPhi # in rad
-                phaseRaw = dih.phase * radPi # in degree
-                phase = int(phaseRaw) # in degree
-                if period > 4 and not self.gmx45:
-                    self.printError("Likely trying to convert ILDN to RB, use option '-r' for GMX45")
-                    sys.exit(1)
-                if phase in [0, 180]:
-                    properDihedralsGmx45.append([item[0].atoms, phaseRaw, kPhi, period])
-                    if not self.gmx45:
-                        if kPhi > 0: V[period] = 2 * kPhi * cal
-                        if period == 1:
-                            C[0] += 0.5 * V[period]
-                            if phase == 0:
-                                C[1] -= 0.5 * V[period]
-                            else:
-                                C[1] += 0.5 * V[period]
-                        elif period == 2:
-                            if phase == 180:
-                                C[0] += V[period]
-                                C[2] -= V[period]
-                            else:
-                                C[2] += V[period]
-                        elif period == 3:
-                            C[0] += 0.5 * V[period]
-                            if phase == 0:
-                                C[1] += 1.5 * V[period]
-                                C[3] -= 2 * V[period]
-                            else:
-                                C[1] -= 1.5 * V[period]
-                                C[3] += 2 * V[period]
-                        elif period == 4:
-                            if phase == 180:
-                                C[2] += 4 * V[period]
-                                C[4] -= 4 * V[period]
-                            else:
-                                C[0] += V[period]
-                                C[2] -= 4 * V[period]
-                                C[4] += 4 * V[period]
-                else:
-                    properDihedralsAlphaGamma.append([item[0].atoms, phaseRaw, kPhi, period])
-                    #print phaseRaw, kPhi, period
-            if phase in [0, 180]:
-                properDihedralsCoefRB.append([item[0].atoms, C])
-
-        #print properDihedralsCoefRB
-        #print properDihedralsAlphaGamma
+        dihedrals = self.dihedralArrays
+        proper = ~dihedrals.improper
+        quartets = dihedrals.atoms[proper]
+        kPhis = dihedrals.get('kPhi')[proper] # in rad
+        periods = dihedrals.get('period')[proper] # Pn
+        phasesRaw = dihedrals.get('phase')[proper] * radPi # in degree
+        phases = phasesRaw.astype(int) # in degree
+        groups = dihedrals.groups
+        starts = np.flatnonzero(np.diff(groups, prepend = -1))
+        lasts = np.append(starts[1:], len(groups)) - 1
+        if not self.gmx45 and (periods > 4).any():
+            self.printError("Likely trying to convert ILDN to RB, use option '-r' for GMX45")
+            sys.exit(1)
+        toRB = (phases == 0) | (phases == 180)
+        # a quartet goes to RB if its last term can be converted
+        groupsRB = toRB[lasts]
+        if self.gmx45:
+            coefRB = np.zeros((groupsRB.sum(), 6))
+        else:
+            coefRB = amber_to_rb(kPhis[toRB], periods[toRB], phases[toRB], groups[toRB],
+                                 len(starts), scale = cal)[groupsRB]
+        alphaGamma = ~toRB
 
         self.printDebug("setProperDihedralsCoef done")
 
-        self.properDihedralsCoefRB = properDihedralsCoefRB
-        self.properDihedralsAlphaGamma = properDihedralsAlphaGamma
-        self.properDihedralsGmx45 = properDihedralsGmx45
+        self.properDihedralsCoefRB = [quartets[starts[groupsRB]], coefRB]
+        self.properDihedralsAlphaGamma = [quartets[alphaGamma], phasesRaw[alphaGamma],
+                                          kPhis[alphaGamma], periods[alphaGamma]]
+        self.properDihedralsGmx45 = [quartets[toRB], phasesRaw[toRB], kPhis[toRB], periods[toRB]]
+
+    def getAtomColumns(self):
+        """
+            Arrays, in prmtop order, of current atom ids, atom names and
+            residue names, to write bonded terms straight from their arrays
+        """
+        atoms = self.prmtopAtoms
+        ids = np.array([a.id for a in atoms], dtype = np.int64)
+        names = np.array([a.atomName for a in atoms], dtype = object)
+        resNames = np.array(self.residueLabel, dtype = object)[[a.resid for a in atoms]]
+        return ids, names, resNames
 
     def writeCharmmTopolFiles(self):
 
@@ -2250,7 +2605,7 @@ a        """
             resid = atom.resid
             resname = self.residueLabel[resid]
             if not self.direct:
-                if resname in ionsDict.keys() + ['WAT' ]:
+                if resname in list(ionsDict.keys()) + ['WAT' ]:
                     break
             aName = atom.atomName
             aType = atom.atomType.atomTypeName
@@ -2285,244 +2640,115 @@ a        """
                 oitpText += otemp
         self.printDebug("GMX atoms done")
 
+        def addSection(head, temp, otemp):
+            temp.sort()
+            otemp.sort()
+            if temp:
+                if amb2gmx:
+                    topText.append(head)
+                    topText.extend(temp)
+                else:
+                    itpText.append(head)
+                    itpText.extend(temp)
+                    oitpText.append(head)
+                    oitpText.extend(otemp)
+
+        # bonded terms are written from their arrays, with atoms in prmtop order
+        ids, names, resNames = self.getAtomColumns()
+        oplsNames = np.array([id2oplsATDict.get(i) for i in ids.tolist()], dtype = object)
+
         # remove bond of water
-        self.printDebug("bonds %i" % len(self.bonds))
-        temp = []
-        otemp = []
-        for bond in self.bonds:
-            res1 = self.residueLabel[bond.atoms[0].resid]
-            res2 = self.residueLabel[bond.atoms[0].resid]
-            if 'WAT' in [res1, res2] : continue
-            a1Name = bond.atoms[0].atomName
-            a2Name = bond.atoms[1].atomName
-            id1 = bond.atoms[0].id
-            id2 = bond.atoms[1].id
-            oat1 = id2oplsATDict.get(id1)
-            oat2 = id2oplsATDict.get(id2)
-            line = "%6i %6i %3i %13.4e %13.4e ; %6s - %-6s\n" % (id1, id2, 1,
-                   bond.rEq * 0.1, bond.kBond * 200 * cal, a1Name, a2Name)
-            oline = "%6i %6i %3i ; %13.4e %13.4e ; %6s - %-6s %6s - %-6s\n" % \
-                (id1, id2, 1, bond.rEq * 0.1, bond.kBond * 200 * cal, a1Name,
-                 a2Name, oat1, oat2)
-            temp.append(line)
-            otemp.append(oline)
-        temp.sort()
-        otemp.sort()
-        if temp:
-            if amb2gmx:
-                topText.append(headBonds)
-                topText += temp
-            else:
-                itpText.append(headBonds)
-                itpText += temp
-                oitpText.append(headBonds)
-                oitpText += otemp
+        bondArrays = self.bondArrays
+        self.printDebug("bonds %i" % len(bondArrays))
+        notWater = resNames[bondArrays.atoms[:, 0]] != 'WAT'
+        a1, a2 = bondArrays.atoms[notWater].T
+        rEq = bondArrays.get('rEq')[notWater] * 0.1
+        kBond = bondArrays.get('kBond')[notWater] * 200 * cal
+        temp = formatRows("%6i %6i   1 %13.4e %13.4e ; %6s - %-6s\n",
+                          ids[a1], ids[a2], rEq, kBond, names[a1], names[a2])
+        otemp = formatRows("%6i %6i   1 ; %13.4e %13.4e ; %6s - %-6s %6s - %-6s\n",
+                           ids[a1], ids[a2], rEq, kBond, names[a1], names[a2],
+                           oplsNames[a1], oplsNames[a2])
+        addSection(headBonds, temp, otemp)
         self.printDebug("GMX bonds done")
 
-        self.printDebug("atomPairs %i" % len(self.atomPairs))
-        temp = []
-        for pair in self.atomPairs:
-            #if not printed:
-            #    tmpFile.write(headPairs)
-            #    printed = True
-            a1Name = pair[0].atomName
-            a2Name = pair[1].atomName
-            id1 = pair[0].id
-            id2 = pair[1].id
-            #id1 = self.atoms.index(pair[0]) + 1
-            #id2 = self.atoms.index(pair[1]) + 1
-            line = "%6i %6i %6i ; %6s - %-6s\n" % (id1, id2, 1, a1Name,
-                                                        a2Name)
-            temp.append(line)
-        temp.sort()
-        if temp:
-            if amb2gmx:
-                topText.append(headPairs)
-                topText += temp
-            else:
-                itpText.append(headPairs)
-                itpText += temp
-                oitpText.append(headPairs)
-                oitpText += temp
+        pairs = self.dihedralArrays.pairs
+        self.printDebug("atomPairs %i" % len(pairs))
+        a1, a2 = pairs.T
+        temp = formatRows("%6i %6i      1 ; %6s - %-6s\n", ids[a1], ids[a2], names[a1], names[a2])
+        addSection(headPairs, temp, list(temp))
         self.printDebug("GMX pairs done")
 
-        self.printDebug("angles %i" % len(self.angles))
-        temp = []
-        otemp = []
-        for angle in self.angles:
-            a1 = angle.atoms[0].atomName
-            a2 = angle.atoms[1].atomName
-            a3 = angle.atoms[2].atomName
-            id1 = angle.atoms[0].id
-            id2 = angle.atoms[1].id
-            id3 = angle.atoms[2].id
-            oat1 = id2oplsATDict.get(id1)
-            oat2 = id2oplsATDict.get(id2)
-            oat3 = id2oplsATDict.get(id3)
-            line = "%6i %6i %6i %6i %13.4e %13.4e ; %6s - %-6s - %-6s\n" % (id1, id2,
-            id3, 1, angle.thetaEq * radPi, 2 * cal * angle.kTheta, a1, a2, a3)
-            oline = "%6i %6i %6i %6i ; %13.4e %13.4e ; %6s - %-4s - %-6s %4s - %+4s - %-4s\n" % \
-                (id1, id2, id3, 1, angle.thetaEq * radPi, 2 * cal * angle.kTheta,
-                 a1, a2, a3, oat1, oat2, oat3)
-            temp.append(line)
-            otemp.append(oline)
-        temp.sort()
-        otemp.sort()
-        if temp:
-            if amb2gmx:
-                topText.append(headAngles)
-                topText += temp
-            else:
-                itpText.append(headAngles)
-                itpText += temp
-                oitpText.append(headAngles)
-                oitpText += otemp
+        angleArrays = self.angleArrays
+        self.printDebug("angles %i" % len(angleArrays))
+        a1, a2, a3 = angleArrays.atoms.T
+        thetaEq = angleArrays.get('thetaEq') * radPi
+        kTheta = 2 * cal * angleArrays.get('kTheta')
+        temp = formatRows("%6i %6i %6i      1 %13.4e %13.4e ; %6s - %-6s - %-6s\n",
+                          ids[a1], ids[a2], ids[a3], thetaEq, kTheta,
+                          names[a1], names[a2], names[a3])
+        otemp = formatRows("%6i %6i %6i      1 ; %13.4e %13.4e ; %6s - %-4s - %-6s %4s - %+4s - %-4s\n",
+                           ids[a1], ids[a2], ids[a3], thetaEq, kTheta,
+                           names[a1], names[a2], names[a3],
+                           oplsNames[a1], oplsNames[a2], oplsNames[a3])
+        addSection(headAngles, temp, otemp)
         self.printDebug("GMX angles done")
 
+        def dihedralRows(fmt, quartets, columns, opls = False):
+            quartet = quartets.T
+            columns = [ids[a] for a in quartet] + list(columns) + [names[a] for a in quartet]
+            if opls:
+                columns += [oplsNames[a] for a in quartet]
+            return formatRows(fmt, *columns)
+
         self.setProperDihedralsCoef()
-        self.printDebug("properDihedralsCoefRB %i" % len(self.properDihedralsCoefRB))
-        self.printDebug("properDihedralsAlphaGamma %i" % len(self.properDihedralsAlphaGamma))
-        self.printDebug("properDihedralsGmx45 %i" % len(self.properDihedralsGmx45))
-        temp = []
-        otemp = []
+        self.printDebug("properDihedralsCoefRB %i" % len(self.properDihedralsCoefRB[0]))
+        self.printDebug("properDihedralsAlphaGamma %i" % len(self.properDihedralsAlphaGamma[0]))
+        self.printDebug("properDihedralsGmx45 %i" % len(self.properDihedralsGmx45[0]))
         if not self.gmx45:
-            for dih in self.properDihedralsCoefRB:
-                a1 = dih[0][0].atomName
-                a2 = dih[0][1].atomName
-                a3 = dih[0][2].atomName
-                a4 = dih[0][3].atomName
-                id1 = dih[0][0].id
-                id2 = dih[0][1].id
-                id3 = dih[0][2].id
-                id4 = dih[0][3].id
-                oat1 = id2oplsATDict.get(id1)
-                oat2 = id2oplsATDict.get(id2)
-                oat3 = id2oplsATDict.get(id3)
-                oat4 = id2oplsATDict.get(id4)
-                c0, c1, c2, c3, c4, c5 = dih[1]
-                line = \
-                "%6i %6i %6i %6i %6i %10.5f %10.5f %10.5f %10.5f %10.5f %10.5f" % \
-                (id1, id2, id3, id4, 3, c0, c1, c2, c3, c4, c5) \
-                + " ; %6s-%6s-%6s-%6s\n" % (a1, a2, a3, a4)
-                oline = \
-                "%6i %6i %6i %6i %6i ; %10.5f %10.5f %10.5f %10.5f %10.5f %10.5f" % \
-                (id1, id2, id3, id4, 3, c0, c1, c2, c3, c4, c5) \
-                + " ; %6s-%6s-%6s-%6s    %4s-%4s-%4s-%4s\n" % (a1, a2, a3, a4, oat1, oat2, oat3, oat4)
-                temp.append(line)
-                otemp.append(oline)
-            temp.sort()
-            otemp.sort()
-            if temp:
-                if amb2gmx:
-                    topText.append(headProDih)
-                    topText += temp
-                else:
-                    itpText.append(headProDih)
-                    itpText += temp
-                    oitpText.append(headProDih)
-                    oitpText += otemp
+            quartets, coefs = self.properDihedralsCoefRB
+            temp = dihedralRows("%6i %6i %6i %6i      3 %10.5f %10.5f %10.5f %10.5f %10.5f %10.5f"
+                                " ; %6s-%6s-%6s-%6s\n", quartets, coefs.T)
+            otemp = dihedralRows("%6i %6i %6i %6i      3 ; %10.5f %10.5f %10.5f %10.5f %10.5f %10.5f"
+                                 " ; %6s-%6s-%6s-%6s    %4s-%4s-%4s-%4s\n", quartets, coefs.T,
+                                 opls = True)
+            addSection(headProDih, temp, otemp)
             self.printDebug("GMX proper dihedrals done")
         else:
             self.printMess("Writing GMX dihedrals for GMX 4.5.\n")
             funct = 9 #9
-            for dih in self.properDihedralsGmx45:
-                a1 = dih[0][0].atomName
-                a2 = dih[0][1].atomName
-                a3 = dih[0][2].atomName
-                a4 = dih[0][3].atomName
-                id1 = dih[0][0].id
-                id2 = dih[0][1].id
-                id3 = dih[0][2].id
-                id4 = dih[0][3].id
-                ph = dih[1] # phase already in degree
-                kd = dih[2] * cal #kPhi PK
-                pn = dih[3] #.period
-                line = "%6i %6i %6i %6i %6i %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n" % \
-                                (id1, id2, id3, id4, funct, ph, kd, pn, a1, a2, a3, a4)
-                oline = "%6i %6i %6i %6i %6i ; %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n" % \
-                                (id1, id2, id3, id4, funct, ph, kd, pn, a1, a2, a3, a4)
-                temp.append(line)
-                otemp.append(oline)
-            temp.sort()
-            otemp.sort()
-            if temp:
-                if amb2gmx:
-                    topText.append(headProDihGmx45)
-                    topText += temp
-                else:
-                    itpText.append(headProDihGmx45)
-                    itpText += temp
-                    oitpText.append(headProDihGmx45)
-                    oitpText += otemp
+            quartets, ph, kPhi, pn = self.properDihedralsGmx45
+            kd = kPhi * cal
+            temp = dihedralRows("%6i %6i %6i %6i %6i %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n",
+                                quartets, ([funct] * len(pn), ph, kd, pn))
+            otemp = dihedralRows("%6i %6i %6i %6i %6i ; %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n",
+                                 quartets, ([funct] * len(pn), ph, kd, pn))
+            addSection(headProDihGmx45, temp, otemp)
 
         # for properDihedralsAlphaGamma
         if self.gmx45: funct = 4 #4
         else: funct = 1
-        temp = []
-        otemp = []
-        for dih in self.properDihedralsAlphaGamma:
-            a1 = dih[0][0].atomName
-            a2 = dih[0][1].atomName
-            a3 = dih[0][2].atomName
-            a4 = dih[0][3].atomName
-            id1 = dih[0][0].id
-            id2 = dih[0][1].id
-            id3 = dih[0][2].id
-            id4 = dih[0][3].id
-            ph = dih[1] # phase already in degree
-            kd = dih[2] * cal #kPhi PK
-            pn = dih[3] #.period
-            line = "%6i %6i %6i %6i %6i %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n" % \
-                            (id1, id2, id3, id4, funct, ph, kd, pn, a1, a2, a3, a4)
-            oline = "%6i %6i %6i %6i %6i ; %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n" % \
-                            (id1, id2, id3, id4, funct, ph, kd, pn, a1, a2, a3, a4)
-            temp.append(line)
-            otemp.append(oline)
-        temp.sort()
-        otemp.sort()
-        if temp:
-            if amb2gmx:
-                topText.append(headProDihAlphaGamma)
-                topText += temp
-            else:
-                itpText.append(headProDihAlphaGamma)
-                itpText += temp
-                oitpText.append(headProDihAlphaGamma)
-                oitpText += otemp
+        quartets, ph, kPhi, pn = self.properDihedralsAlphaGamma
+        kd = kPhi * cal
+        temp = dihedralRows("%6i %6i %6i %6i %6i %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n",
+                            quartets, ([funct] * len(pn), ph, kd, pn))
+        otemp = dihedralRows("%6i %6i %6i %6i %6i ; %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n",
+                             quartets, ([funct] * len(pn), ph, kd, pn))
+        addSection(headProDihAlphaGamma, temp, otemp)
         self.printDebug("GMX special proper dihedrals done")
 
-        self.printDebug("improperDihedrals %i" % len(self.improperDihedrals))
-        temp = []
-        otemp = []
-        for dih in self.improperDihedrals:
-            a1 = dih.atoms[0].atomName
-            a2 = dih.atoms[1].atomName
-            a3 = dih.atoms[2].atomName
-            a4 = dih.atoms[3].atomName
-            id1 = dih.atoms[0].id
-            id2 = dih.atoms[1].id
-            id3 = dih.atoms[2].id
-            id4 = dih.atoms[3].id
-            kd = dih.kPhi * cal
-            pn = dih.period
-            ph = dih.phase * radPi
-            line = "%6i %6i %6i %6i %6i %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n" % \
-                            (id1, id2, id3, id4, funct, ph, kd, pn, a1, a2, a3, a4)
-            oline = "%6i %6i %6i %6i %6i ; %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n" % \
-                            (id1, id2, id3, id4, funct, ph, kd, pn, a1, a2, a3, a4)
-            temp.append(line)
-            otemp.append(oline)
-        temp.sort()
-        otemp.sort()
-        if temp:
-            if amb2gmx:
-                topText.append(headImpDih)
-                topText += temp
-            else:
-                itpText.append(headImpDih)
-                itpText += temp
-                oitpText.append(headImpDih)
-                oitpText += otemp
+        dihedrals = self.dihedralArrays
+        improper = dihedrals.improper
+        self.printDebug("improperDihedrals %i" % improper.sum())
+        quartets = dihedrals.atoms[improper]
+        kd = dihedrals.get('kPhi')[improper] * cal
+        pn = dihedrals.get('period')[improper]
+        ph = dihedrals.get('phase')[improper] * radPi
+        temp = dihedralRows("%6i %6i %6i %6i %6i %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n",
+                            quartets, ([funct] * len(pn), ph, kd, pn))
+        otemp = dihedralRows("%6i %6i %6i %6i %6i ; %8.2f %9.5f %3i ; %6s-%6s-%6s-%6s\n",
+                             quartets, ([funct] * len(pn), ph, kd, pn))
+        addSection(headImpDih, temp, otemp)
         self.printDebug("GMX improper dihedrals done")
 
         if not self.direct:
@@ -2954,9 +3180,11 @@ class ACTopol(AbstractTopol):
             multiplicity = '1', atomType = 'gaff', force = False, basename = None,
             debug = False, outTopol = 'all', engine = 'tleap', allhdg = False,
             timeTol = 36000, qprog = 'sqm', ekFlag = None, verbose = True,
-            gmx45 = False, disam = False, direct = False, sorted = False):
+            gmx45 = False, disam = False, direct = False, sorted = False,
+            cache = True):
 
         self.debug = debug
+        self.cache = cache
         self.verbose = verbose
         self.gmx45 = gmx45
         self.disam = disam
@@ -3065,12 +3293,13 @@ class MolTopol(ACTopol):
 
         Parser, take information in AC xyz and top files and convert to objects
 
-        INPUTS: acFileXyz and acFileTop
+        INPUTS: acFileXyz and acFileTop, or acFileTps (topology store saved
+                by ACTopol.topStoreSave, see loadTopStore)
         RETURN: molTopol obj or None
     """
     def __init__(self, acTopolObj = None, acFileXyz = None, acFileTop = None,
                  debug = False, basename = None, verbose = True, gmx45 = False,
-                 disam = False, direct = False, sorted = False):
+                 disam = False, direct = False, sorted = False, acFileTps = None):
 
         self.allhdg = False
         self.debug = debug
@@ -3080,6 +3309,12 @@ class MolTopol(ACTopol):
         self.sorted = sorted
         self.verbose = verbose
         self.inputFile = acFileTop
+        if acFileTps:
+            self.inputFile = acFileTps
+            self.loadTopStore(acFileTps)
+            self.baseName = basename or self.baseName
+            self.printDebug("topology store loaded, basename = '%s'" % self.baseName)
+            return
         if acTopolObj:
             if not acFileXyz: acFileXyz = acTopolObj.acXyzFileName
             if not acFileTop: acFileTop = acTopolObj.acTopFileName
@@ -3196,6 +3431,109 @@ class Dihedral(object):
         self.period = period
         self.phase = phase # rad, to convert to degree: kPhi * 180/Pi
 
+def collectBatchInputs(batch):
+    """
+        Input files for batch mode: every mol2, mdl or pdb file of directory
+        batch, or the files listed (one per line, '#' for comments) in file
+        batch, relative to its folder.
+    """
+    if os.path.isdir(batch):
+        return sorted(os.path.join(batch, f) for f in os.listdir(batch)
+                      if os.path.splitext(f)[1] in ('.mol2', '.mdl', '.pdb'))
+    listDir = os.path.dirname(os.path.abspath(batch))
+    inputs = []
+    for line in open(batch):
+        line = line.split('#')[0].strip()
+        if line:
+            inputs.append(os.path.join(listDir, line))
+    return inputs
+
+def runBatchJob(job):
+    """
+        Run one batch job (input file, job folder, ACTopol keywords) in its
+        own folder, with its output going to acpype.log there. Never raises:
+        returns a dict with input, dir, status, time, charge and error.
+    """
+    inputFile, jobDir, kwargs = job
+    t0 = time.time()
+    result = {'input' : inputFile, 'dir' : jobDir, 'status' : 'FAILED',
+              'charge' : '', 'error' : ''}
+    if not os.path.exists(jobDir):
+        os.makedirs(jobDir)
+    localDir = os.path.abspath('.')
+    os.chdir(jobDir)
+    stdout = sys.stdout
+    log = open('acpype.log', 'w')
+    sys.stdout = log
+    molecule = None
+    try:
+        molecule = ACTopol(inputFile, **kwargs)
+        if not molecule.acExe:
+            raise Exception("no 'antechamber' executable")
+        molecule.createACTopol()
+        molecule.createMolTopol()
+        result['status'] = 'OK'
+    except SystemExit:
+        result['error'] = 'aborted, see acpype.log'
+    except Exception:
+        result['error'] = str(sys.exc_info()[1])
+        traceback.print_exc(file = log)
+    finally:
+        if molecule is not None:
+            result['charge'] = molecule.chargeVal
+            try: rmtree(molecule.tmpDir)
+            except: pass
+        sys.stdout = stdout
+        log.close()
+        os.chdir(localDir)
+    result['time'] = time.time() - t0
+    return result
+
+def runBatch(inputs, jobs = None, batchDir = 'acpype_batch', report = 'report.txt', **kwargs):
+    """
+        Run ACTopol for every input file on a pool of jobs processes (default
+        is the number of CPUs), each in its folder batchDir/NNNN_basename.
+        Antechamber, parmchk and leap are timed out per job (timeTol), one
+        process per job so a crash or a sys.exit can't take the others down.
+        The summary is written in batchDir/report and the results returned.
+    """
+    batchDir = os.path.abspath(batchDir)
+    jobList = []
+    for i, inputFile in enumerate(inputs):
+        base = os.path.splitext(os.path.basename(inputFile))[0]
+        jobDir = os.path.join(batchDir, '%04i_%s' % (i + 1, base))
+        jobList.append((os.path.abspath(inputFile), jobDir, kwargs))
+    if not os.path.exists(batchDir):
+        os.makedirs(batchDir)
+    print("==> Running %i batch jobs in '%s'" % (len(jobList), batchDir))
+    results = []
+    pool = multiprocessing.Pool(jobs, maxtasksperchild = 1)
+    try:
+        for result in pool.imap(runBatchJob, jobList, chunksize = 1):
+            print("==> %-6s %s (%s)" % (result['status'], result['input'],
+                                        elapsedTime(int(round(result['time']))) or '0s'))
+            results.append(result)
+    finally:
+        pool.close()
+        pool.join()
+    writeBatchReport(results, os.path.join(batchDir, report))
+    return results
+
+def writeBatchReport(results, fileName):
+    """
+        Write the summary of a batch run: one line per job with status,
+        time (s), net charge, input file, job folder and error if any
+    """
+    failed = len([r for r in results if r['status'] != 'OK'])
+    lines = ['# acpype batch report, %s\n' % datetime.now().ctime(),
+             '# %i jobs, %i OK, %i FAILED\n' % (len(results), len(results) - failed, failed),
+             '# %-6s %10s %6s  %s\n' % ('status', 'time(s)', 'charge', 'input, folder, error')]
+    for r in results:
+        lines.append('%-8s %10.1f %6s  %s  %s  %s\n' % (r['status'], r['time'], r['charge'],
+                                                         r['input'], r['dir'], r['error']))
+    open(fileName, 'w').writelines(lines)
+    print("==> Batch report written in '%s': %i OK, %i FAILED" % (fileName, len(results) - failed, failed))
+
 if __name__ == '__main__':
     t0 = time.time()
     print(header)
@@ -3217,6 +3555,10 @@ if __name__ == '__main__':
                       action = "store",
                       dest = 'prmtop',
                       help = "amber prmtop file name (always used with -x)",)
+    parser.add_option('-T', '--tps',
+                      action = "store",
+                      dest = 'tps',
+                      help = "topology store (.tps) saved by acpype, to write its GMX files again without prmtop and inpcrd",)
     parser.add_option('-c', '--charge_method',
                       type = 'choice',
                       choices = ['gas', 'bcc', 'user'],
@@ -3312,11 +3654,37 @@ if __name__ == '__main__':
                       dest = 'sorted',
                       help = "sort atoms for GMX ordering",)
 
+    parser.add_option('-N', '--no_cache',
+                      action = "store_false",
+                      default = True,
+                      dest = 'cache',
+                      help = "don't reuse or store antechamber charges in the cache ($ACPYPE_CACHE or ~/.acpype/cache)",)
+    parser.add_option('-B', '--batch',
+                      action = "store",
+                      dest = 'batch',
+                      help = "batch mode: folder with mol2/mdl/pdb input files or file listing them, one per line",)
+    parser.add_option('-j', '--jobs',
+                      action = "store",
+                      type = 'int',
+                      dest = 'jobs',
+                      help = "number of parallel jobs in batch mode, default is the number of CPUs",)
+    parser.add_option('-D', '--batch_dir',
+                      action = "store",
+                      default = 'acpype_batch',
+                      dest = 'batch_dir',
+                      help = "folder for batch mode jobs and report, default is 'acpype_batch'",)
+
     options, remainder = parser.parse_args()
 
     amb2gmx = False
 
-    if not options.input:
+    if options.batch:
+        if options.input or options.inpcrd or options.prmtop or options.basename or options.tps:
+            parser.error("option -B can't be used with '-i', '-p', '-x', '-T' or '-b'")
+    elif options.tps:
+        if options.input or options.inpcrd or options.prmtop:
+            parser.error("option -T can't be used with '-i', '-p' or '-x'")
+    elif not options.input:
         amb2gmx = True
         if not options.inpcrd or not options.prmtop:
             parser.error("missing input files")
@@ -3331,7 +3699,13 @@ if __name__ == '__main__':
         parser.error("option -u is only meaningful in 'amb2gmx' mode")
 
     try:
-        if amb2gmx:
+        if options.tps:
+            print("Writing Gromacs files from topology store ...")
+            system = MolTopol(acFileTps = options.tps, debug = options.debug,
+                              basename = options.basename, verbose = options.verboseless,
+                              gmx45 = options.gmx45, disam = options.disambiguate)
+            system.writeGromacsTopolFiles()
+        elif amb2gmx:
             print("Converting Amber input files to Gromacs ...")
             system = MolTopol(acFileXyz = options.inpcrd, acFileTop = options.prmtop,
                               debug = options.debug, basename = options.basename,
@@ -3341,16 +3715,26 @@ if __name__ == '__main__':
             system.printDebug("prmtop and inpcrd files parsed")
             system.writeGromacsTopolFiles(amb2gmx = True)
         else:
-            molecule = ACTopol(options.input, chargeType = options.charge_method,
-                               chargeVal = options.net_charge, debug = options.debug,
-                               multiplicity = options.multiplicity, atomType = options.atom_type,
-                               force = options.force, outTopol = options.outtop,
-                               engine = options.engine, allhdg = options.cnstop,
-                               basename = options.basename, timeTol = options.max_time,
-                               qprog = options.qprog, ekFlag = '''"%s"''' % options.keyword,
-                               verbose = options.verboseless, gmx45 = options.gmx45,
-                               disam = options.disambiguate, direct = options.direct,
-                               sorted = options.sorted)
+            acKwargs = dict(chargeType = options.charge_method,
+                            chargeVal = options.net_charge, debug = options.debug,
+                            multiplicity = options.multiplicity, atomType = options.atom_type,
+                            force = options.force, outTopol = options.outtop,
+                            engine = options.engine, allhdg = options.cnstop,
+                            timeTol = options.max_time,
+                            qprog = options.qprog, ekFlag = '''"%s"''' % options.keyword,
+                            verbose = options.verboseless, gmx45 = options.gmx45,
+                            disam = options.disambiguate, direct = options.direct,
+                            sorted = options.sorted, cache = options.cache)
+        if options.batch:
+            inputs = collectBatchInputs(options.batch)
+            if not inputs:
+                raise Exception("no input files found in '%s'" % options.batch)
+            results = runBatch(inputs, jobs = options.jobs, batchDir = options.batch_dir, **acKwargs)
+            failed = len([r for r in results if r['status'] != 'OK'])
+            if failed:
+                raise Exception("%i of %i batch jobs failed" % (failed, len(results)))
+        elif not amb2gmx and not options.tps:
+            molecule = ACTopol(options.input, basename = options.basename, **acKwargs)
 
             if not molecule.acExe:
                 molecule.printError("no 'antechamber' executable... aborting ! ")
@@ -30,7 +30,7 @@ if len(group) <= 1:
 #print("\033[0;33mNote: The index of atoms should be numbered from 0.\033[0m")
 indices = [int(i) for i in indices_str.split()]
 
-ndx_exa = ndx.NDX(ndx_file)
+ndx_exa = ndx.listNDX(ndx_file)
 if not res in ndx_exa:
     print('res_name', res, 'is not a group of', ndx_file)
     print(__doc__)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+'''
+Benchmark of itpparser.ItpParser against gromacs.fileformats.itp.ITP on a
+synthetic chain molecule: n atoms with n - 1 bonds, n - 3 pairs, n - 2
+angles and n - 3 dihedrals, every line with an inline comment. The
+default of 12500 atoms gives about 50000 terms.
+
+usage: bench_itpparser.py [-n 12500] [-r 3]
+'''
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import itpparser
+from gromacs.fileformats.itp import ITP
+
+
+def chain_itp(n_atoms):
+    '''text of the itp of a chain of n_atoms carbons'''
+    lines = ['; synthetic chain', '[ moleculetype ]', '; name nrexcl', 'CHN 3', '',
+             '[ atoms ]', ';  nr  type  resnr  resid  atom  cgnr  charge    mass']
+    lines += ['%6d %6s %6d %6s %6s %6d %10.4f %10.4f ; atom %d' % (i, 'CH2', 1 + i // 20, 'CHN', 'C%d' % (i % 1000), i,
+                                                                  0.0, 14.027, i) for i in range(1, n_atoms + 1)]
+    lines += ['', '[ bonds ]', ';  ai   aj  funct   c0         c1']
+    lines += ['%5d %5d %5d %10.4f %12.4e ; bond' % (i, i + 1, 2, 0.153, 7.15e6) for i in range(1, n_atoms)]
+    lines += ['', '[ pairs ]', ';  ai   aj  funct']
+    lines += ['%5d %5d %5d ; pair' % (i, i + 3, 1) for i in range(1, n_atoms - 2)]
+    lines += ['', '[ angles ]', ';  ai   aj   ak  funct   angle     fc']
+    lines += ['%5d %5d %5d %5d %10.2f %10.2f ; angle' % (i, i + 1, i + 2, 2, 109.5, 285.0) for i in range(1, n_atoms - 1)]
+    lines += ['', '[ dihedrals ]', ';  ai   aj   ak   al  funct    ph0      cp     mult']
+    lines += ['%5d %5d %5d %5d %5d %10.2f %10.2f %5d ; dihedral' % (i, i + 1, i + 2, i + 3, 1, 0.0, 5.92, 3)
+              for i in range(1, n_atoms - 2)]
+    return '\n'.join(lines) + '\n'
+
+
+def best_time(func, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark itpparser.ItpParser against gromacs.fileformats.itp.ITP.')
+    parser.add_argument('-n', dest='atoms', type=int, default=12500, help='number of atoms of the chain')
+    parser.add_argument('-r', dest='repeat', type=int, default=3, help='repetitions, best is taken')
+    args = parser.parse_args()
+
+    fd, filename = tempfile.mkstemp(suffix='.itp')
+    with os.fdopen(fd, 'w') as f:
+        f.write(chain_itp(args.atoms))
+    try:
+        with open(filename) as f:
+            parsed = itpparser.ItpParser(f)
+        nterms = sum(len(section) for section in parsed.sections if section.name in itpparser.TERMS)
+        print('%d atoms, %d terms' % (args.atoms, nterms))
+
+        def read():
+            with open(filename) as f:
+                itpparser.ItpParser(f)
+
+        print('%-28s %10s' % ('', 'time (s)'))
+        print('%-28s %10.4f' % ('ItpParser read', best_time(read, args.repeat)))
+        print('%-28s %10.4f' % ('ItpParser to_itp', best_time(parsed.to_itp, args.repeat)))
+        try:
+            print('%-28s %10.4f' % ('ITP read', best_time(lambda: ITP(filename), args.repeat)))
+        except Exception as err:
+            print('%-28s %10s (%s)' % ('ITP read', 'failed', err))
+    finally:
+        os.remove(filename)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+'''
+Benchmark of acpype atom sorting for gromacs (gromacsAtomOrder) on a
+synthetic polyethylene-like chain: every carbon carries two hydrogens, all
+the hydrogens are listed after the carbons as leap usually does.
+
+usage: bench_sort_atoms.py [-n 10000 100000 1000000] [-r 3]
+'''
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import acpype
+
+
+def polymer(n_atoms):
+    '''masses and bonds of a chain of n_atoms / 3 carbons with 2 hydrogens each'''
+    n_carbons = n_atoms // 3
+    n_atoms = n_carbons * 3
+    masses = np.full(n_atoms, 1.008)
+    masses[:n_carbons] = 12.01
+    carbons = np.arange(n_carbons)
+    backbone = np.column_stack((carbons[:-1], carbons[1:]))
+    hydrogens = np.arange(n_carbons, n_atoms)
+    c_h = np.column_stack((np.repeat(carbons, 2), hydrogens))
+    return masses, np.concatenate((c_h, backbone))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark acpype gromacsAtomOrder.')
+    parser.add_argument('-n', dest='sizes', type=int, nargs='+',
+                        default=[10000, 100000, 1000000], help='number of atoms')
+    parser.add_argument('-r', dest='repeat', type=int, default=3, help='repetitions, best is taken')
+    args = parser.parse_args()
+
+    print('%10s %10s %12s %14s' % ('atoms', 'bonds', 'time (s)', 'us per atom'))
+    for size in args.sizes:
+        masses, bonds = polymer(size)
+        best = None
+        for i in range(args.repeat):
+            start = time.time()
+            acpype.gromacsAtomOrder(masses, bonds)
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        print('%10d %10d %12.4f %14.3f' % (len(masses), len(bonds), best, best / len(masses) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
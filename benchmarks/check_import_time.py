@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+'''
+Startup budget of mdtool.py and of the helper scripts called from the
+generated command files. Every check runs a fresh interpreter with
+``python -X importtime``, sums the import time of the top-level imports
+minus the median of a bare interpreter, and fails when the median of
+the repetitions is over its budget or when a module which must stay lazy
+(numpy, matplotlib) was imported.
+
+The budgets are two to three times the medians measured when they were
+set (10-15 ms), so run to run noise doesn't fail the check, while
+importing numpy (60 ms and more) or a few heavy modules still does.
+
+usage: check_import_time.py [-r 7] [--scale 1.0]
+
+Exits with status 1 if a check fails, so it can guard a commit.
+'''
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+#: (name, interpreter arguments, budget in ms over a bare interpreter, modules which must not be imported)
+CHECKS = [
+    ('gromacs.fileformats.ndx', ['-c', 'import gromacs.fileformats.ndx'], 30, ('numpy', 'matplotlib')),
+    ('gromacs.utilities', ['-c', 'import gromacs.utilities'], 30, ('numpy', 'matplotlib', 'pylab')),
+    ('mdtool', ['-c', 'import mdtool'], 35, ('numpy', 'matplotlib')),
+    ('getnr.py', ['getnr.py', '{ndx}', 'SOL'], 35, ('numpy', 'matplotlib')),
+    ('add_group_to_ndx.py', ['add_group_to_ndx.py', 'first', 'SOL', '3', '0', '1', '{ndx}'], 35, ('numpy', 'matplotlib')),
+    ('opt_pme.py', ['opt_pme.py', '0.3', '0.25', '{mdp}'], 15, ('numpy', 'matplotlib')),
+]
+
+
+def import_times(arguments):
+    '''(total ms of the top-level imports, names of all imported modules) of a fresh interpreter run with arguments'''
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime'] + arguments, cwd=ROOT,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    out, err = proc.communicate()
+    if proc.returncode != 0:
+        raise RuntimeError(err)
+    total, modules = 0, set()
+    for line in err.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        modules.add(name.strip())
+        # top-level imports are not indented
+        if name[1:2] != ' ':
+            total += int(cumulative)
+    return total / 1000.0, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the import time budget of mdtool.py and the helper scripts.')
+    parser.add_argument('-r', dest='repeat', type=int, default=7, help='repetitions, the median is taken')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply the budgets, for slow machines')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    ndx = os.path.join(tmpdir, 'system.ndx')
+    mdp = os.path.join(tmpdir, 'md.mdp')
+    with open(ndx, 'w') as f:
+        f.write('[ System ]\n1 2 3\n[ SOL ]\n1 2 3\n')
+    with open(mdp, 'w') as f:
+        f.write('fourierspacing\t=\t0.12\n')
+
+    def median_of(arguments):
+        times, modules = [], set()
+        for i in range(args.repeat):
+            elapsed, modules = import_times(arguments)
+            times.append(elapsed)
+        times.sort()
+        middle = len(times) // 2
+        return (times[middle] if len(times) % 2 else (times[middle - 1] + times[middle]) / 2), modules
+
+    bare = median_of(['-c', 'pass'])[0]
+    failed = False
+    print('bare interpreter: %.1f ms of imports' % bare)
+    print('%-26s %10s %10s  %s' % ('check', 'time (ms)', 'budget', 'result'))
+    try:
+        for name, arguments, budget, forbidden in CHECKS:
+            median, modules = median_of([a.format(ndx=ndx, mdp=mdp) for a in arguments])
+            # the scripts may import less than the bare -c run
+            median = max(median - bare, 0.0)
+            budget *= args.scale
+            problems = []
+            if median > budget:
+                problems.append('over budget')
+            lazy = sorted(m for m in forbidden if m in modules)
+            if lazy:
+                problems.append('imports ' + ', '.join(lazy))
+            failed = failed or bool(problems)
+            print('%-26s %10.1f %10.1f  %s' % (name, median, budget, '; '.join(problems) or 'ok'))
+    finally:
+        for filename in (ndx, mdp):
+            os.remove(filename)
+        os.rmdir(tmpdir)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
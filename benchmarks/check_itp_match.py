@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+'''
+Check of itp_match.merge_fragments on two overlapping fragments of a
+chain of 6 atoms. Fragment 1 (atoms 1-4) has a proper dihedral written as
+three funct 9 lines; fragment 2 (atoms 2-6) has other parameters for the
+same terms plus its own multi-term dihedral. The merged topology must keep
+every line of the first fragment which has a term, and drop the lines of
+the later fragments on those atoms.
+
+usage: check_itp_match.py
+
+Exits with status 1 if a check fails.
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+import itp_match
+
+FRAGMENT1 = '''[ bonds ]
+    1     2     2   0.153   7.15e6
+    2     3     2   0.153   7.15e6
+    3     4     2   0.153   7.15e6
+[ dihedrals ]
+    1     2     3     4     9     0.0   5.0   1
+    1     2     3     4     9   180.0   2.0   2
+    1     2     3     4     9     0.0   1.0   3
+'''
+# atoms 1-5 are the molecule atoms 2-6
+FRAGMENT2 = '''[ bonds ]
+    1     2     2   0.999   9.99e6
+    2     3     2   0.999   9.99e6
+    3     4     2   0.153   7.15e6
+    4     5     2   0.153   7.15e6
+[ dihedrals ]
+    1     2     3     4     9     9.0   9.0   1
+    2     3     4     5     9     0.0   4.0   1
+    2     3     4     5     9     0.0   4.0   3
+'''
+
+
+def main():
+    tmpdir = tempfile.mkdtemp()
+    try:
+        tops = []
+        for name, text in (('frag1.itp', FRAGMENT1), ('frag2.itp', FRAGMENT2)):
+            tops.append(os.path.join(tmpdir, name))
+            with open(tops[-1], 'w') as f:
+                f.write(text)
+        types = numpy.array(['C'] * 7 + [itp_match.UNMATCHED], dtype=object)
+        merged = itp_match.merge_fragments([(tops[0], [(i, i) for i in range(1, 5)]),
+                                            (tops[1], [(i + 1, i) for i in range(1, 6)])], types)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    bonds = [line.split('\t\t;')[0].split() for line in merged[('bonds', 0)]]
+    dihedrals = [line.split('\t\t;')[0].split() for line in merged[('dihedrals', 0)]]
+    checks = [
+        ('5 bonds, each once', [b[:2] for b in bonds] == [['1', '2'], ['2', '3'], ['3', '4'], ['4', '5'], ['5', '6']]),
+        ('bonds 2-3 and 3-4 from fragment 1', all(b[3] == '0.153' for b in bonds)),
+        ('3 lines of dihedral 1-2-3-4 kept', [d[:4] for d in dihedrals[:3]] == [['1', '2', '3', '4']] * 3),
+        ('their multiplicities 1, 2, 3 in order', [d[-1] for d in dihedrals[:3]] == ['1', '2', '3']),
+        ('dihedral 2-3-4-5 from fragment 2', [d[:4] for d in dihedrals[3:4]] == [['2', '3', '4', '5']]),
+        ('2 lines of dihedral 3-4-5-6 kept', [d[:4] for d in dihedrals[4:]] == [['3', '4', '5', '6']] * 2),
+    ]
+    failed = False
+    for name, ok in checks:
+        print('%-40s %s' % (name, 'ok' if ok else 'FAILED'))
+        failed = failed or not ok
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
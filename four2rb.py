@@ -1,4 +1,10 @@
 #!/usr/bin/env python
+import argparse
+
+import numpy
+
+from gromacs.dihedrals import fourier_to_rb
+
 class Four2RB:
     '''Convert fourier dihedrals to Ryckaert-Bellemans parameters
     
@@ -35,15 +41,45 @@ class Four2RB:
         '''C5 = 0'''
         return 0
 
+def read_table(filename):
+    '''Read a table of fourier dihedrals, one per line: optional labels (e.g. the
+    atoms) followed by V1 V2 V3 V4. Lines starting with ; or # are comments.
+
+    Returns the list of labels and the array of V1..V4.
+    '''
+    labels = []
+    values = []
+    with open(filename) as table:
+        for line in table:
+            fields = line.split(';')[0].split('#')[0].split()
+            if not fields:
+                continue
+            labels.append(' '.join(fields[:-4]))
+            values.append([float(v) for v in fields[-4:]])
+    return labels, numpy.array(values).reshape(-1, 4)
+
 def main():
-    import sys
-    four2RB = Four2RB(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4])
-    print('C0:' + str(four2RB.getC0()))
-    print('C1:' + str(four2RB.getC1()))
-    print('C2:' + str(four2RB.getC2()))
-    print('C3:' + str(four2RB.getC3()))
-    print('C4:' + str(four2RB.getC4()))
-    print('C5:' + str(four2RB.getC5()))
+    parser = argparse.ArgumentParser(description='Convert fourier dihedrals to Ryckaert-Bellemans parameters.')
+    parser.add_argument('v', nargs='*', help='V1 V2 V3 V4 of one dihedral')
+    parser.add_argument('-f', '--file', help='table of dihedrals: [labels] V1 V2 V3 V4 per line')
+    args = parser.parse_args()
+
+    if args.file:
+        labels, values = read_table(args.file)
+        rb = fourier_to_rb(values)
+        print(';%-19s %10s %10s %10s %10s %10s %10s' % ('dihedral', 'C0', 'C1', 'C2', 'C3', 'C4', 'C5'))
+        for label, c in zip(labels, rb.tolist()):
+            print(('%-20s' % label) + ' %10.5f %10.5f %10.5f %10.5f %10.5f %10.5f' % tuple(c))
+    elif len(args.v) == 4:
+        four2RB = Four2RB(*args.v)
+        print('C0:' + str(four2RB.getC0()))
+        print('C1:' + str(four2RB.getC1()))
+        print('C2:' + str(four2RB.getC2()))
+        print('C3:' + str(four2RB.getC3()))
+        print('C4:' + str(four2RB.getC4()))
+        print('C5:' + str(four2RB.getC5()))
+    else:
+        parser.error('give V1 V2 V3 V4 or a table with -f')
 
 if __name__ == '__main__':
     main()
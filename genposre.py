@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+'''
+Write the position restraint files posre_<residue>.itp of residues without make_ndx, getnr.py and genrestr, e.g.
+
+    genposre.py -r DRG drg.pdb -r SURF surf.pdb -s heavy -fc 1000 1000 1000
+
+The atoms are numbered by their position in the pdb, so the pdb must have the atoms of the molecule in the order of
+its itp.
+'''
+import argparse
+import sys
+
+from gromacs import posre
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write position restraint files of residues.')
+    parser.add_argument('-r', dest='residues', action='append', nargs=2, metavar=('RESIDUE', 'PDB'), required=True,
+                        help='residue name and its pdb file, may be repeated')
+    parser.add_argument('-s', dest='selection', choices=posre.SELECTIONS, default='all', help='restrained atoms')
+    parser.add_argument('-fc', dest='fc', type=float, nargs=3, default=[1000, 1000, 1000], metavar=('X', 'Y', 'Z'),
+                        help='force constants along x, y and z (kJ mol^-1 nm^-2)')
+    parser.add_argument('-o', dest='output', default='posre_{0}.itp',
+                        help='output file name, {0} is replaced by the lower case residue name')
+    args = parser.parse_args()
+
+    try:
+        written = posre.generate(args.residues, args.selection, args.fc, args.output)
+    except (IOError, ValueError) as e:
+        sys.exit('genposre.py: {0}'.format(e))
+    for filename, natoms in written:
+        print('{0}: {1} atoms restrained'.format(filename, natoms))
+
+
+if __name__ == '__main__':
+    main()
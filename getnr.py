@@ -12,12 +12,11 @@ from gromacs.fileformats import ndx
 ndx_file = sys.argv[1]
 resi = sys.argv[2:]
 
-index = ndx.NDX()
-index.read(ndx_file)
+groups = ndx.read_groups(ndx_file)
 idces = []
 for i in resi:
     try:
-        idces.append(str(index.groups.index(i)))
+        idces.append(str(groups.index(i)))
     except ValueError:
         idces.append(str(-1))
 print(' '.join(idces), end='')
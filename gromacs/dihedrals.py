@@ -0,0 +1,113 @@
+# Dihedral parameters conversion
+# email: email@klniu.com
+
+"""
+Dihedral parameters conversion
+==============================
+
+Vectorised conversion of periodic dihedral parameters to the
+Ryckaert-Bellemans (RB) coefficients C0..C5 of Gromacs (dihedral
+function type 3), see the Gromacs manual 4.5.4 p76.
+
+Both functions work on whole tables at once: one row per dihedral term
+in, one row of C0..C5 per dihedral (or per group of terms) out, in the
+energy unit of the input.
+
+**Example**
+
+  OPLS Fourier terms F1..F4 of two dihedrals::
+
+    rb = fourier_to_rb([[0.0, 0.0, 1.2, 0.0], [2.9, -1.4, 1.1, 0.0]])
+
+  AMBER terms, the 3 terms of the first quartet summed in one RB row::
+
+    rb = amber_to_rb(kphi, period, phase, groups=[0, 0, 0, 1])
+
+.. autofunction:: fourier_to_rb
+.. autofunction:: amber_to_rb
+.. autodata:: PERIODIC_RB
+"""
+
+import numpy
+
+#: RB coefficients of a term V/2 (1 + cos(n phi - phase)) for V = 1, by
+#: period n (0 to 4, 0 meaning no term) and phase (0 or 180 degrees).
+PERIODIC_RB = numpy.zeros((5, 2, 6))
+PERIODIC_RB[1, 0] = [0.5, -0.5, 0, 0, 0, 0]
+PERIODIC_RB[1, 1] = [0.5, 0.5, 0, 0, 0, 0]
+PERIODIC_RB[2, 0] = [0, 0, 1, 0, 0, 0]
+PERIODIC_RB[2, 1] = [1, 0, -1, 0, 0, 0]
+PERIODIC_RB[3, 0] = [0.5, 1.5, 0, -2, 0, 0]
+PERIODIC_RB[3, 1] = [0.5, -1.5, 0, 2, 0, 0]
+PERIODIC_RB[4, 0] = [1, 0, -4, 0, 4, 0]
+PERIODIC_RB[4, 1] = [0, 0, 4, 0, -4, 0]
+
+# Fourier terms: F1 and F3 with phase 0, F2 and F4 with phase 180
+_FOURIER_RB = PERIODIC_RB[[1, 2, 3, 4], [0, 1, 0, 1]]
+
+
+def fourier_to_rb(v):
+    """Convert Fourier dihedral coefficients to RB coefficients.
+
+    :Arguments:
+       *v*
+          array of shape (n, 4), or (4,) for a single dihedral, with
+          the Fourier coefficients F1..F4
+
+    :Returns: array of shape (n, 6), or (6,), with C0..C5
+
+    C0 = F2 + (F1 + F3) / 2, C1 = (-F1 + 3 F3) / 2, C2 = -F2 + 4 F4,
+    C3 = -2 F3, C4 = -4 F4, C5 = 0
+    """
+    v = numpy.asarray(v, dtype=float)
+    if v.shape[-1] != 4:
+        raise ValueError("Fourier dihedrals need 4 coefficients, got {0}".format(v.shape[-1]))
+    return numpy.dot(v, _FOURIER_RB)
+
+
+def amber_to_rb(kphi, period, phase, groups=None, ngroups=None, scale=1.0):
+    """Convert AMBER periodic dihedral terms to RB coefficients.
+
+    Each term is kphi (1 + cos(period phi - phase)), i.e. V = 2 kphi, and
+    all the terms of a group (the same quartet of atoms) are summed in one
+    row of RB coefficients. Terms with kphi <= 0 or period 0 add nothing.
+
+    :Arguments:
+       *kphi*
+          array of force constants (PK, already divided by IDIVF)
+       *period*
+          array of integer periodicities, 0 to 4
+       *phase*
+          array of phases in degree, 0 or 180 (truncated to integer)
+       *groups*
+          array with the group (row of the result) of each term; by
+          default each term is its own group
+       *ngroups*
+          number of rows of the result [``max(groups) + 1``]
+       *scale*
+          factor applied to V, e.g. 4.184 for kcal/mol to kJ/mol
+
+    :Returns: array of shape (ngroups, 6) with C0..C5
+
+    :Raises: :exc:`ValueError` for a period above 4 or a phase other than
+             0 or 180, which RB can't represent.
+    """
+    kphi = numpy.asarray(kphi, dtype=float)
+    period = numpy.asarray(period, dtype=int)
+    phase = numpy.asarray(phase).astype(int)
+    if numpy.any((period < 0) | (period > 4)):
+        raise ValueError("RB dihedrals can't represent periods above 4: {0}".format(
+            numpy.unique(period[(period < 0) | (period > 4)]).tolist()))
+    if numpy.any((phase != 0) & (phase != 180)):
+        raise ValueError("RB dihedrals need phases of 0 or 180 degree: {0}".format(
+            numpy.unique(phase[(phase != 0) & (phase != 180)]).tolist()))
+    v = numpy.where(kphi > 0, 2 * kphi * scale, 0.0)
+    terms = PERIODIC_RB[period, phase // 180] * v[:, numpy.newaxis]
+    if groups is None:
+        return terms
+    groups = numpy.asarray(groups, dtype=int)
+    if ngroups is None:
+        ngroups = groups.max() + 1 if len(groups) else 0
+    rb = numpy.zeros((ngroups, 6))
+    numpy.add.at(rb, groups, terms)
+    return rb
@@ -22,7 +22,11 @@ import re
 import numpy
 import gromacs.utilities as utilities
 from .preprocessor import Preprocessor
-from collections import OrderedDict, Iterable
+from collections import OrderedDict
+try:
+    from collections.abc import Iterable
+except ImportError:
+    from collections import Iterable
 import logging
 
 
@@ -105,7 +109,7 @@ class ITPSection(object):
             if len(line) == 0:
                 continue               # skip empty lines for now
 
-            m = self.SECTION.match(line)
+            m = self.SECTION.match(line) if line[0] == '[' else None
             if m:
                 if current_section == m.group('name'):
                     self.logger.info("Merging [ %(current_section)s ] sections!", vars())
@@ -165,9 +169,12 @@ class ITPSection(object):
 class ITPdata(ITPSection):
     """Class to represent most ITP sections.
 
-    1) parse line by line and store data and comments
-    2) format data as recarray; uses up columns from left to right
-    3) manipulate data in the recarray or write section with :meth:`section`
+    1) parse line by line and store the tokens and comments of each line
+    2) convert the tokens to typed numpy columns, one column at a time, and
+       build the recarray from them; comments are kept in a separate table
+       (:attr:`row_comments`) and as the last ``comment`` column
+    3) manipulate data in the recarray or write section with :meth:`section`,
+       which formats all lines with the same number of columns at once
 
     .. versionadded:: 0.2.5
     """
@@ -175,36 +182,54 @@ class ITPdata(ITPSection):
     fmt = []     # override, define output fmt "%6d" (used in section())
     column_comment = ""  # line to be output after section header
 
+    #: value of a column missing in a line, by dtype kind
+    MISSING = {'f': numpy.nan, 'O': None, 'i': 0, 'U': ''}
+
     def __init__(self, *args, **kwargs):
         super(ITPdata, self).__init__(*args, **kwargs)
-        self.__records = []   # [((atomnr, atomtype, ...), comment), ...]
+        self.__tokens = []    # tokens of all the lines, one after the other
+        self.__ncols = []     # number of tokens (columns) of each line
+        self.row_comments = []  # trailing comment of each line
         self.__data = None    # recarray
 
+    def _column_dtypes(self, nmax):
+        """dtypes of the first *nmax* columns; extra columns are objects"""
+        extra = [("col%d" % i, object) for i in range(len(self.dtypes), nmax)]
+        return self.dtypes[:nmax] + extra
+
+    @staticmethod
+    def _convert(tokens, dtype):
+        """Array of *dtype* from an array of string tokens"""
+        if dtype.kind in 'fi':
+            convert = float if dtype.kind == 'f' else int
+            return numpy.fromiter(map(convert, tokens), dtype=dtype, count=len(tokens))
+        return tokens.astype(dtype)
+
     def _create_recarray(self):
-        """Build a recarray from parsed data."""
-        # build empty record array and fill line by line to accomodate
-        # lines with variable number of entries
-        numcols = [len(record) for record, comment in self.__records]
-        nmax = numpy.max(numcols) if len(numcols) > 0 else 0
-        dtype = self.dtypes[:nmax] + [("comment", "U128")]
-        a = numpy.recarray((len(self.__records),), dtype=dtype)
-        for i, (record, comment) in enumerate(self._canonical_records(nmax=nmax)):
-            a[i] = record + (comment,)
-        return a
-
-    def _canonical_records(self, nmax=None):
-        """Bring records to shape with nmax columns.
-
-        Empty columns are filled with ``None``. :meth:`section` filters out any
-        ``None`` entries.
-        """
-        if nmax is None:
-            nmax = numpy.max([len(record) for record, comment in self.__records])
-        records = []
-        for record, comment in self.__records:
-            new_col = nmax - len(record)
-            records.append((tuple(record) + new_col * (None,), comment))
-        return records
+        """Build a recarray from parsed data, column by column."""
+        ncols = numpy.array(self.__ncols, dtype=int)
+        nrows = len(ncols)
+        nmax = ncols.max() if nrows > 0 else 0
+        tokens = numpy.empty(len(self.__tokens), dtype=object)
+        tokens[:] = self.__tokens
+        starts = numpy.cumsum(ncols) - ncols   # first token of each line
+        dtypes = self._column_dtypes(nmax)
+        columns = []
+        for j, (name, dtype) in enumerate(dtypes):
+            dtype = numpy.dtype(dtype)
+            present = ncols > j
+            if present.all():
+                column = self._convert(tokens[starts + j], dtype)
+            else:
+                column = numpy.empty(nrows, dtype=dtype)
+                column[:] = self.MISSING.get(dtype.kind, 0)
+                column[present] = self._convert(tokens[starts[present] + j], dtype)
+            columns.append(column)
+        self.__tokens = []
+        self.__ncols = ncols
+        self.row_comments = numpy.array(self.row_comments, dtype=str)
+        names = [name for name, dtype in dtypes] + ["comment"]
+        return numpy.rec.fromarrays(columns + [self.row_comments], names=names)
 
     @property
     def data(self):
@@ -220,37 +245,34 @@ class ITPdata(ITPSection):
         """  data is atom data, stored as :class:`numpy.rec.arry`
         """
         self.__data = data
+        self.__ncols = []
 
     def process(self, line):
-        if len(line.strip()) == 0:
+        record, semicolon, comment = line.partition(';')
+        record = record.split()
+        if not record:
+            if semicolon:
+                self.comments.append(comment.lstrip())
             return     # skip empty lines
-
-        m = self.COMMENT.match(line)
-        if m:
-            self.comments.append(m.group('comment'))
-            return
-
-        m = self.DATA.match(line)
-        if m:
-            comment = m.group('comment') or ""
-            record = m.group('data').split()
-            self.__records.append((record, comment))
-            return
-
-        self.logger.warn("[%s] not parsing line: %r", self.name, line)
-
-    def _clean_records(self):
-        """Generator returning data records with ``None`` or ``nan`` entries stripped,"""
-        def is_NONE(x):
-            if x is None:
-                return True
-            try:
-                return numpy.isnan(x)
-            except TypeError:
-                pass
-            return False
-        for rec in self.data:
-            yield tuple([x for x in rec if not is_NONE(x)])
+        self.__tokens.extend(record)
+        self.__ncols.append(len(record))
+        self.row_comments.append(comment.lstrip())
+
+    def _numcols(self, data, names):
+        """Number of columns to write for each line: columns can only be
+        omitted from the right, a column is missing if it is ``None`` or
+        ``nan`` or was missing in the parsed line."""
+        present = numpy.ones((len(data), len(names)), dtype=bool)
+        for j, name in enumerate(names):
+            column = data[name]
+            if column.dtype.kind == 'f':
+                present[:, j] = ~numpy.isnan(column)
+            elif column.dtype.kind == 'O':
+                present[:, j] = numpy.not_equal(column, None)
+        numcols = numpy.cumprod(present, axis=1).sum(axis=1)
+        if len(self.__ncols) == len(data):
+            numcols = numpy.minimum(numcols, self.__ncols)
+        return numcols
 
     def section(self):
         """Return a string of the section data in ITP format.
@@ -262,15 +284,21 @@ class ITPdata(ITPSection):
         lines = ["[ %s ]" % self.name]          # start with section header
         lines.append(self.column_comment)       # add fixed column descriptors
 
-        for rec in self._clean_records():
-            numcols = len(rec) - 1              # subtract 1 because comment is always last field in record
-            fmt = " ".join(self.fmt[:numcols])  # fill columns left-to-right
-            if rec[-1]:                         # add non-empty comment
-                fmt += " ; %s"
-                line = fmt % tuple(rec)
-            else:                               # line without trailing comment
-                line = fmt % tuple(rec)[:-1]
-            lines.append(line)
+        data = self.data
+        names = [name for name in data.dtype.names if name != "comment"]
+        fmts = self.fmt + ["%s"] * (len(names) - len(self.fmt))
+        numcols = self._numcols(data, names)
+        body = [None] * len(data)
+        for n in numpy.unique(numcols):
+            rows = numpy.flatnonzero(numcols == n)
+            fmt = " ".join(fmts[:n])            # fill columns left-to-right
+            columns = [data[name][rows].tolist() for name in names[:n]]
+            for i, line in zip(rows.tolist(), map(fmt.__mod__, zip(*columns))):
+                body[i] = line
+        if "comment" in data.dtype.names:       # add non-empty comments
+            for i in numpy.flatnonzero(data["comment"] != "").tolist():
+                body[i] += " ; %s" % data["comment"][i]
+        lines.extend(body)
 
         return "\n".join(lines) + "\n"
 
@@ -391,8 +419,8 @@ class Atoms(ITPdata):
 
     The data itself are stored in :attr:`data`, a :class:`numpy.rec.array`.
     :attr:`data` is a managed attribute but the values inside can be
-    changed. Fields in the array have a maximum size (in particular, comments
-    are cut off after 128 characters).
+    changed. String fields in the array have a maximum size; comments are
+    kept whole.
 
     .. versionadded:: 0.2.5
     """
@@ -654,8 +682,7 @@ class ITP(utilities.FileUtils):
         kwargs['clean'] = True
         kwargs['strip'] = True
         ppitp = Preprocessor(self.real_filename, **kwargs)
-        ppitp.parse()
-        pp_lines = ppitp.StringIO().readlines()
+        pp_lines = list(ppitp.lines())
 
         def strip_line(line):
             s = line.strip()
@@ -693,8 +720,7 @@ class ITP(utilities.FileUtils):
             kwargs['commentchar'] = self.commentchar
             kwargs['clean'] = True
             ppitp = Preprocessor(self.real_filename, **kwargs)
-            ppitp.parse(**defines)
-            itp = ppitp.StringIO()
+            itp = ppitp.lines(**defines)    # lines are streamed to the parser
         else:
             itp = open(self.real_filename)
 
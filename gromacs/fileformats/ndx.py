@@ -23,14 +23,20 @@ access to the individual groups.
 .. autoclass:: uniqueNDX
    :members:
 
+.. autoclass:: listNDX
+
 .. autoclass:: IndexSet
+
+.. autofunction:: read_groups
+
+numpy is only imported when index groups are converted to arrays, so
+:func:`read_groups` and :class:`listNDX` (used by the helper scripts run
+from the generated command files) start without it.
 """
 
 import re
 import operator
 
-import numpy
-
 #from gromacs import ParseError, AutoCorrectionWarning
 import gromacs.utilities as utilities
 from collections import OrderedDict as odict
@@ -125,14 +131,17 @@ class NDX(odict, utilities.FileUtils):
 
     def write(self, filename=None, ncol=ncol, format=format):
         """Write index file to *filename* (or overwrite the file that the index was read from)"""
+        row = " ".join(ncol * [format]) + '\n'
         with open(self.filename(filename, ext='ndx'), 'w') as ndx:
             for name in self:
-                atomnumbers = self._getarray(name)  # allows overriding
+                atomnumbers = self._getlist(name)  # allows overriding
                 ndx.write('[ %s ]\n' % name)
-                for k in range(0, len(atomnumbers), ncol):
-                    line = atomnumbers[k: k + ncol].astype(int)   # nice formatting in ncol-blocks
-                    n = len(line)
-                    ndx.write((" ".join(n * [format]) + '\n') % tuple(line))
+                # nice formatting in ncol-blocks, all full lines formatted at once
+                full = len(atomnumbers) // ncol
+                ndx.write((row * full) % tuple(atomnumbers[:full * ncol]))
+                rest = atomnumbers[full * ncol:]
+                if rest:
+                    ndx.write((" ".join(len(rest) * [format]) + '\n') % tuple(rest))
                 ndx.write('\n')
 
     def get(self, name):
@@ -174,11 +183,17 @@ class NDX(odict, utilities.FileUtils):
         """
         return self[name]
 
+    def _getlist(self, name):
+        """Helper getter that is used in write(): the atom numbers of
+        group *name* as a list of int."""
+        return self._getarray(name).astype(int).tolist()
+
     def _transform(self, v):
         """Transform input to the stored representation.
 
         Override eg with ``return set(v)`` for index lists as sets.
         """
+        import numpy
         return numpy.ravel(v).astype(int)
 
     def __setitem__(self, k, v):
@@ -226,6 +241,22 @@ class NDX(odict, utilities.FileUtils):
         self.write(filename)
 
 
+def read_groups(filename):
+    """Names of the index groups of *filename*, in the order of the file
+    and with duplicates, as :attr:`NDX.groups`; atom numbers are not
+    parsed. The suffix ``.ndx`` is added if missing, as by :meth:`NDX.read`."""
+    if filename[-3:] != NDX.default_extension:
+        filename += '.' + NDX.default_extension
+    groups = []
+    with open(filename) as ndx:
+        for line in ndx:
+            if '[' in line:
+                m = NDX.SECTION.match(line.strip())
+                if m:
+                    groups.append(m.group('name'))
+    return groups
+
+
 class IndexSet(set):
     """set which defines '+' as union (OR) and '-' as intersection  (AND)."""
     def __add__(self, x):
@@ -273,9 +304,29 @@ class uniqueNDX(NDX):
         return IndexSet(v)
 
     def _getarray(self, k):
+        import numpy
         return numpy.sort(numpy.fromiter(self[k], dtype=int, count=len(self[k])))
 
 
+class listNDX(NDX):
+    """Index whose groups are lists of int instead of numpy arrays, for
+    the scripts which only read, slice and write index groups: numpy is
+    never imported.
+
+    **Example** ::
+
+       I = listNDX('system.ndx')
+       I['first'] = I['SOL'][:3]
+       I.write()
+    """
+
+    def _transform(self, v):
+        return [int(i) for i in v]
+
+    def _getlist(self, k):
+        return self[k]
+
+
 
 # or use list of these?
 # class IndexGroup(dict):
@@ -0,0 +1,331 @@
+# PDB coordinate files
+# email: email@klniu.com
+
+"""
+PDB coordinate files
+====================
+
+Bulk reading and writing of the ATOM/HETATM records of PDB files. The
+records are cut into their fixed-width columns over a bytes buffer and
+converted column by column into a numpy structured array (see
+:data:`DTYPE`), so reading or writing a million atoms takes seconds, and
+the bounding box or the centre of a structure is a single numpy call.
+The principal axes give the oriented (tightest) bounding box, and
+:meth:`PDB.align` turns the long axis of a molecule along z.
+
+Atom serial numbers above 99999 and residue numbers above 9999 are
+written and read in the hybrid-36 notation (``A0000`` follows ``99999``),
+as by packmol, VMD and the PDB tools for large systems.
+
+Only the first model of a file is read.
+
+**Example**
+
+  Centre a structure on the origin::
+
+    pdb = read('m.pdb')
+    pdb.coords -= pdb.center()
+    pdb.write('centred.pdb')
+
+.. autodata:: DTYPE
+.. autofunction:: read
+.. autofunction:: parse
+.. autofunction:: write
+.. autofunction:: hy36encode
+.. autofunction:: hy36decode
+.. autoclass:: PDB
+   :members:
+"""
+
+import numpy
+
+#: Fields of an atom record. Strings are stripped, missing numbers are 0
+#: (occupancy 1).
+DTYPE = numpy.dtype([
+    ('record', 'U6'),
+    ('serial', int),
+    ('name', 'U4'),
+    ('altloc', 'U1'),
+    ('resname', 'U4'),
+    ('chain', 'U1'),
+    ('resid', int),
+    ('icode', 'U1'),
+    ('coords', float, (3,)),
+    ('occupancy', float),
+    ('bfactor', float),
+    ('element', 'U2'),
+    ('charge', 'U2'),
+])
+
+# (field, first column, last column + 1)
+_STRINGS = [('record', 0, 6), ('name', 12, 16), ('altloc', 16, 17), ('resname', 17, 21),
+            ('chain', 21, 22), ('icode', 26, 27), ('element', 76, 78), ('charge', 78, 80)]
+_WIDTH = 80
+_DIGITS_UPPER = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+_DIGITS_LOWER = _DIGITS_UPPER.lower()
+# value of the byte of a base 36 digit, either case
+_DIGIT_VALUES = numpy.zeros(256, dtype=int)
+_DIGIT_VALUES[numpy.frombuffer((_DIGITS_UPPER + _DIGITS_LOWER).encode(), dtype=numpy.uint8)] = list(range(36)) * 2
+
+
+def hy36encode(width, value):
+    """Hybrid-36 string of the integer *value* in a field of *width*:
+    decimal below 10**width, then upper case and lower case base 36.
+
+    :Raises: :exc:`ValueError` if *value* doesn't fit
+    """
+    if value < 10 ** width:
+        return '%*d' % (width, value)
+    value -= 10 ** width
+    block = 26 * 36 ** (width - 1)
+    for digits in (_DIGITS_UPPER, _DIGITS_LOWER):
+        if value < block:
+            value += 10 * 36 ** (width - 1)
+            chars = []
+            while value:
+                value, digit = divmod(value, 36)
+                chars.append(digits[digit])
+            return ''.join(reversed(chars))
+        value -= block
+    raise ValueError("{0} doesn't fit in hybrid-36 of width {1}".format(value, width))
+
+
+def hy36decode(width, string):
+    """Integer of the hybrid-36 *string* of a field of *width*, see
+    :func:`hy36encode`. A blank field is 0."""
+    string = string.strip()
+    if not string:
+        return 0
+    if string[0].isdigit() or string[0] == '-':
+        return int(string)
+    value = int(string, 36) - 10 * 36 ** (width - 1) + 10 ** width
+    if string[0].islower():
+        value += 26 * 36 ** (width - 1)
+    return value
+
+
+def _hy36encode_array(width, values):
+    """:func:`hy36encode` of an int array, as an array of strings"""
+    values = numpy.asarray(values, dtype=int)
+    strings = numpy.char.mod('%{0}d'.format(width), values).astype('U%d' % width)
+    large = values >= 10 ** width
+    if large.any():
+        block = 26 * 36 ** (width - 1)
+        rest = values[large] - 10 ** width
+        if rest.max() >= 2 * block:
+            raise ValueError("{0} doesn't fit in hybrid-36 of width {1}".format(rest.max() + 10 ** width, width))
+        lower = rest >= block
+        rest = rest - lower * block + 10 * 36 ** (width - 1)
+        digits = numpy.zeros((len(rest), width), dtype=int)
+        for k in range(width - 1, -1, -1):
+            rest, digits[:, k] = numpy.divmod(rest, 36)
+        table = numpy.array([list(_DIGITS_UPPER), list(_DIGITS_LOWER)])
+        chars = table[lower.astype(int)[:, numpy.newaxis], digits]
+        strings[large] = numpy.ascontiguousarray(chars).view('U%d' % width).ravel()
+    return strings
+
+
+def _column(chars, start, stop):
+    """bytes of the columns *start*:*stop* of a 2D char array, one per row"""
+    return numpy.ascontiguousarray(chars[:, start:stop]).view('S%d' % (stop - start)).ravel()
+
+
+def _floats(field, default=0.0):
+    """floats of a column, *default* for blank or unreadable values"""
+    field = numpy.char.strip(field)
+    try:
+        return numpy.where(field == b'', str(default).encode(), field).astype(float)
+    except ValueError:
+        values = []
+        for value in field.tolist():
+            try:
+                values.append(float(value))
+            except ValueError:
+                values.append(default)
+        return numpy.array(values, dtype=float)
+
+
+def _ints(chars, start, stop):
+    """integers of a hybrid-36 column; hybrid-36 values fill the whole
+    field, so they start with a letter"""
+    width = stop - start
+    field = numpy.char.strip(_column(chars, start, stop))
+    values = numpy.zeros(len(field), dtype=int)
+    alpha = numpy.char.isalpha(numpy.ascontiguousarray(chars[:, start]))
+    plain = ~alpha & (field != b'')
+    values[plain] = field[plain].astype(int)
+    if alpha.any():
+        codes = numpy.ascontiguousarray(chars[alpha, start:stop]).view(numpy.uint8)
+        powers = 36 ** numpy.arange(width - 1, -1, -1)
+        values[alpha] = (_DIGIT_VALUES[codes] * powers).sum(axis=1) - 10 * 36 ** (width - 1) + 10 ** width + \
+            (codes[:, 0] >= ord('a')) * 26 * 36 ** (width - 1)
+    return values
+
+
+def parse(lines):
+    """Parse ATOM/HETATM records.
+
+    :Arguments:
+       *lines*
+          sequence of the record lines (str or bytes)
+
+    :Returns: structured array of :data:`DTYPE`
+    """
+    atoms = numpy.zeros(len(lines), dtype=DTYPE)
+    if not len(lines):
+        return atoms
+    if not isinstance(lines[0], bytes):
+        lines = [line.encode() for line in lines]
+    chars = numpy.array([line.rstrip(b'\r\n') for line in lines], dtype='S%d' % _WIDTH)
+    chars = chars.view('S1').reshape(len(lines), _WIDTH)
+    for field, start, stop in _STRINGS:
+        atoms[field] = numpy.char.strip(_column(chars, start, stop)).astype(str)
+    atoms['serial'] = _ints(chars, 6, 11)
+    atoms['resid'] = _ints(chars, 22, 26)
+    try:
+        for axis in range(3):
+            start = 30 + 8 * axis
+            atoms['coords'][:, axis] = _column(chars, start, start + 8).astype(float)
+    except ValueError as err:
+        raise ValueError("can't parse the coordinates: {0}".format(err))
+    atoms['occupancy'] = _floats(_column(chars, 54, 60), 1.0)
+    atoms['bfactor'] = _floats(_column(chars, 60, 66))
+    return atoms
+
+
+class PDB(object):
+    """Atoms of a PDB file.
+
+    :Attributes:
+       *atoms*
+          structured array of :data:`DTYPE`
+       *cryst1*
+          (a, b, c, alpha, beta, gamma) of the CRYST1 record or ``None``
+       *title*
+          text of the TITLE records
+    """
+
+    def __init__(self, atoms, cryst1=None, title=''):
+        self.atoms = atoms
+        self.cryst1 = cryst1
+        self.title = title
+
+    def __len__(self):
+        return len(self.atoms)
+
+    @property
+    def coords(self):
+        """coordinates, a (n, 3) view of :attr:`atoms`, in angstrom"""
+        return self.atoms['coords']
+
+    @coords.setter
+    def coords(self, value):
+        self.atoms['coords'] = value
+
+    def bounding_box(self):
+        """(minimum, maximum) coordinates"""
+        return self.coords.min(axis=0), self.coords.max(axis=0)
+
+    def size(self):
+        """extent along x, y and z"""
+        lower, upper = self.bounding_box()
+        return upper - lower
+
+    def center(self):
+        """centre of the bounding box"""
+        lower, upper = self.bounding_box()
+        return (lower + upper) / 2
+
+    def principal_axes(self):
+        """Principal axes of the coordinates, unit vectors as the rows of a
+        (3, 3) array, the axis of largest spread first; right-handed."""
+        coords = self.coords - self.coords.mean(axis=0)
+        values, vectors = numpy.linalg.eigh(numpy.dot(coords.T, coords))
+        axes = vectors[:, ::-1].T
+        axes[2] = numpy.cross(axes[0], axes[1])
+        return axes
+
+    def oriented_size(self):
+        """extents along the :meth:`principal_axes` (largest first): the
+        size of the tightest box of the structure, whatever its
+        orientation"""
+        coords = numpy.dot(self.coords, self.principal_axes().T)
+        return coords.max(axis=0) - coords.min(axis=0)
+
+    def align(self):
+        """Rotate the atoms in place about their centroid so that the first
+        principal axis lies along z and the last along x."""
+        first, second, third = self.principal_axes()
+        rotation = numpy.array([numpy.cross(second, first), second, first])
+        centroid = self.coords.mean(axis=0)
+        self.coords = numpy.dot(self.coords - centroid, rotation.T) + centroid
+
+    def write(self, filename):
+        """Write to *filename*, see :func:`write`."""
+        write(filename, self.atoms, self.cryst1, self.title)
+
+
+def read(filename):
+    """Read the atoms of the first model of a PDB file.
+
+    :Returns: :class:`PDB`
+    :Raises: :exc:`ValueError` if coordinates can't be parsed
+    """
+    with open(filename, 'rb') as f:
+        data = f.read()
+    cryst1, title = None, []
+    lines = []
+    for line in data.splitlines():
+        record = line[:6]
+        if record == b'ATOM  ' or record == b'HETATM':
+            lines.append(line)
+        elif record == b'ENDMDL':
+            break
+        elif record == b'CRYST1':
+            cryst1 = tuple(float(line[start:stop]) for start, stop in
+                           ((6, 15), (15, 24), (24, 33), (33, 40), (40, 47), (47, 54)))
+        elif record == b'TITLE ':
+            title.append(line[10:].decode().strip())
+    try:
+        atoms = parse(lines)
+    except ValueError as err:
+        raise ValueError("{0}: {1}".format(filename, err))
+    return PDB(atoms, cryst1, ' '.join(title))
+
+
+def _name(name, element):
+    """atom name aligned as in the PDB: from column 13 unless it has 4
+    characters, starts with a digit or has a two-letter element"""
+    if len(name) >= 4 or name[:1].isdigit() or len(element) == 2:
+        return '%-4s' % name
+    return ' %-3s' % name
+
+
+def write(filename, atoms, cryst1=None, title=''):
+    """Write atoms to a PDB file.
+
+    :Arguments:
+       *atoms*
+          structured array of :data:`DTYPE`
+       *cryst1*
+          (a, b, c, alpha, beta, gamma) for a CRYST1 record
+       *title*
+          text of a TITLE record
+    """
+    fmt = '%-6s%5s %4s%1s%-4s%1s%4s%1s   %8.3f%8.3f%8.3f%6.2f%6.2f          %2s%-2s\n'
+    coords = atoms['coords']
+    columns = [atoms['record'].tolist(),
+               _hy36encode_array(5, atoms['serial']).tolist(),
+               [_name(name, element) for name, element in zip(atoms['name'].tolist(), atoms['element'].tolist())],
+               atoms['altloc'].tolist(), atoms['resname'].tolist(), atoms['chain'].tolist(),
+               _hy36encode_array(4, atoms['resid']).tolist(),
+               atoms['icode'].tolist(), coords[:, 0].tolist(), coords[:, 1].tolist(), coords[:, 2].tolist(),
+               atoms['occupancy'].tolist(), atoms['bfactor'].tolist(),
+               atoms['element'].tolist(), atoms['charge'].tolist()]
+    with open(filename, 'w') as f:
+        if title:
+            f.write('TITLE     %s\n' % title)
+        if cryst1 is not None:
+            f.write('CRYST1%9.3f%9.3f%9.3f%7.2f%7.2f%7.2f P 1           1\n' % tuple(cryst1))
+        f.write(''.join([fmt % row for row in zip(*columns)]))
+        f.write('END\n')
@@ -52,6 +52,12 @@ with :meth:`Preprocessor.StringIO`::::
      print s,
  s.close()
 
+To process big files in constant memory, iterate over the lines as they are
+produced by the generator :meth:`Preprocessor.lines` (no :meth:`parse` needed)::
+
+ for line in PP.lines(POSRES=True):
+     print line,
+
 Finally, there's also a `context manager`_ for the :mod:`cStringIO`
 functionality, provided by :meth:`Preprocessor.open`::
 
@@ -70,12 +76,17 @@ Directives
 
 The directives understood are:
 
-``#define VAR``
+``#define VAR`` or ``#define VAR value``
 
   Define the variable *VAR*; note that even ``#define VAR 0`` in the
   input file will have the effect of defining the variable. The
   :class:`Preprocessor` constructor, however, will *not define* any
-  *VAR* keyword that evaluates to ``False``.
+  *VAR* keyword that evaluates to ``False``. With a *value*, *VAR* is a
+  macro: every whole-word *VAR* in the data part (before the comment
+  character) of the following lines is replaced by *value*, e.g. the
+  ``gb_1`` bond parameters of the GROMOS force fields. A keyword of the
+  constructor is a macro only if its value is a string (``gb_1="0.1 1e7"``);
+  other true values (``POSRES=True``, ``POSRES=1``) only define *VAR*.
 
 ``#undef VAR``
 
@@ -85,23 +96,41 @@ The directives understood are:
 
   Conditional evaluation of content blocks. *VAR* can only be a simple
   variable name, and it is checked against a list of defined variable
-  names.
+  names. Blocks can be nested (e.g. ``#ifdef FLEXIBLE`` inside
+  ``#ifdef POSRES``); a block must be closed in the file it was opened.
+
+``#ifndef VAR`` ... ``#else`` ... ``#endif``
+
+  Same, for *VAR* not defined.
+
+``#include "file"`` or ``#include <file>``
+
+  The processed content of *file* replaces the directive. *file* is looked
+  for relative to the directory of the including file, then in the
+  *includedirs* given to :class:`Preprocessor`, then in the directories of
+  :envvar:`GMXLIB` and in :envvar:`GMXDATA`/top, like :program:`grompp`
+  does. Processed include files are kept in a process-wide cache keyed by
+  path, defines and options, so a force field shared by many topologies is
+  processed once (see :func:`clear_include_cache`). An entry records the
+  modification times of all the files read to expand it, nested includes
+  too, and is processed again when any of them changed.
 
 ``#exclude`` ... ``#endexclude``
 
   Content inside the exclude block is omitted from the processed file.
 
-.. Note::
-
-   Expansion of a defined VAR inside the file is *not supported*. VAR are *only used
-   in the context of ``#ifdef``/``#ifndef`` directives.
+Each line is split once and directives are dispatched through the table
+:attr:`Preprocessor.DIRECTIVES`; ``# ifdef`` (with a blank after ``#``) is
+understood too. Other directives (e.g. ``#if``) are left in the output.
 
 
-Classes
--------
+Classes and functions
+---------------------
 
 .. autoclass:: Preprocessor
    :members:
+.. autofunction:: clear_include_cache
+.. autofunction:: include_path
 
 """
 
@@ -112,16 +141,39 @@ __licence__ = "MIT"
 __URL__ = "http://code.google.com/p/pypreprocessor/"
 
 import os
+import re
+from collections import OrderedDict
 from contextlib import contextmanager
 
+# processed #include files: (realpath, defines, options) -> (lines, defines after, ((path, mtime), ...) of all
+# the files read for it)
+_include_cache = {}
+
+
+def clear_include_cache():
+    """Empty the process-wide cache of processed #include files."""
+    _include_cache.clear()
+
+
+def include_path():
+    """Include directories from the environment: the directories in
+    :envvar:`GMXLIB` and :envvar:`GMXDATA`/top."""
+    dirs = [d for d in os.environ.get('GMXLIB', '').split(os.pathsep) if d]
+    if os.environ.get('GMXDATA'):
+        dirs.append(os.path.join(os.environ['GMXDATA'], 'top'))
+    return dirs
+
+
 class Preprocessor(object):
     """CPP-style processing of files.
 
     The directives understood are:
 
-    - ``#define VAR``
+    - ``#define VAR`` and ``#define VAR value`` (macro)
     - ``#undef VAR``
-    - ``#ifdef VAR`` ... ``#else`` ... ``#endif``
+    - ``#ifdef VAR`` ... ``#else`` ... ``#endif`` (nested)
+    - ``#ifndef VAR`` ... ``#else`` ... ``#endif`` (nested)
+    - ``#include "file"``
     - ``#exclude`` ... ``#endexclude``
 
     """
@@ -144,134 +196,286 @@ class Preprocessor(object):
            *strip*
               remove all empty lines and lines starting with *commentchar*
               (does not work with *clean* = ``False``) [``False``]
+           *include*
+              replace ``#include`` directives by the processed files; with
+              ``False`` the directives are left in the output [``True``]
+           *includedirs*
+              list of directories searched for ``#include`` files before
+              :envvar:`GMXLIB` and :envvar:`GMXDATA`/top
            *defines*
               any other keywords *VAR* are interpreted as ``#define VAR`` statement if
-              *VAR* evaluates to ``True``.
+              *VAR* evaluates to ``True``; a string value makes *VAR* a macro
+              (``#define VAR value``).
 
         .. versionchanged:: 0.3.1
            *strip* keyword added
+        .. versionchanged:: 0.3.2
+           *include* and *includedirs* keywords added
         """
         # public variables
         self.input = filename  # XXX: was a filename
         self.output = output
         self.removeMeta = kwargs.pop("clean", True)
         self.commentchar = kwargs.pop("commentchar", ";")  # for itp files
-        self.default_defines = [x for x in kwargs if kwargs[x]]    #   #define x
-        self.defines = self.default_defines[:]                     # see parser()
         self.strip = kwargs.pop('strip', False)
+        self.resolve_includes = kwargs.pop('include', True)
+        self.includedirs = list(kwargs.pop('includedirs', [])) + include_path()
+        self.default_defines = [x for x in kwargs if kwargs[x]]    #   #define x
+        self.defines = OrderedDict((x, self._value(kwargs[x])) for x in self.default_defines)
+        self.__default_values = self.defines.copy()
         if not self.removeMeta and self.strip:
             import warnings
             warnings.warn("Preprocessor: clean=False takes precedence over strip=True")
         # private variables
+        self.__filename = filename
         self.__linenum = 0
         self.__excludeblock = False
-        self.__ifblock = False
-        self.__ifcondition = ''
-        self.__ifconditions = []
-        self.__evalsquelch = True
-        self.__outputBuffer = ''
-
-    def define(self, define):
-        """#define directive"""
-        self.defines.append(define)
+        self.__ifstack = []      # [active, parent active, condition taken] per #if
+        self.__include = None    # file of the last #include
+        self.__including = []    # files being processed, to catch include loops
+        self.__read = []         # (path, mtime) of the files read, per #include being processed
+        self.__macros = None     # compiled regex of the macros, see substitute()
+        self.__outputLines = []
+
+    @staticmethod
+    def _value(value):
+        """macro value of a keyword: a string is substituted for VAR, other
+        true values (``True``, ``1``) define VAR without value"""
+        return value if isinstance(value, str) else ''
+
+    def define(self, define, value=''):
+        """#define directive, *value* is substituted for *define* in the
+        lines that follow"""
+        self.defines[define] = value
+        self.__macros = None
 
     def search_defines(self, define):
         """Check if variable *define* has been defined."""
         return (define in self.defines)
 
-    def compare_defines_and_conditions(self, defines, conditions):
-        """#ifdef directive"""
-        # if defines and conditions lists have no intersecting values (ie. else = true)
-        return (not [val for val in defines if val in conditions])
-
     def undefine(self, define):
         """#undef directive"""
-        # re-map the defines list excluding the define specified in the args
-        self.defines[:] = [x for x in self.defines if x != define]
+        self.defines.pop(define, None)
+        self.__macros = None
+
+    def active(self):
+        """``True`` if lines at the current position are kept, i.e. all the
+        enclosing conditions hold"""
+        return not self.__ifstack or self.__ifstack[-1][0]
+
+    def substitute(self, line):
+        """Replace the macros (variables defined with a value) in the data
+        part of *line*, before any *commentchar*"""
+        if self.__macros is None:
+            names = [name for name in self.defines if self.defines[name]]
+            self.__macros = re.compile(r'\b(%s)\b' % '|'.join(
+                re.escape(name) for name in sorted(names, key=len, reverse=True))) if names else False
+        if self.__macros is False:
+            return line
+        data, comment, rest = line.partition(self.commentchar)
+        for i in range(self.MAX_EXPANSION):    # values can use other macros
+            expanded = self.__macros.sub(lambda m: self.defines[m.group(1)], data)
+            if expanded == data:
+                break
+            data = expanded
+        return data + comment + rest
+
+    # directive: (handler, min args, max args, evaluated in inactive blocks)
+    DIRECTIVES = {
+        '#ifdef': ('_ifdef', 1, 1, True),
+        '#ifndef': ('_ifdef', 1, 1, True),
+        '#else': ('_else', 0, 0, True),
+        '#endif': ('_endif', 0, 0, True),
+        '#define': ('_define', 1, None, False),
+        '#undef': ('_undef', 1, 1, False),
+        '#include': ('_include', 1, 1, False),
+        '#exclude': ('_exclude', 0, 0, False),
+        '#endexclude': ('_endexclude', 0, 0, False),
+    }
+    #: maximum number of rounds of macro expansion in a line
+    MAX_EXPANSION = 16
 
     def lexer(self, line):
-        """evaluate *line*
+        """evaluate *line*, splitting it once and dispatching directives
+        through :attr:`DIRECTIVES`
 
         :returns: ``(squelch, metadata)``
         """
-        if self.__ifblock is False and self.__excludeblock is False:
-            if line[:1] != '#':
-                return False, False
-        # handle #define directives
-        if line[:7] == '#define':
-            if len(line.split()) != 2:
-                self.raise_error('#define')
-            else:
-                self.define(line.split()[1])
-                return False, True
-        # handle #undef directives
-        if line[:6] == '#undef':
-            if len(line.split()) != 2:
-                self.raise_error('#undef')
-            else:
-                self.undefine(line.split()[1])
-                return False, True
-        # handle #endif directives
-        if line[:6] == '#endif':
-            if len(line.split()) != 1:
-                self.raise_error('#endif')
-            else:
-                self.__ifblock = False
-                self.__ifcondition = ''
-                self.__ifconditions = []
-                return False, True
-        # handle #endexclude directives
-        if line[:11] == '#endexclude':
-            if len(line.split()) != 1:
-                self.raise_error('#endexclude')
-            else:
-                self.__excludeblock = False
-                return False, True
-        # handle #exclude directives
-        if line[:8] == '#exclude':
-            if len(line.split()) != 1:
-                self.raise_error('#exclude')
-            else:
-                self.__excludeblock = True
-        # process the excludeblock
-        if self.__excludeblock is True:
+        if line[:1] != '#':
+            return self.__excludeblock or not self.active(), False
+        fields = line.split()
+        if fields[0] == '#' and len(fields) > 1:    # "# ifdef VAR"
+            fields = ['#' + fields[1]] + fields[2:]
+        directive, args = fields[0], fields[1:]
+        if directive not in self.DIRECTIVES:
+            return self.__excludeblock or not self.active(), False
+        handler, nmin, nmax, conditional = self.DIRECTIVES[directive]
+        if self.__excludeblock and directive != '#endexclude':
             return True, False
-        # handle #ifdef directives
-        if line[:6] == '#ifdef':
-            if len(line.split()) != 2:
-                self.raise_error('#ifdef')
-            else:
-                self.__ifblock = True
-                self.__ifcondition = line.split()[1]
-                self.__ifconditions.append(line.split()[1])
-        # handle #else directives
-        if line[:5] == '#else':
-            if len(line.split()) != 1:
-                self.raise_error('#else')
-        # process the ifblock
-        if self.__ifblock is True:
-            # evaluate and process an #ifdef
-            if line[:6] == '#ifdef':
-                self.__evalsquelch = not self.search_defines(self.__ifcondition)
-                return False, True
-            # evaluate and process the #else
-            elif line[:5] == '#else':
-                self.__evalsquelch = not self.compare_defines_and_conditions(self.defines, self.__ifconditions)
-                return False, True
-            else:
-                return self.__evalsquelch, False
-        else:
+        if not conditional and not self.active():
+            return True, False
+        if directive == '#include' and not self.resolve_includes:
             return False, False
+        if len(args) < nmin or (nmax is not None and len(args) > nmax):
+            self.raise_error(directive)
+        return getattr(self, handler)(directive, args)
+
+    def _ifdef(self, directive, args):
+        """#ifdef and #ifndef, nested in the enclosing blocks"""
+        taken = self.search_defines(args[0]) == (directive == '#ifdef')
+        parent = self.active()
+        self.__ifstack.append([parent and taken, parent, taken])
+        return False, True
+
+    def _else(self, directive, args):
+        if not self.__ifstack:
+            self.raise_error(directive)
+        block = self.__ifstack[-1]
+        block[0] = block[1] and not block[2]
+        return False, True
+
+    def _endif(self, directive, args):
+        if not self.__ifstack:
+            self.raise_error(directive)
+        self.__ifstack.pop()
+        return False, True
+
+    def _define(self, directive, args):
+        self.define(args[0], ' '.join(args[1:]))
+        return False, True
+
+    def _undef(self, directive, args):
+        self.undefine(args[0])
+        return False, True
+
+    def _include(self, directive, args):
+        self.__include = args[0].strip('"<>')
+        return False, True
+
+    def _exclude(self, directive, args):
+        self.__excludeblock = True
+        return True, False
+
+    def _endexclude(self, directive, args):
+        self.__excludeblock = False
+        return False, True
 
     def raise_error(self, directive):
         """error handling
 
         :Raises: :exc:`SyntaxError`
         """
-        msg = 'File: "' + self.input + '", line ' + str(self.__linenum)
+        msg = 'File: "' + self.__filename + '", line ' + str(self.__linenum)
         msg = msg + '\n' + 'SyntaxError: Invalid ' + directive + ' directive'
         raise SyntaxError(msg)
 
+    def find_include(self, name, directory):
+        """Path of the #include file *name*: relative to *directory* (of the
+        including file), else in the include directories (*includedirs*,
+        then :envvar:`GMXLIB` and :envvar:`GMXDATA`/top).
+
+        :Raises: :exc:`IOError` if the file is not found
+        """
+        if os.path.isabs(name):
+            candidates = [name]
+        else:
+            candidates = [os.path.join(d, name) for d in [directory] + self.includedirs]
+        for path in candidates:
+            if os.path.isfile(path):
+                return path
+        raise IOError('File: "%s", line %d\nInclude file "%s" not found in %s' % (
+            self.__filename, self.__linenum, name, [directory] + self.includedirs))
+
+    def _process(self, filename):
+        """Generator of the processed lines of *filename*; conditional blocks
+        can't span files, #include files are processed in place."""
+        saved = self.__filename, self.__linenum, self.__ifstack, self.__excludeblock
+        self.__filename, self.__linenum, self.__ifstack, self.__excludeblock = filename, 0, [], False
+        try:
+            with open(filename, 'r') as input_file:
+                # process the input file
+                for line in input_file:
+                    self.__linenum += 1
+                    # to squelch or not to squelch
+                    squelch, metaData = self.lexer(line)
+                    # process and output
+                    if self.removeMeta is False or (metaData is False and squelch is False):
+                        if squelch is True:
+                            yield self.commentchar + '#' + line
+                        elif not (self.strip and (len(line.strip()) == 0 or
+                                                  line.strip().startswith(self.commentchar))):
+                            # output survived!
+                            yield self.substitute(line) if metaData is False else line
+                    if self.__include is not None:
+                        path = self.find_include(self.__include, os.path.dirname(filename))
+                        self.__include = None
+                        for included in self._included(path):
+                            yield included
+            if self.__ifstack:
+                raise SyntaxError('File: "%s", line %d\nSyntaxError: missing #endif' % (
+                    filename, self.__linenum))
+        finally:
+            self.__filename, self.__linenum, self.__ifstack, self.__excludeblock = saved
+
+    def _included(self, path):
+        """Processed lines of the #include file *path*, from the
+        process-wide cache if the file was processed already with the
+        same defines and options."""
+        path = os.path.realpath(path)
+        if path in self.__including:
+            raise SyntaxError('File: "%s" includes itself' % path)
+        key = (path, tuple(sorted(self.defines.items())),
+               self.removeMeta, self.strip, self.commentchar, tuple(self.includedirs))
+        entry = _include_cache.get(key)
+        if entry is not None and self._unchanged(entry[2]):
+            lines, defines, read = entry
+            self.defines = OrderedDict(defines)
+            self.__macros = None
+        else:
+            self.__including.append(path)
+            self.__read.append([(path, os.path.getmtime(path))])
+            try:
+                lines = tuple(self._process(path))
+            finally:
+                self.__including.pop()
+                read = tuple(self.__read.pop())
+            _include_cache[key] = lines, tuple(self.defines.items()), read
+        # the enclosing #include depends on these files too
+        if self.__read:
+            self.__read[-1].extend(read)
+        return lines
+
+    @staticmethod
+    def _unchanged(read):
+        """``True`` if none of the (path, mtime) *read* was changed or removed"""
+        try:
+            return all(os.path.getmtime(path) == mtime for path, mtime in read)
+        except OSError:
+            return False
+
+    def lines(self, **kwargs):
+        """Generator of the processed lines of the input file.
+
+        *kwargs* are variables that are set (``#define VAR``) or unset
+        (``#undef VAR``) at the beginning of the file, see :meth:`parse`.
+        The input is read lazily, so memory use does not depend on the size
+        of the file; #include files are taken from a process-wide cache
+        (see :func:`clear_include_cache`).
+
+        .. versionadded:: 0.3.2
+        """
+        # unset defaults for any VAR=False
+        self.defines = OrderedDict((x, self.__default_values[x]) for x in self.default_defines
+                                   if kwargs.pop(x, True))
+        # add all new defines for which VAR is True
+        self.defines.update((x, self._value(kwargs[x])) for x in kwargs if kwargs[x])
+        self.__macros = None
+
+        self.__including = [os.path.realpath(self.input)]
+        self.__read = []
+        for line in self._process(self.input):
+            yield line
+
     def parse(self, **kwargs):
         """parsing/processing
 
@@ -281,31 +485,10 @@ class Preprocessor(object):
         *VAR* = ``False`` allows one to undefine some of these.
 
         This method only populates the output buffer and does not write an
-        output file; use :meth:`write` for that purpose.
+        output file; use :meth:`write` for that purpose. To process the file
+        without holding it in memory, iterate over :meth:`lines` instead.
         """
-        # unset defaults for any VAR=False
-        self.defines = [x for x in self.default_defines if kwargs.pop(x, True)]
-        # add all new defines for which VAR is True
-        self.defines.extend([x for x in kwargs if kwargs[x]])
-
-        self.__outputBuffer = ''
-        with open(self.input, 'r') as input_file:
-            # process the input file
-            for line in input_file:
-                self.__linenum += 1
-                # to squelch or not to squelch
-                squelch, metaData = self.lexer(line)
-                # process and output
-                if self.removeMeta is True:
-                    if metaData is True or squelch is True:
-                        continue
-                if squelch is True:
-                    self.__outputBuffer += self.commentchar + '#' + line
-                    continue
-                if self.strip and (len(line.strip()) == 0 or line.strip().startswith(self.commentchar)):
-                    continue
-                # output survived!
-                self.__outputBuffer += line
+        self.__outputLines = list(self.lines(**kwargs))
 
     @property
     def buffer(self):
@@ -313,7 +496,7 @@ class Preprocessor(object):
 
         .. SeeAlso:: :meth:`StringIO` and :meth:`write`
         """
-        return str(self.__outputBuffer)
+        return ''.join(self.__outputLines)
 
     def StringIO(self):
         """Return a :func:`cStringIO.StringIO` instance of the buffer.
@@ -322,7 +505,7 @@ class Preprocessor(object):
         the processed input from the last invocation of :meth:`parse`.
         """
         from io import StringIO
-        return StringIO(self.__outputBuffer)
+        return StringIO(self.buffer)
 
     @contextmanager
     def open(self):
@@ -365,7 +548,7 @@ class Preprocessor(object):
             output_file = os.fdopen(fd, 'w')
 
         try:
-            output_file.write(self.__outputBuffer)
+            output_file.writelines(self.__outputLines)
         finally:
             output_file.close()
 
@@ -0,0 +1,272 @@
+# Whole-system topology
+# email: email@klniu.com
+
+"""
+Whole-system topology
+=====================
+
+Model of a Gromacs system topology (``.top``): the file and all its
+``#include`` files are run through the
+:class:`~gromacs.fileformats.preprocessor.Preprocessor`, every
+``[ moleculetype ]`` becomes a :class:`Molecule` template (numpy arrays of
+its ``[ atoms ]``) and ``[ molecules ]`` the list of (template, count)
+blocks of the system.
+
+Per-atom arrays of the whole system (:attr:`Topology.names`,
+:attr:`Topology.charges`, ...) are built lazily, when first used, by
+tiling each template as many times as its count; no per-atom objects are
+created. The net charge and the total mass don't need them at all.
+
+:meth:`Topology.check` compares the atom and residue names of the system
+with a coordinate file (GRO or PDB) in a few vectorised operations, so a
+topology can be validated in milliseconds before grompp is run.
+
+**Example**
+
+  Check a generated topology against the start structure::
+
+    top = Topology('system.top', includedirs=['/usr/share/gromacs/top'])
+    print(top.natoms, top.net_charge, top.total_mass)
+    for problem in top.check('start.pdb'):
+        print(problem)
+
+.. autoclass:: Topology
+   :members:
+.. autoclass:: Molecule
+   :members:
+.. autofunction:: read_names
+"""
+
+import os
+from collections import OrderedDict
+
+import numpy
+
+from .preprocessor import Preprocessor
+from . import gro
+from . import pdb
+
+# ptype column of [ atomtypes ], which tells how many optional columns precede it
+_PTYPES = ('A', 'S', 'V', 'D')
+
+
+class Molecule(object):
+    """Template of a ``[ moleculetype ]``.
+
+    :Attributes:
+       *name*, *nrexcl*
+          from ``[ moleculetype ]``
+       *types*, *resnames*, *names*
+          unicode arrays of the ``[ atoms ]`` columns
+       *resnrs*
+          int array of the residue numbers
+       *charges*, *masses*
+          float arrays; missing values are taken from ``[ atomtypes ]``
+    """
+
+    def __init__(self, name, nrexcl=3):
+        self.name = name
+        self.nrexcl = nrexcl
+        self._atoms = []
+
+    def _finish(self, atomtypes):
+        """convert the rows of [ atoms ] to arrays"""
+        rows = self._atoms
+        del self._atoms
+        self.types = numpy.array([row[1] for row in rows], dtype=str)
+        self.resnrs = numpy.array([int(row[2]) for row in rows], dtype=int)
+        self.resnames = numpy.array([row[3] for row in rows], dtype=str)
+        self.names = numpy.array([row[4] for row in rows], dtype=str)
+        self.charges = numpy.array([float(row[6]) if len(row) > 6 else atomtypes.get(row[1], (0.0, 0.0))[1]
+                                    for row in rows], dtype=float)
+        self.masses = numpy.array([float(row[7]) if len(row) > 7 else atomtypes.get(row[1], (0.0, 0.0))[0]
+                                   for row in rows], dtype=float)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __repr__(self):
+        return "<Molecule {0} with {1} atoms>".format(self.name, len(self))
+
+
+class Topology(object):
+    """System topology read from a ``.top`` file.
+
+    :Attributes:
+       *moleculetypes*
+          :class:`OrderedDict` of name: :class:`Molecule`
+       *molecules*
+          list of (name, count) of ``[ molecules ]``, in order
+       *atomtypes*
+          dict of atom type: (mass, charge)
+       *system*
+          title from ``[ system ]``
+    """
+
+    def __init__(self, filename=None, includedirs=(), **defines):
+        """Read *filename* if given.
+
+        :Arguments:
+           *filename*
+              the ``.top`` file
+           *includedirs*
+              directories searched for ``#include`` files, before
+              :envvar:`GMXLIB` and :envvar:`GMXDATA`/top
+           *defines*
+              ``#define`` *VAR* variables for the preprocessor, as for
+              :class:`~gromacs.fileformats.itp.ITP`
+        """
+        self.includedirs = list(includedirs)
+        self.defines = defines
+        self.moleculetypes = OrderedDict()
+        self.molecules = []
+        self.atomtypes = {}
+        self.system = ''
+        self._expanded = {}
+        if filename is not None:
+            self.read(filename)
+
+    def read(self, filename):
+        """Read the topology *filename* with its #include files.
+
+        :Raises: :exc:`ValueError` for an unknown molecule in
+                 ``[ molecules ]`` or a bad line; :exc:`IOError` if an
+                 include file is not found
+        """
+        self.filename = filename
+        self.moleculetypes = OrderedDict()
+        self.molecules = []
+        self.atomtypes = {}
+        self.system = ''
+        self._expanded = {}
+        pp = Preprocessor(filename, strip=True, includedirs=self.includedirs)
+        section = molecule = None
+        for line in pp.lines(**self.defines):
+            data = line.partition(';')[0].strip()
+            if not data or data[0] == '#':
+                continue
+            if data[0] == '[':
+                section = data.strip('[] \t').lower()
+                continue
+            fields = data.split()
+            try:
+                if section == 'atoms' and molecule is not None:
+                    molecule._atoms.append(fields)
+                elif section == 'moleculetype':
+                    molecule = Molecule(fields[0], int(fields[1]) if len(fields) > 1 else 3)
+                    self.moleculetypes[molecule.name] = molecule
+                elif section == 'atomtypes':
+                    self._atomtype(fields)
+                elif section == 'molecules':
+                    self.molecules.append((fields[0], int(fields[1])))
+                elif section == 'system':
+                    self.system = (self.system + ' ' + data).strip()
+            except (IndexError, ValueError):
+                raise ValueError("{0}: can't parse [ {1} ] line: {2}".format(filename, section, data))
+        for molecule in self.moleculetypes.values():
+            molecule._finish(self.atomtypes)
+        unknown = [name for name, count in self.molecules if name not in self.moleculetypes]
+        if unknown:
+            raise ValueError("{0}: no [ moleculetype ] for molecules {1}".format(filename, unknown))
+
+    def _atomtype(self, fields):
+        """mass and charge of an [ atomtypes ] line; the bonded type and
+        atomic number columns are optional, so locate the ptype column"""
+        for i in range(3, min(len(fields), 6)):
+            if fields[i] in _PTYPES:
+                self.atomtypes[fields[0]] = (float(fields[i - 2]), float(fields[i - 1]))
+                return
+
+    @property
+    def blocks(self):
+        """list of (:class:`Molecule`, count) of the system"""
+        return [(self.moleculetypes[name], count) for name, count in self.molecules]
+
+    @property
+    def natoms(self):
+        """number of atoms of the system"""
+        return sum(len(mol) * count for mol, count in self.blocks)
+
+    @property
+    def net_charge(self):
+        """net charge of the system"""
+        return sum(mol.charges.sum() * count for mol, count in self.blocks)
+
+    @property
+    def total_mass(self):
+        """total mass of the system, in u"""
+        return sum(mol.masses.sum() * count for mol, count in self.blocks)
+
+    def expand(self, attribute):
+        """Per-atom array of the system for the :class:`Molecule`
+        *attribute* (e.g. ``'names'``): each template tiled *count* times.
+        Arrays are built on first use and cached."""
+        if attribute not in self._expanded:
+            blocks = self.blocks
+            parts = [numpy.tile(getattr(mol, attribute), count) for mol, count in blocks if count]
+            self._expanded[attribute] = numpy.concatenate(parts) if parts else numpy.array([])
+        return self._expanded[attribute]
+
+    names = property(lambda self: self.expand('names'), doc="atom names of the system")
+    resnames = property(lambda self: self.expand('resnames'), doc="residue names of the system")
+    types = property(lambda self: self.expand('types'), doc="atom types of the system")
+    charges = property(lambda self: self.expand('charges'), doc="charges of the system")
+    masses = property(lambda self: self.expand('masses'), doc="masses of the system")
+
+    def locate(self, indices):
+        """(molecule name, molecule number, atom number in the molecule),
+        all one-based, of the atoms at the zero-based *indices*"""
+        blocks = self.blocks
+        sizes = numpy.array([len(mol) * count for mol, count in blocks], dtype=int)
+        starts = numpy.concatenate(([0], numpy.cumsum(sizes)))
+        indices = numpy.asarray(indices, dtype=int)
+        which = numpy.searchsorted(starts, indices, 'right') - 1
+        located = []
+        for index, block in zip(indices.tolist(), which.tolist()):
+            mol = blocks[block][0]
+            offset = index - starts[block]
+            located.append((mol.name, offset // len(mol) + 1, offset % len(mol) + 1))
+        return located
+
+    def check(self, filename, maxreport=10):
+        """Compare the atoms of the coordinate file *filename* (GRO or PDB)
+        with the system.
+
+        Names are compared truncated to the width of the file (5 characters
+        for GRO, 4 for PDB).
+
+        :Returns: list of problems as strings, empty if the atom count and
+                  all the atom and residue names match; at most
+                  *maxreport* mismatches of each kind are detailed
+        """
+        names, resnames = read_names(filename)
+        natoms = self.natoms
+        if len(names) != natoms:
+            return ["{0} has {1} atoms, the topology {2}".format(filename, len(names), natoms)]
+        problems = []
+        for what, coord, top in (('atom', names, self.names), ('residue', resnames, self.resnames)):
+            top = top.astype(coord.dtype) if len(coord) else top
+            wrong = numpy.flatnonzero(coord != top)
+            if not len(wrong):
+                continue
+            problems.append("{0} {1} names differ from the topology".format(len(wrong), what))
+            for index, (mol, number, atom) in zip(wrong[:maxreport], self.locate(wrong[:maxreport])):
+                problems.append("  atom {0}: {1} {2} in {3}, {4} in {5} {6} atom {7}".format(
+                    index + 1, what, coord[index], filename, top[index], mol, number, atom))
+        return problems
+
+    def __repr__(self):
+        return "<Topology {0!r} with {1} molecule types, {2} atoms>".format(
+            self.system, len(self.moleculetypes), self.natoms)
+
+
+def read_names(filename):
+    """Atom and residue names of a GRO or PDB file (by extension).
+
+    :Returns: (names, resnames) unicode arrays
+    """
+    if os.path.splitext(filename)[1].lower() == '.gro':
+        coords = gro.read(filename)
+        return coords.names, coords.resnames
+    atoms = pdb.read(filename).atoms
+    return atoms['name'], atoms['resname']
@@ -0,0 +1,163 @@
+# Topology store
+# email: email@klniu.com
+
+"""
+Topology store
+==============
+
+Compact, versioned on-disk store for a parametrised molecule: a JSON
+header plus raw numpy arrays (atoms, atom types, bonded terms), each
+array aligned so it can be memory mapped. Loading reads only the header;
+arrays are mapped on first access, so reloading a molecule takes
+milliseconds whatever its size, and nothing is unpickled (safe to load
+from untrusted sources).
+
+The store is written by acpype (``<base>.tps``, see
+``ACTopol.topStoreSave``) and read with :func:`load`: ``acpype -T``
+writes the GROMACS files of a stored molecule again without prmtop and
+inpcrd (``MolTopol.loadTopStore``), and ``itp_match.py`` takes a store as
+the topology of a fragment (``read_store``).
+
+File layout::
+
+    MAGIC (8 bytes) | header length (8 bytes, little endian) | JSON header
+    | padding | array | padding | array ...
+
+The header holds the format ``version``, free ``meta`` data and, for
+each array, its ``dtype``, ``shape`` and ``offset`` in the file. Files
+written with an older version stay readable: :func:`load` accepts any
+version up to :data:`VERSION`.
+
+**Example**
+
+  Write and reload::
+
+    save('mol.tps', {'charges': charges, 'bond_atoms': bonds}, meta={'name': 'MOL'})
+    store = load('mol.tps')
+    store.meta['name'], store['charges'].sum()
+
+.. autofunction:: save
+.. autofunction:: load
+.. autoclass:: TopStore
+   :members:
+"""
+
+import json
+import struct
+
+import numpy
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+#: Magic bytes at the start of a store file.
+MAGIC = b'TOPSTORE'
+#: Current version of the format.
+VERSION = 1
+# alignment of the header end and of each array, in bytes
+_ALIGN = 64
+
+
+def _aligned(offset):
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def save(filename, arrays, meta=None):
+    """Write a store.
+
+    :Arguments:
+       *filename*
+          output file
+       *arrays*
+          dict of name: array-like; object arrays are saved as unicode
+          strings
+       *meta*
+          JSON-serialisable dict saved in the header
+    """
+    names = list(arrays)
+    data = []
+    for name in names:
+        array = numpy.ascontiguousarray(arrays[name])
+        if array.dtype == object:
+            array = array.astype(str)
+        data.append(array)
+
+    def header_bytes(offsets):
+        header = {'version': VERSION, 'meta': meta or {}, 'arrays': dict(
+            (name, {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset})
+            for name, array, offset in zip(names, data, offsets))}
+        return json.dumps(header, sort_keys=True).encode('utf-8')
+
+    # offsets depend on the header length and the header on the offsets:
+    # size the header with dummy offsets as wide as the real ones can be
+    size = sum(array.nbytes + _ALIGN for array in data)
+    wide = header_bytes([size * 10 + 10 ** 6] * len(data))
+    offset = _aligned(len(MAGIC) + 8 + len(wide))
+    offsets = []
+    for array in data:
+        offsets.append(offset)
+        offset = _aligned(offset + array.nbytes)
+    header = header_bytes(offsets)
+    with open(filename, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for array, offset in zip(data, offsets):
+            f.write(b'\0' * (offset - f.tell()))
+            f.write(array.tobytes())
+
+
+class TopStore(Mapping):
+    """Read-only mapping of array name to array of a store file, see
+    :func:`load`. Header data are in :attr:`version`, :attr:`meta` and
+    :attr:`header`."""
+
+    def __init__(self, filename, mmap=True):
+        self.filename = filename
+        self.mmap = mmap
+        with open(filename, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("{0} is not a topology store file".format(filename))
+            length = struct.unpack('<Q', f.read(8))[0]
+            self.header = json.loads(f.read(length).decode('utf-8'))
+        self.version = self.header.get('version', 0)
+        if self.version > VERSION:
+            raise ValueError("{0} has version {1}, newer than the supported {2}".format(
+                filename, self.version, VERSION))
+        self.meta = self.header.get('meta', {})
+        self._arrays = {}
+
+    def __getitem__(self, name):
+        if name not in self._arrays:
+            info = self.header['arrays'][name]
+            dtype, shape = numpy.dtype(info['dtype']), tuple(info['shape'])
+            count = int(numpy.prod(shape))
+            if count == 0:
+                array = numpy.zeros(shape, dtype)
+            elif self.mmap:
+                array = numpy.memmap(self.filename, dtype, 'r', info['offset'], shape)
+            else:
+                with open(self.filename, 'rb') as f:
+                    f.seek(info['offset'])
+                    array = numpy.fromfile(f, dtype, count).reshape(shape)
+            self._arrays[name] = array
+        return self._arrays[name]
+
+    def __iter__(self):
+        return iter(self.header['arrays'])
+
+    def __len__(self):
+        return len(self.header['arrays'])
+
+
+def load(filename, mmap=True):
+    """Open a store; only the header is read, the arrays are memory
+    mapped (or read if *mmap* is False) when first accessed.
+
+    :Returns: :class:`TopStore`
+    :Raises: :exc:`ValueError` if the file is not a store or was written
+             by a newer version
+    """
+    return TopStore(filename, mmap)
@@ -0,0 +1,203 @@
+# Index groups of a system
+# email: email@klniu.com
+
+"""
+Index groups of a system
+========================
+
+Build the index groups of a system without :program:`make_ndx`: atom
+names and residue names come from the coordinates (GRO or PDB), atom
+types from the :class:`~gromacs.fileformats.top.Topology`, and every
+group is a numpy mask over the whole system.
+
+:func:`default_groups` gives the groups :program:`make_ndx` creates for
+a system without protein: ``System``, ``Other`` and one group per other
+residue name, ``Water`` and one group per water residue name,
+``non-Water``, ``Ion`` and one group per ion residue name and
+``Water_and_ions``. Residues are classified by name only (:data:`WATER`,
+:data:`IONS`); everything else, protein residues included, is ``Other``.
+
+Extra groups are written in the :program:`make_ndx` syntax, ``r`` for a
+residue name, ``a`` for an atom name and ``t`` for an atom type, joined
+with ``|``. A trailing ``*`` matches a prefix. The group is named after
+the names joined with ``_``, as :program:`make_ndx` does::
+
+    r SOL|r NA|r CL   -->  SOL_NA_CL
+    t HW|t OW         -->  HW_OW
+
+**Example**
+
+  Default groups plus water with ions, written to ``system.ndx``::
+
+    atoms = SystemAtoms.read('pdb.gro', 'system.top')
+    groups = default_groups(atoms.resnames)
+    groups.update(select(atoms, ['r SOL|r NA|r CL']))
+    write('system.ndx', groups)
+
+.. autodata:: WATER
+.. autodata:: IONS
+.. autoclass:: SystemAtoms
+   :members:
+.. autofunction:: default_groups
+.. autofunction:: parse_selection
+.. autofunction:: select
+.. autofunction:: write
+"""
+
+import os
+from collections import OrderedDict
+
+import numpy
+
+from gromacs.fileformats import gro as grofile
+from gromacs.fileformats import pdb as pdbfile
+from gromacs.fileformats.ndx import NDX
+
+#: residue names of water models
+WATER = ('SOL', 'WAT', 'HOH', 'HO4', 'HO5', 'TIP3', 'TIP4', 'TIP5', 'SPC', 'SPCE', 'T3P', 'T4P', 'T5P')
+#: residue names of ions
+IONS = ('NA', 'K', 'MG', 'CA', 'ZN', 'CL', 'BR', 'I', 'F', 'LI', 'RB', 'CS', 'CU', 'CU2', 'SOD', 'POT', 'CLA',
+        'NA+', 'K+', 'CL-', 'MG2+', 'CA2+', 'ZN2+')
+
+# make_ndx selection letter: attribute of SystemAtoms
+_KINDS = {'r': 'resnames', 'a': 'names', 't': 'types'}
+
+
+class SystemAtoms(object):
+    """Per-atom names of a system.
+
+    :Attributes:
+       *names*, *resnames*
+          unicode arrays from the coordinate file
+       *types*
+          unicode array of the atom types from the topology, or ``None``
+    """
+
+    def __init__(self, names, resnames, types=None):
+        self.names = numpy.asarray(names, dtype=str)
+        self.resnames = numpy.asarray(resnames, dtype=str)
+        self.types = None if types is None else numpy.asarray(types, dtype=str)
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def read(cls, coordinates, topology=None, includedirs=()):
+        """Atoms of the coordinate file *coordinates* (GRO or PDB, by
+        extension), with the types of the ``.top`` file *topology* if
+        given.
+
+        :Raises: :exc:`ValueError` if the topology has another number of
+                 atoms
+        """
+        if os.path.splitext(coordinates)[1].lower() == '.gro':
+            coords = grofile.read(coordinates)
+            names, resnames = coords.names, coords.resnames
+        else:
+            atoms = pdbfile.read(coordinates).atoms
+            names, resnames = atoms['name'], atoms['resname']
+        types = None
+        if topology is not None:
+            from gromacs.fileformats.top import Topology
+            top = Topology(topology, includedirs=includedirs)
+            types = top.types
+            if len(types) != len(names):
+                raise ValueError("{0} has {1} atoms, the topology {2} {3}".format(
+                    coordinates, len(names), topology, len(types)))
+        return cls(names, resnames, types)
+
+
+def _atoms_of(mask):
+    """one-based atom numbers of a mask"""
+    return numpy.flatnonzero(mask) + 1
+
+
+def default_groups(resnames):
+    """The default groups of :program:`make_ndx` for the residue names
+    *resnames* of the system.
+
+    :Returns: :class:`OrderedDict` of group name: one-based atom numbers;
+              residue names are in the order of their first atom
+    """
+    resnames = numpy.asarray(resnames, dtype=str)
+    unique, first = numpy.unique(resnames, return_index=True)
+    unique = unique[numpy.argsort(first)]
+    is_water = numpy.isin(resnames, WATER)
+    is_ion = numpy.isin(resnames, IONS)
+    other = [name for name in unique.tolist() if name not in WATER and name not in IONS]
+    water = [name for name in unique.tolist() if name in WATER]
+    ions = [name for name in unique.tolist() if name in IONS]
+
+    groups = OrderedDict([('System', numpy.arange(1, len(resnames) + 1))])
+    if other:
+        groups['Other'] = _atoms_of(~(is_water | is_ion))
+        for name in other:
+            groups[name] = _atoms_of(resnames == name)
+    if water:
+        groups['Water'] = _atoms_of(is_water)
+        for name in water:
+            groups[name] = _atoms_of(resnames == name)
+        groups['non-Water'] = _atoms_of(~is_water)
+    if ions:
+        groups['Ion'] = _atoms_of(is_ion)
+        for name in ions:
+            groups[name] = _atoms_of(resnames == name)
+    if water and ions:
+        groups['Water_and_ions'] = _atoms_of(is_water | is_ion)
+    return groups
+
+
+def parse_selection(selection):
+    """(name, [(kind, id), ...]) of a make_ndx style *selection* such as
+    ``'t HW|a OW'``.
+
+    :Raises: :exc:`ValueError` for an unknown kind or an empty part
+    """
+    terms = []
+    for part in selection.split('|'):
+        fields = part.split()
+        if len(fields) != 2 or fields[0] not in _KINDS:
+            raise ValueError("can't parse {0!r} of {1!r}, expected one of {2} and a name".format(
+                part.strip(), selection, ', '.join(sorted(_KINDS))))
+        terms.append((fields[0], fields[1]))
+    return '_'.join(ident for kind, ident in terms), terms
+
+
+def _match(values, ident):
+    """mask of the values equal to ident, or starting with it if it ends with *"""
+    if ident.endswith('*'):
+        return numpy.char.startswith(values, ident[:-1])
+    return values == ident
+
+
+def select(atoms, selections):
+    """Groups of the make_ndx style *selections* of the
+    :class:`SystemAtoms` *atoms*.
+
+    :Returns: :class:`OrderedDict` of group name: one-based atom numbers,
+              in the order of *selections*; repeated groups are kept once
+    :Raises: :exc:`ValueError` for a bad selection or an atom type
+             selection without types
+    """
+    groups = OrderedDict()
+    for selection in selections:
+        name, terms = parse_selection(selection)
+        if name in groups:
+            continue
+        mask = numpy.zeros(len(atoms), dtype=bool)
+        for kind, ident in terms:
+            values = getattr(atoms, _KINDS[kind])
+            if values is None:
+                raise ValueError("{0!r} selects atom types, which need the topology".format(selection))
+            mask |= _match(values, ident)
+        groups[name] = _atoms_of(mask)
+    return groups
+
+
+def write(filename, groups):
+    """Write the :class:`OrderedDict` *groups* to the index file
+    *filename* through :class:`~gromacs.fileformats.ndx.NDX`."""
+    ndx = NDX()
+    for name, atomnumbers in groups.items():
+        ndx[name] = atomnumbers
+    ndx.write(filename)
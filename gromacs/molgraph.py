@@ -0,0 +1,207 @@
+# Molecular graph helpers
+# email: email@klniu.com
+
+"""
+Molecular graph helpers
+=======================
+
+Read the atoms and bonds of small molecule files (Sybyl mol2, MDL mol)
+and compute atom labels and a hash of the molecular graph, independent
+of the atom order and names.
+
+The labels come from a Weisfeiler-Lehman colour refinement: each atom
+starts with its element and is relabelled with its label plus the sorted
+labels of its neighbours until the partition is stable. Atoms with the
+same final label are topologically equivalent (up to the rare graphs the
+refinement can't tell apart). The hash is not canonical: different
+molecules with the same refinement (e.g. decalin and bicyclopentyl) share
+it, so it can only pick candidates, which must be confirmed with
+:func:`match_atoms`. That turns the labels into a one-to-one atom
+mapping by individualising one pair of equivalent atoms at a time and
+refining again, then checks that the mapping keeps every bond.
+
+**Example**
+
+  Hash of a molecule plus the settings of a charge calculation::
+
+    mol = read_mol2('lig.mol2')
+    key = graph_hash(mol['elements'], mol['bonds'], extra=(0, 1, 'bcc', 'gaff'))
+
+.. autofunction:: read_mol2
+.. autofunction:: read_mdl
+.. autofunction:: read_molecule
+.. autofunction:: wl_labels
+.. autofunction:: graph_hash
+.. autofunction:: match_atoms
+"""
+
+import hashlib
+import os
+
+import numpy
+
+# two-letter elements, to tell Cl from C when the element comes from a name
+_TWO_LETTERS = set(['Cl', 'Br', 'Na', 'Mg', 'Si', 'Li', 'Ca', 'Zn', 'Fe', 'Cu',
+                    'Mn', 'Co', 'Ni', 'Al', 'Se', 'Cs', 'Rb', 'Sr', 'Ba', 'Cd'])
+
+
+def _element(atype, name):
+    """Element of a mol2 atom from its Sybyl type (C.ar, Cl) or, for
+    lowercase force field types (c3, hc), from its name."""
+    symbol = atype.split('.')[0]
+    if symbol[:1].isupper():
+        return symbol.capitalize() if len(symbol) <= 2 else symbol[0]
+    letters = ''.join(c for c in name if c.isalpha()).capitalize()
+    return letters[:2] if letters[:2] in _TWO_LETTERS else letters[:1]
+
+
+def read_mol2(filename):
+    """Read the first molecule of a Sybyl mol2 file.
+
+    :Returns: dict with *names*, *types* and *elements* (lists),
+              *charges* (float array) and *bonds* (int array of shape
+              (n, 2) with zero-based atom indices, plus *orders* with the
+              bond types as strings)
+    """
+    names, types, elements, charges, bonds, orders = [], [], [], [], [], []
+    section = None
+    with open(filename) as f:
+        for line in f:
+            if line.startswith('@<TRIPOS>'):
+                if section is not None and line.startswith('@<TRIPOS>MOLECULE'):
+                    break
+                section = line[9:].strip()
+                continue
+            fields = line.split()
+            if not fields:
+                continue
+            if section == 'ATOM':
+                names.append(fields[1])
+                types.append(fields[5])
+                elements.append(_element(fields[5], fields[1]))
+                charges.append(float(fields[8]) if len(fields) > 8 else 0.0)
+            elif section == 'BOND':
+                bonds.append((int(fields[1]) - 1, int(fields[2]) - 1))
+                orders.append(fields[3])
+    return {'names': names, 'types': types, 'elements': elements,
+            'charges': numpy.array(charges),
+            'bonds': numpy.array(bonds, dtype=int).reshape(-1, 2),
+            'orders': orders}
+
+
+def read_mdl(filename):
+    """Read a MDL mol (V2000) file, same result as :func:`read_mol2`;
+    names are the element symbols and charges zeros."""
+    with open(filename) as f:
+        lines = f.readlines()
+    natoms, nbonds = int(lines[3][0:3]), int(lines[3][3:6])
+    elements = [line[31:34].strip() for line in lines[4:4 + natoms]]
+    block = lines[4 + natoms:4 + natoms + nbonds]
+    bonds = [(int(line[0:3]) - 1, int(line[3:6]) - 1) for line in block]
+    return {'names': list(elements), 'types': list(elements), 'elements': elements,
+            'charges': numpy.zeros(natoms),
+            'bonds': numpy.array(bonds, dtype=int).reshape(-1, 2),
+            'orders': [line[6:9].strip() for line in block]}
+
+
+def read_molecule(filename):
+    """Read a mol2 or mdl/mol file according to its extension, see
+    :func:`read_mol2`. Raises :exc:`ValueError` for other formats."""
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.mol2':
+        return read_mol2(filename)
+    if ext in ('.mdl', '.mol'):
+        return read_mdl(filename)
+    raise ValueError("Can't read molecule graph from {0}".format(filename))
+
+
+def _refine(elements, bonds):
+    """WL refinement; returns the final labels and the signatures of all
+    the rounds, which together identify the graph."""
+    natoms = len(elements)
+    neighbours = [[] for i in range(natoms)]
+    for i, j in numpy.asarray(bonds, dtype=int).reshape(-1, 2).tolist():
+        neighbours[i].append(j)
+        neighbours[j].append(i)
+    ranks = dict((e, k) for k, e in enumerate(sorted(set(elements))))
+    labels = [ranks[e] for e in elements]
+    nclasses = len(ranks)
+    rounds = [sorted(elements)]
+    while True:
+        signatures = [(labels[i], tuple(sorted(labels[j] for j in neighbours[i])))
+                      for i in range(natoms)]
+        ranks = dict((s, k) for k, s in enumerate(sorted(set(signatures))))
+        labels = [ranks[s] for s in signatures]
+        rounds.append(sorted(signatures))
+        if len(ranks) == nclasses:
+            return labels, rounds
+        nclasses = len(ranks)
+
+
+def wl_labels(elements, bonds):
+    """Colour refinement label of each atom.
+
+    :Arguments:
+       *elements*
+          sequence of element symbols
+       *bonds*
+          (n, 2) array-like of zero-based atom indices
+
+    :Returns: int array, equal labels for equivalent atoms in any atom
+              order of the same molecule (equal labels don't prove
+              that atoms or molecules are equivalent)
+    """
+    return numpy.array(_refine(elements, bonds)[0], dtype=int)
+
+
+def graph_hash(elements, bonds, extra=()):
+    """SHA1 hex digest of the colour refinement of a molecular graph
+    (elements and connectivity) and of the items of *extra* (e.g. net
+    charge and the calculation settings). Equal for any atom order of a
+    molecule, but not canonical: different molecules may share it, so
+    check a match with :func:`match_atoms`."""
+    rounds = _refine(elements, bonds)[1]
+    digest = hashlib.sha1()
+    for item in rounds + [list(extra)]:
+        digest.update(repr(item).encode())
+    return digest.hexdigest()
+
+
+def match_atoms(elements1, bonds1, elements2, bonds2):
+    """Map the atoms of a molecule onto another atom order of it.
+
+    Both graphs are refined together; while a class holds several atoms
+    of each molecule (symmetry-equivalent atoms), the first atom of each
+    is given a new label of its own and the refinement is repeated.
+
+    :Returns: int array, the index in molecule 1 of each atom of
+              molecule 2
+    :Raises: :exc:`ValueError` if the two graphs differ
+    """
+    natoms = len(elements1)
+    bonds1 = numpy.asarray(bonds1, dtype=int).reshape(-1, 2)
+    bonds2 = numpy.asarray(bonds2, dtype=int).reshape(-1, 2)
+    if natoms != len(elements2) or len(bonds1) != len(bonds2):
+        raise ValueError("the molecules differ in atom or bond counts")
+    bonds = numpy.concatenate((bonds1, bonds2 + natoms))
+    labels = list(elements1) + list(elements2)
+    while True:
+        labels = numpy.array(_refine(labels, bonds)[0], dtype=int)
+        counts1 = numpy.bincount(labels[:natoms], minlength=labels.max() + 1)
+        counts2 = numpy.bincount(labels[natoms:], minlength=labels.max() + 1)
+        if (counts1 != counts2).any():
+            raise ValueError("the molecular graphs differ")
+        shared = numpy.flatnonzero(counts1 > 1)
+        if not len(shared):
+            break
+        first = numpy.flatnonzero(labels[:natoms] == shared[0])[0]
+        second = natoms + numpy.flatnonzero(labels[natoms:] == shared[0])[0]
+        labels[[first, second]] = labels.max() + 1
+        labels = labels.tolist()
+    mapping = numpy.empty(natoms, dtype=int)
+    mapping[numpy.argsort(labels[natoms:])] = numpy.argsort(labels[:natoms])
+    # refinement can't tell some regular graphs apart: check the bonds
+    mapped = numpy.sort(mapping[bonds2], axis=1)
+    if not numpy.array_equal(numpy.unique(mapped, axis=0), numpy.unique(numpy.sort(bonds1, axis=1), axis=0)):
+        raise ValueError("no atom mapping found between the molecular graphs")
+    return mapping
@@ -0,0 +1,259 @@
+# Packed structure check
+# email: email@klniu.com
+
+"""
+Packed structure check
+======================
+
+Validation of a structure packed by packmol: the minimum distance
+between atoms of different molecules must not be below the ``tolerance``
+of the packmol input. Close pairs are found with a cell list (cells as
+large as the tolerance, so only the 13 forward neighbour cells and the
+cell itself are searched), entirely in numpy.
+
+Clashing molecules can then be relaxed as rigid bodies: every clashing
+pair pushes its two atoms apart by half the missing distance, the pushes
+are averaged over each molecule and the molecules are translated, until
+no clash is left or the number of iterations is exhausted. Molecules of
+``fixed`` structures are never moved.
+
+Molecules are found from the packmol input: each ``structure`` adds
+``number`` copies of its pdb, in the order of the input.
+
+**Example**
+
+  Check and relax the output of ``packed.inp``::
+
+    inp = read_inp('packed.inp')
+    packed = PackedStructure.from_inp(inp)
+    clashes = packed.relax(inp['tolerance'])
+    packed.write('packed_relaxed.pdb')
+
+.. autofunction:: read_inp
+.. autofunction:: close_pairs
+.. autofunction:: report
+.. autoclass:: PackedStructure
+   :members:
+"""
+
+import numpy
+
+from gromacs.fileformats import pdb as pdbfile
+
+# forward half of the 26 neighbour cells, plus the cell itself
+_OFFSETS = numpy.array([(i, j, k) for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)
+                        if (i, j, k) > (0, 0, 0)] + [(0, 0, 0)], dtype=int)
+
+
+def read_inp(filename):
+    """Read the settings and structures of a packmol input file.
+
+    :Returns: dict with *tolerance* (float, 2.0 if not set), *output*
+              and *structures*, a list of dicts with *pdb*, *number* and
+              *fixed* (bool)
+    """
+    inp = {'tolerance': 2.0, 'output': None, 'structures': []}
+    structure = None
+    with open(filename) as f:
+        for line in f:
+            fields = line.partition('#')[0].split()
+            if not fields:
+                continue
+            keyword = fields[0].lower()
+            if keyword == 'structure':
+                structure = {'pdb': fields[1], 'number': 1, 'fixed': False}
+            elif keyword == 'end' and fields[1:2] == ['structure']:
+                inp['structures'].append(structure)
+                structure = None
+            elif structure is not None:
+                if keyword == 'number':
+                    structure['number'] = int(fields[1])
+                elif keyword == 'fixed':
+                    structure['fixed'] = True
+            elif keyword == 'tolerance':
+                inp['tolerance'] = float(fields[1])
+            elif keyword == 'output':
+                inp['output'] = fields[1]
+    return inp
+
+
+def _ragged_arange(starts, counts):
+    """concatenation of arange(start, start + count) for all the pairs"""
+    keep = counts > 0
+    starts, counts = starts[keep], counts[keep]
+    if not len(counts):
+        return numpy.zeros(0, dtype=int)
+    steps = numpy.ones(counts.sum(), dtype=int)
+    steps[0] = starts[0]
+    steps[numpy.cumsum(counts)[:-1]] = starts[1:] - (starts[:-1] + counts[:-1] - 1)
+    return numpy.cumsum(steps)
+
+
+def close_pairs(coords, cutoff, molecules=None):
+    """Pairs of atoms closer than *cutoff*.
+
+    :Arguments:
+       *coords*
+          array of shape (n, 3)
+       *cutoff*
+          distance, in the unit of *coords*
+       *molecules*
+          molecule index of each atom; pairs in the same molecule are
+          skipped
+
+    :Returns: (i, j, distance) arrays, i < j
+    """
+    coords = numpy.asarray(coords, dtype=float)
+    if not len(coords):
+        return numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int), numpy.zeros(0)
+    cells = numpy.floor((coords - coords.min(axis=0)) / cutoff).astype(int)
+    shape = cells.max(axis=0) + 1
+    cell_ids = numpy.ravel_multi_index(cells.T, shape)
+    order = numpy.argsort(cell_ids, kind='stable')
+    ncells = int(numpy.prod(shape))
+    counts = numpy.bincount(cell_ids, minlength=ncells)
+    starts = numpy.concatenate(([0], numpy.cumsum(counts)[:-1]))
+
+    found_i, found_j, found_d = [], [], []
+    for offset in _OFFSETS:
+        neighbours = cells + offset
+        valid = ((neighbours >= 0) & (neighbours < shape)).all(axis=1)
+        atoms = numpy.flatnonzero(valid)
+        neighbour_ids = numpy.ravel_multi_index(neighbours[atoms].T, shape)
+        n = counts[neighbour_ids]
+        i = numpy.repeat(atoms, n)
+        j = order[_ragged_arange(starts[neighbour_ids], n)]
+        if not offset.any():
+            keep = i < j    # same cell: each pair once
+            i, j = i[keep], j[keep]
+        if molecules is not None:
+            keep = molecules[i] != molecules[j]
+            i, j = i[keep], j[keep]
+        d = numpy.sqrt(((coords[i] - coords[j]) ** 2).sum(axis=1))
+        close = d < cutoff
+        found_i.append(i[close])
+        found_j.append(j[close])
+        found_d.append(d[close])
+    i, j, d = numpy.concatenate(found_i), numpy.concatenate(found_j), numpy.concatenate(found_d)
+    return numpy.minimum(i, j), numpy.maximum(i, j), d
+
+
+class PackedStructure(object):
+    """Atoms of a packed pdb with their molecule index.
+
+    :Attributes:
+       *pdb*
+          the :class:`~gromacs.fileformats.pdb.PDB`
+       *coords*
+          its coordinates, float array of shape (n, 3), in angstrom
+       *molecules*
+          molecule index of each atom
+       *fixed*
+          bool array, ``True`` for the molecules which can't move
+    """
+
+    def __init__(self, pdb, molecules, fixed):
+        self.pdb = pdb
+        self.molecules = numpy.asarray(molecules, dtype=int)
+        self.fixed = numpy.asarray(fixed, dtype=bool)
+
+    @property
+    def coords(self):
+        return self.pdb.coords
+
+    @coords.setter
+    def coords(self, value):
+        self.pdb.coords = value
+
+    @classmethod
+    def from_inp(cls, inp, output=None):
+        """Packed structure of the packmol input *inp* (see
+        :func:`read_inp`), read from *output* or from the output of the
+        input.
+
+        :Raises: :exc:`ValueError` if the atoms of the output don't add up
+                 to the structures of the input
+        """
+        output = output or inp['output']
+        sizes, fixed = [], []
+        for structure in inp['structures']:
+            natoms = len(pdbfile.read(structure['pdb']))
+            sizes += [natoms] * structure['number']
+            fixed += [structure['fixed']] * structure['number']
+        pdb = pdbfile.read(output)
+        if len(pdb) != sum(sizes):
+            raise ValueError("{0} has {1} atoms, the structures of the input {2}".format(
+                output, len(pdb), sum(sizes)))
+        molecules = numpy.repeat(numpy.arange(len(sizes)), sizes)
+        return cls(pdb, molecules, fixed)
+
+    def clashes(self, tolerance):
+        """Pairs of atoms of different molecules closer than *tolerance*,
+        see :func:`close_pairs`."""
+        return close_pairs(self.coords, tolerance, self.molecules)
+
+    def relax(self, tolerance, maxiter=100, log=None):
+        """Translate the clashing molecules apart until no pair is closer
+        than *tolerance*.
+
+        :Arguments:
+           *tolerance*
+              minimum distance, angstrom
+           *maxiter*
+              maximum number of iterations
+           *log*
+              list to which a line per iteration is appended
+
+        :Returns: the remaining clashes, as :meth:`clashes`
+        """
+        nmol = len(self.fixed)
+        movable = ~self.fixed
+        for iteration in range(maxiter + 1):
+            i, j, d = self.clashes(tolerance)
+            if log is not None:
+                log.append('iteration {0}: {1} clashes, minimum distance {2}'.format(
+                    iteration, len(d), '%.3f' % d.min() if len(d) else '-'))
+            if not len(d) or iteration == maxiter:
+                return i, j, d
+            delta = self.coords[i] - self.coords[j]
+            # coincident atoms: push along x
+            delta[d == 0] = (1.0, 0.0, 0.0)
+            unit = delta / numpy.maximum(d, 1e-6)[:, numpy.newaxis]
+            # a little more than half the gap, so the iterations converge
+            push = unit * ((tolerance - d) * 0.55 + 0.01)[:, numpy.newaxis]
+            mi, mj = self.molecules[i], self.molecules[j]
+            # a fixed partner doesn't share the move
+            push_i = numpy.where(movable[mj], 1.0, 2.0)[:, numpy.newaxis] * push
+            push_j = numpy.where(movable[mi], 1.0, 2.0)[:, numpy.newaxis] * push
+            moves = numpy.zeros((nmol, 3))
+            counts = numpy.zeros(nmol)
+            numpy.add.at(moves, mi, push_i)
+            numpy.add.at(moves, mj, -push_j)
+            numpy.add.at(counts, mi, 1)
+            numpy.add.at(counts, mj, 1)
+            moves[~movable] = 0
+            moves[counts > 0] /= counts[counts > 0, numpy.newaxis]
+            self.coords += moves[self.molecules]
+
+    def write(self, filename):
+        """Write the atoms with the current coordinates to *filename*."""
+        self.pdb.write(filename)
+
+
+def report(packed, tolerance, before, after, log=()):
+    """Text of a clash report: clashes *before* and *after* relaxing
+    (both as :meth:`PackedStructure.clashes`), with the remaining clashing
+    molecule pairs."""
+    lines = ['tolerance {0} A, {1} atoms, {2} molecules'.format(
+                 tolerance, len(packed.coords), len(packed.fixed)),
+             'clashes before relaxing: {0}'.format(len(before[2]))]
+    lines += list(log)
+    i, j, d = after
+    lines.append('clashes after relaxing: {0}'.format(len(d)))
+    if len(d):
+        pairs = numpy.column_stack((packed.molecules[i], packed.molecules[j]))
+        pairs, first = numpy.unique(pairs, axis=0, return_index=True)
+        lines.append('molecule  molecule  atom  atom  distance')
+        for (mi, mj), k in zip(pairs.tolist(), first.tolist()):
+            lines.append('%8d  %8d  %4d  %4d  %8.3f' % (mi + 1, mj + 1, i[k] + 1, j[k] + 1, d[k]))
+    return '\n'.join(lines) + '\n'
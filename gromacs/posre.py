@@ -0,0 +1,133 @@
+# Position restraint files
+# email: email@klniu.com
+
+"""
+Position restraint files
+========================
+
+Write the ``posre_*.itp`` files of residues without :program:`make_ndx`
+and :program:`genrestr`: the residue's PDB is read with
+:mod:`gromacs.fileformats.pdb`, the restrained atoms are selected with a
+numpy mask and the ``[ position_restraints ]`` section is formatted in
+one operation.
+
+The atoms are numbered by their position in the PDB (from 1), as
+:program:`genrestr` does, so the PDB must hold the atoms of the
+``[ moleculetype ]`` in its order.
+
+Selections (:data:`SELECTIONS`):
+
+``all``
+   every atom of the residue
+``heavy``
+   atoms which are not hydrogens; the element column is used, or the
+   first letter of the atom name when it is empty
+``backbone``
+   the atoms named N, CA and C
+
+**Example**
+
+  Restrain the heavy atoms of DRG, more strongly along z::
+
+    pdb = pdbfile.read('drg.pdb')
+    atoms = restrained_atoms(pdb.atoms, 'DRG', 'heavy')
+    write('posre_drg.itp', atoms, fc=(1000, 1000, 5000))
+
+.. autodata:: SELECTIONS
+.. autofunction:: restrained_atoms
+.. autofunction:: posre_itp
+.. autofunction:: write
+.. autofunction:: generate
+"""
+
+import numpy
+
+from gromacs.fileformats import pdb as pdbfile
+
+#: atom selections of :func:`restrained_atoms`
+SELECTIONS = ('all', 'heavy', 'backbone')
+
+_BACKBONE = ('N', 'CA', 'C')
+
+
+def _elements(atoms):
+    """element of each atom, from the element column or the first letter of the name"""
+    elements = numpy.char.upper(numpy.char.strip(atoms['element']))
+    guessed = numpy.char.upper(numpy.char.lstrip(atoms['name'], '0123456789'))
+    guessed = numpy.array([name[:1] for name in guessed.tolist()], dtype='U1')
+    return numpy.where(elements == '', guessed, elements)
+
+
+def restrained_atoms(atoms, resname=None, selection='all'):
+    """Atom numbers of the restrained atoms.
+
+    :Arguments:
+       *atoms*
+          atom array of a PDB (:data:`~gromacs.fileformats.pdb.DTYPE`)
+       *resname*
+          only atoms of this residue name; all atoms if ``None``
+       *selection*
+          one of :data:`SELECTIONS`
+
+    :Returns: int array of the one-based positions of the atoms
+    :Raises: :exc:`ValueError` for an unknown selection or if no atom is
+             selected
+    """
+    if selection not in SELECTIONS:
+        raise ValueError("unknown selection {0!r}, expected one of {1}".format(selection, ', '.join(SELECTIONS)))
+    mask = numpy.ones(len(atoms), dtype=bool)
+    if resname is not None:
+        mask &= atoms['resname'] == resname
+    if selection == 'heavy':
+        mask &= _elements(atoms) != 'H'
+    elif selection == 'backbone':
+        mask &= numpy.isin(atoms['name'], _BACKBONE)
+    if not mask.any():
+        raise ValueError("no atom of residue {0} is selected by {1!r}".format(resname, selection))
+    return numpy.flatnonzero(mask) + 1
+
+
+def posre_itp(atomnumbers, fc=(1000, 1000, 1000), title=''):
+    """Text of the ``[ position_restraints ]`` section of *atomnumbers*
+    with the force constants *fc* (x, y, z, kJ mol^-1 nm^-2), function
+    type 1, preceded by the comment *title* if given."""
+    fcx, fcy, fcz = fc
+    row = '%6d%6d' + ' %10g %10g %10g\n' % (fcx, fcy, fcz)
+    atomnumbers = numpy.asarray(atomnumbers, dtype=int).tolist()
+    lines = ['; {0}\n\n'.format(title)] if title else []
+    lines.append('[ position_restraints ]\n;  i funct       fcx        fcy        fcz\n')
+    lines.append((row * len(atomnumbers)) % tuple(i for atom in atomnumbers for i in (atom, 1)))
+    return ''.join(lines)
+
+
+def write(filename, atomnumbers, fc=(1000, 1000, 1000), title=''):
+    """Write the position restraints of *atomnumbers* to *filename*, see
+    :func:`posre_itp`."""
+    with open(filename, 'w') as f:
+        f.write(posre_itp(atomnumbers, fc, title))
+
+
+def generate(residues, selection='all', fc=(1000, 1000, 1000), output='posre_{0}.itp'):
+    """Write the position restraint files of many residues.
+
+    :Arguments:
+       *residues*
+          list of (residue name, pdb file)
+       *selection*
+          one of :data:`SELECTIONS`
+       *fc*
+          force constants along x, y and z
+       *output*
+          file name, ``{0}`` is replaced by the lower case residue name
+
+    :Returns: list of (file name, number of restrained atoms)
+    :Raises: :exc:`ValueError` if no atom of a residue is selected
+    """
+    written = []
+    for resname, filename in residues:
+        atomnumbers = restrained_atoms(pdbfile.read(filename).atoms, resname, selection)
+        posre = output.format(resname.lower())
+        write(posre, atomnumbers, fc, 'position restraints of {0} ({1} atoms) from {2}'.format(
+            resname, selection, filename))
+        written.append((posre, len(atomnumbers)))
+    return written
@@ -88,18 +88,20 @@ from __future__ import with_statement
 __docformat__ = "restructuredtext en"
 
 import os
-import glob
-import fnmatch
 import re
 import warnings
 import errno
-import subprocess
 from contextlib import contextmanager
-import bz2, gzip
 import datetime
 
-import logging
-logger = logging.getLogger('gromacs.utilities')
+class _Logger(object):
+    """The ``gromacs.utilities`` logger; :mod:`logging` is imported when
+    it is first used, which keeps the start of the scripts short."""
+    def __getattr__(self, name):
+        import logging
+        return getattr(logging.getLogger('gromacs.utilities'), name)
+
+logger = _Logger()
 
 #from gromacs import AutoCorrectionWarning
 
@@ -286,6 +288,7 @@ def unlink_gmx_backups(*args):
     """Unlink (rm) all backup files corresponding to the listed files."""
     for path in args:
         dirname, filename = os.path.split(path)
+        import glob
         fbaks = glob.glob(os.path.join(dirname, '#'+filename+'.*#'))
         for bak in fbaks:
             unlink_f(bak)
@@ -309,6 +312,7 @@ def cat(f=None, o=None):
     target = o
     infiles = asiterable(f)
     logger.debug("cat %s > %s " % (" ".join(infiles), target))
+    import subprocess
     with open(target, 'w') as out:
         rc = subprocess.call(['cat'] + infiles, stdout=out)
     if rc != 0:
@@ -411,6 +415,7 @@ def number_pdbs(*args, **kwargs):
     format = kwargs.pop('format', "%(num)04d")
     name_format = "%(prefix)s" + format +".%(suffix)s"
     filenames = []
+    import glob
     map(filenames.append, map(glob.glob, args))  # concatenate all filename lists
     filenames = filenames[0]                     # ... ugly
     for f in filenames:
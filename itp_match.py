@@ -9,229 +9,211 @@
 # You should have received a copy of the GNU General Public License along with this program. If not, see http://www.gnu.org/licenses/.
 ##
 # @file fragitpjoin.py
-# @brief According the indics match of a molecule and its fragment, convert the itp file of fragment to molecule to use.
+# @brief According the indics match of a molecule and its fragments, convert the itp files of the fragments to the molecule to use.
 # @author Hugh Gao, hugh8505@gmail.com
 # @version 0.1alpa
 # @date 2012-04-21
 import os
-import moltoolkit
+import re
+from collections import OrderedDict
+
+import numpy
+
+from gromacs.fileformats import topstore
+
+# sections with atom columns: number of atom columns, whether the ends are swapped to put the lower index first
+SECTIONS = {
+    'bonds': (2, True),
+    'pairs': (2, True),
+    'angles': (3, True),
+    'dihedrals': (4, False),
+    'exclusions': (2, True),
+}
+
+# output blocks: (section, occurrence in the fragment topology) and their header
+HEADERS = OrderedDict([
+    (('bonds', 0), '[ bonds ]\n;  ai   aj  funct   c0         c1\n'),
+    (('pairs', 0), '[ pairs ]\n;  ai   aj  funct  ;  all 1-4 pairs but the ones excluded in GROMOS itp\n'),
+    (('angles', 0), '[ angles ]\n;  ai   aj   ak  funct   angle     fc\n'),
+    (('dihedrals', 0), '[ dihedrals ]\n; GROMOS improper dihedrals\n;  ai   aj   ak   al  funct   angle     fc\n'),
+    (('dihedrals', 1), '[ dihedrals ]\n;  ai   aj   ak   al  funct    ph0      cp     mult\n'),
+    (('exclusions', 0), '[ exclusions ]\n;  ai   aj  funct  ;  GROMOS 1-4 exclusions\n'),
+])
+
+# marker of the atoms which are not in the molecule
+UNMATCHED = '%%'
+
+# AMBER units of a topology store to GROMACS, with the factors of acpype so that the lines are the ones of its itp
+CAL = 4.184
+RAD_PI = 57.295780
+# store terms: (section, occurrence), store array prefix, line format after the atoms, function of the store giving the columns
+STORE_TERMS = [
+    (('bonds', 0), 'bond', ' %6i %13.4e %13.4e', lambda s: (1, s['bond_req'] * 0.1, s['bond_kb'] * 200 * CAL)),
+    (('pairs', 0), 'pair', ' %6i', lambda s: (1,)),
+    (('angles', 0), 'angle', ' %6i %13.4e %13.4e',
+     lambda s: (1, s['angle_theta'] * RAD_PI, s['angle_ktheta'] * 2 * CAL)),
+    # as acpype -r: propers as funct 9, impropers and propers of phase other than 0 or 180 degrees as funct 4
+    (('dihedrals', 1), 'dihedral', ' %6i %8.2f %9.5f %3i',
+     lambda s: (numpy.where(s['dihedral_improper'] | ~numpy.isin((s['dihedral_phase'] * RAD_PI).astype(int), (0, 180)), 4, 9),
+                s['dihedral_phase'] * RAD_PI,
+                s['dihedral_kphi'] * CAL, s['dihedral_period'])),
+]
+
+SECTION = re.compile(r'^\s*\[\s*(?P<name>\S+)\s*\]')
+# the atom columns at the start of a line, by number of atoms
+ATOMS = dict((n, re.compile(r'\s*' + r'(\S+)\s+' * (n - 1) + r'(\S+)')) for n in set(n for n, swap in SECTIONS.values()))
+
+
+def read_store(filename):
+    '''Read the bonded terms of a topology store saved by acpype (.tps, see gromacs.fileformats.topstore) as the sections of its itp.
+
+    Return a dict as read_sections; atoms are numbered by their id in the store, the lines are written as by acpype.
+    '''
+    store = topstore.load(filename)
+    ids = numpy.asarray(store['atom_ids'])
+    sections = {}
+    for key, name, fmt, columns in STORE_TERMS:
+        atoms = ids[store[name + '_atoms']]
+        if not len(atoms):
+            continue
+        columns = [numpy.broadcast_to(c, len(atoms)).tolist() for c in columns(store)]
+        tails = [fmt % row for row in zip(*columns)]
+        lines = [' '.join('%6i' % i for i in row) + tail for row, tail in zip(atoms.tolist(), tails)]
+        sections[key] = (atoms, tails, lines)
+    return sections
+
+
+def read_sections(filename):
+    '''Read the sections with atom columns of a topology, a topology store (.tps) is read with read_store.
+
+    Return a dict of (section, occurrence): (atoms, tails, lines). atoms is an int array of shape (n, number of atom columns), tails the rest of each line after the atoms and lines the original lines.
+    '''
+    if filename.endswith('.tps'):
+        return read_store(filename)
+    sections = {}
+    counts = {}
+    key = None
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            match = SECTION.match(line)
+            if match:
+                name = match.group('name')
+                if name in SECTIONS:
+                    key = (name, counts.get(name, 0))
+                    counts[name] = key[1] + 1
+                    sections[key] = ([], [], [])
+                else:
+                    key = None
+                continue
+            if key is None or not line[:1].isdigit():
+                continue
+            match = ATOMS[SECTIONS[key[0]][0]].match(line)
+            atoms, tails, lines = sections[key]
+            atoms.append(match.groups())
+            tails.append(line[match.end():])
+            lines.append(line)
+    return dict((key, (numpy.array(atoms, dtype=int).reshape(-1, SECTIONS[key[0]][0]), tails, lines))
+                for key, (atoms, tails, lines) in sections.items())
+
+
+def remap(atoms, lookup, swap_ends):
+    '''Map the fragment atom indices of all the atom columns to the molecule in one take, -1 for the atoms out of the molecule.
+
+    If swap_ends, the columns of the terms whose ends are both matched are reversed to put the lower index first.
+    '''
+    mapped = numpy.full(atoms.shape, -1, dtype=int)
+    inside = (atoms >= 0) & (atoms < len(lookup))
+    mapped[inside] = lookup[atoms[inside]]
+    if swap_ends and len(mapped):
+        swap = (mapped[:, 0] >= 0) & (mapped[:, -1] >= 0) & (mapped[:, 0] > mapped[:, -1])
+        mapped[swap] = mapped[swap, ::-1]
+    return mapped
+
+
+def merge_fragments(fragments, types):
+    '''Remap the sections of several fragments to the molecule and merge them.
+
+    fragments is a list of (topology file, [(molecule index, fragment index), ...]), types an array of the atom type of each molecule atom indexed by its index, with UNMATCHED last.
+    Terms of several fragments on the same matched atoms are taken from the first fragment which has them, all its lines
+    on these atoms are kept (e.g. a multi-term proper dihedral). Return a dict of (section, occurrence): list of output lines sorted by the atoms.
+    '''
+    merged = OrderedDict((key, []) for key in HEADERS)
+    for top, matches in fragments:
+        itpname = os.path.basename(top)
+        matches = numpy.array(matches, dtype=int).reshape(-1, 2)
+        lookup = numpy.full(matches[:, 1].max() + 1, -1, dtype=int)
+        lookup[matches[:, 1]] = matches[:, 0]
+        for key, (atoms, tails, lines) in read_sections(top).items():
+            mapped = remap(atoms, lookup, SECTIONS[key[0]][1])
+            merged.setdefault(key, []).append((mapped, tails, lines, itpname))
+
+    result = OrderedDict()
+    for key, parts in merged.items():
+        if not parts:
+            result[key] = []
+            continue
+        mapped = numpy.concatenate([part[0] for part in parts])
+        tails = sum([part[1] for part in parts], [])
+        lines = sum([part[2] for part in parts], [])
+        itpnames = sum([[part[3]] * len(part[1]) for part in parts], [])
+        fragment = numpy.repeat(numpy.arange(len(parts)), [len(part[1]) for part in parts])
+        # drop the terms of the later fragments on atoms matched before; all the terms of the first fragment on
+        # the atoms are kept, e.g. the several lines of a multi-term proper dihedral
+        keep = numpy.ones(len(mapped), dtype=bool)
+        full = numpy.flatnonzero((mapped >= 0).all(axis=1))
+        if len(full):
+            inverse = numpy.unique(mapped[full], axis=0, return_inverse=True)[1].ravel()
+            owner = numpy.full(inverse.max() + 1, len(parts))
+            numpy.minimum.at(owner, inverse, fragment[full])
+            keep[full] = fragment[full] == owner[inverse]
+        order = numpy.flatnonzero(keep)
+        order = order[numpy.lexsort(mapped[order].T[::-1])]
+        atoms = numpy.where(mapped >= 0, mapped.astype(str), UNMATCHED)
+        atom_types = types[mapped]
+        result[key] = [''.join(atom.rjust(5) for atom in atoms[i]) + tails[i] + '\t\t;' +
+                       ' '.join(atype.ljust(3) for atype in atom_types[i]) + ' ' + itpnames[i] + '  ' + lines[i]
+                       for i in order.tolist()]
+    return result
 
 
 def main():
     import argparse
-    parser = argparse.ArgumentParser(description='According the indics match of a molecule and its fragment, convert the itp file of fragment to molecule to use.')
+    import moltoolkit
+    parser = argparse.ArgumentParser(description='According the indics match of a molecule and its fragments, convert the itp files of the fragments to the molecule to use.')
     parser.add_argument('-m', '--molfile', required=True, help='Molecule file')
-    parser.add_argument('-f', '--fragmol', required=True, help='The molecule file containing fragment.')
-    parser.add_argument('-t', '--top', required=True, help='The topology file of the fragment')
-    parser.add_argument('-p', '--pairs', help='Optional. The match pairs of atoms indices in the whole atoms and its fragment, optional. Please give a string whose format is python list. e.g. [(1, 2), (4, 5)]. If you do not assign, the program will calculate it. ')
+    parser.add_argument('-f', '--fragmol', required=True, nargs='+', help='The molecule files containing the fragments.')
+    parser.add_argument('-t', '--top', required=True, nargs='+', help='The topology files of the fragments (itp, or topology store .tps saved by acpype), in the order of the fragment molecule files')
+    parser.add_argument('-p', '--pairs', nargs='+', help='Optional. The match pairs of atoms indices in the whole atoms and its fragment, one for each fragment. Please give a string whose format is python list. e.g. [(1, 2), (4, 5)]. If you do not assign, the program will calculate it. ')
     parser.add_argument('-o', '--output', required=True, help='Output file')
     args = parser.parse_args()
 
-    itpname = os.path.basename(args.top)
-    mol = moltoolkit.Mol(args.molfile)
-    if args.pairs:
-        matches = eval(args.pairs)
-    else:
-        matches = mol.get_matches_of_mols(moltoolkit.Mol(args.fragmol))
-
-    if len(matches) == 0:
-        print("Error: The small molecule is not a fragment of the molecule.")
-        exit(1)
-    matches_dict = {}
-    for (i, j) in matches:
-        matches_dict[j] = i
-
-    # handle topology file
-    with open(args.top) as f:
-        content = f.readlines()
-    for idx in range(len(content)):
-        content[idx] = content[idx].strip()
-    if not content.index('[ bonds ]') < content.index('[ pairs ]') < content.index('[ angles ]') < content.index('[ dihedrals ]') < content.index('[ exclusions ]'):
-        print("The order of sections in topology file is not correct. It should be bond, pairs, angles, dihedrals, exclusions.")
+    if len(args.top) != len(args.fragmol) or (args.pairs and len(args.pairs) != len(args.top)):
+        print("Error: Give one topology file (and match pairs) for each fragment.")
         exit(1)
-    # get bonds
-    bonds = content[content.index('[ bonds ]'):content.index('[ pairs ]')]
-    # get pairs
-    pairs = content[content.index('[ pairs ]'):content.index('[ angles ]')]
-    # get angles
-    angles = content[content.index('[ angles ]'):content.index('[ dihedrals ]')]
-    # get dihedrals
-    first_dihe = content.index('[ dihedrals ]')
-    #second_dihe = content.index(r'[ dihedrals ]', first_dihe + len(r'[ dihedrals ]'), -1)
-    second_dihe = content.index(r'[ dihedrals ]', first_dihe + 1, -1)
-    dihedrals = content[first_dihe:second_dihe]
-    # get second dihedrals
-    dihedrals1 = content[second_dihe:content.index('[ exclusions ]')]
-    # get exclusions
-    exclusions = content[content.index('[ exclusions ]'):]
-
-    # handle bonds
-    bond_result = []
-    for idx, bond in enumerate(bonds):
-        bond_split = bond.split()
-        if len(bond_split) == 0 or not bond_split[0].isdecimal():
-            continue
-        atom0 = matches_dict.get(int(bond_split[0]), '%%')
-        atom1 = matches_dict.get(int(bond_split[1]), '%%')
-        if atom0 == '%%' or atom1 == '%%' or atom0 < atom1:
-            part1 = str(atom0).rjust(5)
-            part2 = str(atom1).rjust(5)
-            type1 = mol.get_atom(atom0).type if isinstance(atom0, int) else "%%"
-            type2 = mol.get_atom(atom1).type if isinstance(atom1, int) else "%%"
-        else:
-            part1 = str(atom1).rjust(5)
-            part2 = str(atom0).rjust(5)
-            type1 = mol.get_atom(atom1).type if isinstance(atom1, int) else "%%"
-            type2 = mol.get_atom(atom0).type if isinstance(atom0, int) else "%%"
-        # find the second atom from the third column
-        part3 = bond[bond.index(bond_split[1], 3) + len(bond_split[1]):]
-        bond_result.append(part1 + part2 + part3 + "\t\t;" + type1.ljust(3) + ' ' + type2.ljust(3) + ' ' + itpname + '  ' + bond)
-    bond_result.sort()
-
-    # handle pairs
-    pair_result = []
-    for idx, pair in enumerate(pairs):
-        pair_split = pair.split()
-        if len(pair_split) == 0 or not pair_split[0].isdecimal():
-            continue
-        atom0 = matches_dict.get(int(pair_split[0]), '%%')
-        atom1 = matches_dict.get(int(pair_split[1]), '%%')
-        if atom0 == '%%' or atom1 == '%%' or atom0 < atom1:
-            part1 = str(atom0).rjust(5)
-            part2 = str(atom1).rjust(5)
-            type1 = mol.get_atom(atom0).type if isinstance(atom0, int) else "%%"
-            type2 = mol.get_atom(atom1).type if isinstance(atom1, int) else "%%"
-        else:
-            part1 = str(atom1).rjust(5)
-            part2 = str(atom0).rjust(5)
-            type1 = mol.get_atom(atom1).type if isinstance(atom1, int) else "%%"
-            type2 = mol.get_atom(atom0).type if isinstance(atom0, int) else "%%"
-        # find the second atom from the third column
-        part3 = pair[pair.index(pair_split[1], 3) + len(pair_split[1]):]
-        pair_result.append(part1 + part2 + part3 + "\t\t;" + type1.ljust(3) + ' ' + type2.ljust(3) + ' ' + itpname + '  ' + pair)
-    pair_result.sort()
-
-    # handle angles
-    angle_result = []
-    for idx, angle in enumerate(angles):
-        angle_split = angle.split()
-        if len(angle_split) == 0 or not angle_split[0].isdecimal():
-            continue
-        atom0 = matches_dict.get(int(angle_split[0]), '%%')
-        atom1 = matches_dict.get(int(angle_split[1]), '%%')
-        atom2 = matches_dict.get(int(angle_split[2]), '%%')
-        if atom0 == '%%' or atom2 == '%%' or atom0 < atom2:
-            part1 = str(atom0).rjust(5)
-            part3 = str(atom2).rjust(5)
-            type1 = mol.get_atom(atom0).type if isinstance(atom0, int) else "%%"
-            type3 = mol.get_atom(atom2).type if isinstance(atom2, int) else "%%"
-        else:
-            part1 = str(atom2).rjust(5)
-            part3 = str(atom0).rjust(5)
-            type1 = mol.get_atom(atom2).type if isinstance(atom2, int) else "%%"
-            type3 = mol.get_atom(atom0).type if isinstance(atom0, int) else "%%"
-        part2 = str(atom1).rjust(5)
-        type2 = mol.get_atom(atom1)
-        # find the second atom from the eight column
-        part4 = angle[angle.index(angle_split[2], 8) + len(angle_split[2]):]
-        angle_result.append(part1 + part2 + part3 + part4 + "\t\t;" + type1.ljust(3) + ' ' + type2.ljust(3) + ' ' + type3.ljust(3) + ' ' + itpname + '  ' + angle)
-    angle_result.sort()
-
-    # handle dihedrals
-    dihedral_result = []
-    for idx, dihedral in enumerate(dihedrals):
-        dihedral_split = dihedral.split()
-        if len(dihedral_split) == 0 or not dihedral_split[0].isdecimal():
-            continue
-        atom0 = matches_dict.get(int(dihedral_split[0]), '%%')
-        atom1 = matches_dict.get(int(dihedral_split[1]), '%%')
-        atom2 = matches_dict.get(int(dihedral_split[2]), '%%')
-        atom3 = matches_dict.get(int(dihedral_split[3]), '%%')
-        part1 = str(atom0).rjust(5)
-        part2 = str(atom1).rjust(5)
-        part3 = str(atom2).rjust(5)
-        part4 = str(atom3).rjust(5)
-        type1 = mol.get_atom(atom0).type if isinstance(atom0, int) else "%%"
-        type2 = mol.get_atom(atom1).type if isinstance(atom1, int) else "%%"
-        type3 = mol.get_atom(atom2).type if isinstance(atom2, int) else "%%"
-        type4 = mol.get_atom(atom3).type if isinstance(atom3, int) else "%%"
-        # find the second atom from the thirteen column
-        part5 = dihedral[dihedral.index(dihedral_split[3], 13) + len(dihedral_split[3]):]
-        dihedral_result.append(part1 + part2 + part3 + part4 + part5 + "\t\t;" + type1.ljust(3) + ' ' + type2.ljust(3) + ' ' + type3.ljust(3) + ' ' + type4.ljust(3) + ' ' + itpname + '  ' + dihedral)
-    dihedral_result.sort()
-
-    # handle dihedral1s
-    dihedral1_result = []
-    for idx, dihedral1 in enumerate(dihedrals1):
-        dihedral1_split = dihedral1.split()
-        if len(dihedral1_split) == 0 or not dihedral1_split[0].isdecimal():
-            continue
-        atom0 = matches_dict.get(int(dihedral1_split[0]), '%%')
-        atom1 = matches_dict.get(int(dihedral1_split[1]), '%%')
-        atom2 = matches_dict.get(int(dihedral1_split[2]), '%%')
-        atom3 = matches_dict.get(int(dihedral1_split[3]), '%%')
-        part1 = str(atom0).rjust(5)
-        part2 = str(atom1).rjust(5)
-        part3 = str(atom2).rjust(5)
-        part4 = str(atom3).rjust(5)
-        type1 = mol.get_atom(atom0).type if isinstance(atom0, int) else "%%"
-        type2 = mol.get_atom(atom1).type if isinstance(atom1, int) else "%%"
-        type3 = mol.get_atom(atom2).type if isinstance(atom2, int) else "%%"
-        type4 = mol.get_atom(atom3).type if isinstance(atom3, int) else "%%"
-        # find the second atom from the thirteen column
-        part5 = dihedral1[dihedral1.index(dihedral1_split[3], 13) + len(dihedral1_split[3]):]
-        dihedral1_result.append(part1 + part2 + part3 + part4 + part5 + "\t\t;" + type1.ljust(3) + ' ' + type2.ljust(3) + ' ' + type3.ljust(3) + ' ' + type4.ljust(3) + ' ' + itpname + '  ' + dihedral1)
-    dihedral1_result.sort()
-
-    # handle exclusions
-    exclusion_result = []
-    for idx, exclusion in enumerate(exclusions):
-        exclusion_split = exclusion.split()
-        if len(exclusion_split) == 0 or not exclusion_split[0].isdecimal():
-            continue
-        atom0 = matches_dict.get(int(exclusion_split[0]), '%%')
-        atom1 = matches_dict.get(int(exclusion_split[1]), '%%')
-        if atom0 == '%%' or atom1 == '%%' or atom0 < atom1:
-            part1 = str(atom0).rjust(5)
-            part2 = str(atom1).rjust(5)
-            type1 = mol.get_atom(atom0).type if isinstance(atom0, int) else "%%"
-            type2 = mol.get_atom(atom1).type if isinstance(atom1, int) else "%%"
+    mol = moltoolkit.Mol(args.molfile)
+    fragments = []
+    for idx, (fragmol, top) in enumerate(zip(args.fragmol, args.top)):
+        if args.pairs:
+            matches = eval(args.pairs[idx])
         else:
-            part1 = str(atom1).rjust(5)
-            part2 = str(atom0).rjust(5)
-            type1 = mol.get_atom(atom1).type if isinstance(atom1, int) else "%%"
-            type2 = mol.get_atom(atom0).type if isinstance(atom0, int) else "%%"
-        # find the second atom from the third column
-        part3 = exclusion[exclusion.index(exclusion_split[1], 3) + len(exclusion_split[1]):]
-        exclusion_result.append(part1 + part2 + part3 + "\t\t;" + type1.ljust(3) + '\t' + type2.ljust(3) + '\t' + itpname + '  ' + exclusion)
-    exclusion_result.sort()
+            matches = mol.get_matches_of_mols(moltoolkit.Mol(fragmol))
+        if len(matches) == 0:
+            print("Error: The small molecule {0} is not a fragment of the molecule.".format(fragmol))
+            exit(1)
+        fragments.append((top, matches))
+
+    # atom types of the matched atoms, indexed by the molecule atom index; the last one for unmatched atoms
+    matched = sorted(set(i for top, matches in fragments for (i, j) in matches))
+    types = numpy.array([UNMATCHED] * (matched[-1] + 2), dtype=object)
+    types[matched] = [mol.get_atom(i).type for i in matched]
 
     # output
     with open(args.output, 'w') as fw:
-        # bonds
-        fw.write('[ bonds ]\n;  ai   aj  funct   c0         c1\n')
-        for i in bond_result:
-            fw.write(i + '\n')
-        # pairs
-        fw.write('[ pairs ]\n;  ai   aj  funct  ;  all 1-4 pairs but the ones excluded in GROMOS itp\n')
-        for i in pair_result:
-            fw.write(i + '\n')
-        # angles
-        fw.write('[ angles ]\n;  ai   aj   ak  funct   angle     fc\n')
-        for i in angle_result:
-            fw.write(i + '\n')
-        # dihedral
-        fw.write('[ dihedrals ]\n; GROMOS improper dihedrals\n;  ai   aj   ak   al  funct   angle     fc\n')
-        for i in dihedral_result:
-            fw.write(i + '\n')
-        # dihedral1
-        fw.write('[ dihedrals ]\n;  ai   aj   ak   al  funct    ph0      cp     mult\n')
-        for i in dihedral1_result:
-            fw.write(i + '\n')
-        # exclusion
-        fw.write('[ exclusions ]\n;  ai   aj  funct  ;  GROMOS 1-4 exclusions\n')
-        for i in exclusion_result:
-            fw.write(i + '\n')
+        for key, lines in merge_fragments(fragments, types).items():
+            fw.write(HEADERS.get(key, '[ {0} ]\n'.format(key[0])))
+            for i in lines:
+                fw.write(i + '\n')
 
 if __name__ == '__main__':
     main()
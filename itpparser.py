@@ -54,100 +54,258 @@ DRG      3
 ;  ai   aj  funct  ;  GROMOS 1-4 exclusions
     2   10		;1.itp  7   12
     2   11		;1.itp  7   15
+
+Usage::
+
+    with open('lig.itp') as f:
+        itp = ItpParser(f)
+    bonds = itp['bonds'][0].data          # ai, aj, funct, params
+    charges = itp['atoms'][0].data.charge
+    itp.write('lig_new.itp')
+
+The file is read in one pass. The known sections ([ atoms ], [ bonds ],
+[ pairs ], [ angles ], [ dihedrals ], [ exclusions ]) are converted to
+numpy record arrays column by column, other sections keep their lines as
+lists of tokens. Inline comments, the column header and full-line
+comments (or preprocessor lines) inside a section are kept apart from
+the data, and to_itp() writes them back at their place.
 '''
 import re
-from collections import OrderedDict
+import warnings
+
+import numpy
+
+# number of atom columns of the term sections
+TERMS = {'bonds': 2, 'pairs': 2, 'angles': 3, 'dihedrals': 4}
+ATOM_NAMES = ('ai', 'aj', 'ak', 'al')
+
+
+class ItpSection:
+    '''One [ section ] of a topology file.
+
+    Attributes:
+        name: section name
+        header: column header comment, the comment line right after [ name ], or ''
+        data: record array for a known section, list of token lists otherwise
+        comments: inline comment of every data line, without ';', or ''
+        notes: (data line index, line) of full-line comments and preprocessor lines, written before that data line
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.header = ''
+        self.data = []
+        self.comments = []
+        self.notes = []
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return '<ItpSection [ %s ] with %d lines>' % (self.name, len(self))
+
+    def _convert(self):
+        '''Convert the data lines to a record array for a known section, to token lists otherwise.'''
+        contents = self.data
+        try:
+            if self.name == 'atoms':
+                self.data = self._atoms([content.split() for content in contents])
+            elif self.name in TERMS:
+                self.data = self._terms(contents, TERMS[self.name])
+            elif self.name == 'exclusions':
+                self.data = self._exclusions(contents)
+            else:
+                self.data = [content.split() for content in contents]
+        except (IndexError, ValueError) as err:
+            raise ValueError('Can not parse [ %s ]: %s' % (self.name, err))
+
+    @staticmethod
+    def _table(contents):
+        '''Numbers of the data lines as a float array padded with nan, and the number of columns of every line.
+        The numbers are read by numpy in one call and the columns counted on the bytes of the text;
+        None if some column is not a number.'''
+        text = '\n'.join(contents)
+        chars = numpy.frombuffer(text.encode(), dtype=numpy.uint8)
+        blank = (chars == 32) | (chars == 9) | (chars == 10) | (chars == 13)
+        starts = ~blank
+        starts[1:] &= blank[:-1]
+        rows = numpy.cumsum(chars == 10)[starts]
+        counts = numpy.bincount(rows, minlength=len(contents))
+        with warnings.catch_warnings():
+            warnings.simplefilter('error', DeprecationWarning)
+            try:
+                values = numpy.fromstring(text, sep=' ')
+            except (ValueError, DeprecationWarning):
+                return None, counts
+        if len(values) != counts.sum():
+            return None, counts
+        table = numpy.full((len(contents), counts.max() if len(counts) else 0), numpy.nan)
+        offsets = numpy.cumsum(counts) - counts
+        table[rows, numpy.arange(len(values)) - offsets[rows]] = values
+        return table, counts
+
+    @staticmethod
+    def _atoms(rows):
+        '''nr, type, resnr, residue, atom, cgnr, charge, mass (nan if missing) and the rest of the columns as text'''
+        if any(len(row) < 7 for row in rows):
+            raise ValueError('less than 7 columns')
+        columns = list(zip(*[row[:7] for row in rows])) or [()] * 7
+        mass = [row[7] if len(row) > 7 else 'nan' for row in rows]
+        rest = [' '.join(row[8:]) for row in rows]
+        return numpy.rec.fromarrays(
+            [numpy.array(columns[0], dtype=int), numpy.array(columns[1], dtype=str),
+             numpy.array(columns[2], dtype=int), numpy.array(columns[3], dtype=str),
+             numpy.array(columns[4], dtype=str), numpy.array(columns[5], dtype=int),
+             numpy.array(columns[6], dtype=float), numpy.array(mass, dtype=float),
+             numpy.array(rest, dtype=str)],
+            names='nr,type,resnr,residue,atom,cgnr,charge,mass,rest')
+
+    @classmethod
+    def _terms(cls, contents, natoms):
+        '''atom indices and funct as ints, parameters as a float array padded with nan
+        (as strings padded with '' if some are macros)'''
+        table, counts = cls._table(contents)
+        if (counts <= natoms).any():
+            raise ValueError('no funct column')
+        if table is None:
+            rows = [content.split() for content in contents]
+            indices = numpy.array([row[:natoms + 1] for row in rows], dtype=int).reshape(-1, natoms + 1)
+            nparams = counts.max() - natoms - 1
+            values = numpy.array([row[natoms + 1:] + [''] * (nparams - len(row) + natoms + 1) for row in rows],
+                                 dtype=str).reshape(-1, nparams)
+        else:
+            if not len(contents):
+                table = numpy.zeros((0, natoms + 1))
+            indices = table[:, :natoms + 1].astype(int)
+            values = table[:, natoms + 1:]
+        names = ATOM_NAMES[:natoms] + ('funct',)
+        data = numpy.zeros(len(contents), dtype=[(name, int) for name in names] +
+                           [('params', values.dtype, (values.shape[1],))])
+        for k, name in enumerate(names):
+            data[name] = indices[:, k]
+        data['params'] = values
+        return data.view(numpy.recarray)
+
+    @classmethod
+    def _exclusions(cls, contents):
+        '''atom indices padded with 0'''
+        table, counts = cls._table(contents)
+        if table is None:
+            raise ValueError('atom indices must be integers')
+        data = numpy.zeros(len(contents), dtype=[('atoms', int, (table.shape[1],))])
+        data['atoms'] = numpy.where(numpy.isnan(table), 0, table).astype(int)
+        return data.view(numpy.recarray)
+
+    def _lines(self):
+        '''data lines without their comments'''
+        data = self.data
+        if self.name == 'atoms':
+            return [('%6d %10s %6d %6s %6s %6d %10.10g' % row[:7] + ('' if row[7] != row[7] else ' %10.10g' % row[7]) +
+                     (' ' + row[8] if row[8] else ''))
+                    for row in data.tolist()]
+        if self.name in TERMS:
+            natoms = TERMS[self.name]
+            fmt = '%5d' * (natoms + 1)
+            if data['params'].dtype.kind == 'f':
+                return [fmt % row[:-1] + ''.join(['  %.10g' % v for v in row[-1] if v == v])
+                        for row in data.tolist()]
+            return [fmt % row[:-1] + ''.join(['  %s' % v for v in row[-1] if v]) for row in data.tolist()]
+        if self.name == 'exclusions':
+            return [''.join(['%5d' % i for i in atoms if i]) for atoms in data['atoms'].tolist()]
+        return ['  '.join(row) for row in data]
+
+    def to_itp(self):
+        '''Text of the section, from [ name ] on.'''
+        out = ['[ %s ]' % self.name]
+        if self.header:
+            out.append(self.header)
+        notes = {}
+        for index, line in self.notes:
+            notes.setdefault(index, []).append(line)
+        for index, (line, comment) in enumerate(zip(self._lines(), self.comments)):
+            if index in notes:
+                out.extend(notes[index])
+            out.append(line + ' ; ' + comment if comment else line)
+        out.extend(notes.get(len(self), []))
+        return '\n'.join(out) + '\n'
 
 
 class ItpParser:
     '''Parser the topology file of gromacs.'''
+    SECTION = re.compile(r'^\s*\[\s*(?P<header>[^\]\s]+)\s*\]')
+
     def __init__(self, fp):
         '''Initialize.
 
-        @param itp itp file-like object.
+        @param fp itp file-like object.
+        @raise ValueError if there are data before the first section or a known section can not be parsed.
         '''
         self._file = fp
         # The delimiter of the comment from beginning of the line or inline.
         self._delimiter = ';'
-
-        # The lines in the sections, exclude comment lines
-        self._sections_line = OrderedDict()
-        # The section header comment, e.g.  ;  nr  type  resnr  resid  atom  cgnr  charge    mass    total_charge
-        self._sections_header = OrderedDict()
-        # The items in every lines such as 2, 3, 2, 3.25e+5
-        self._sections_items = OrderedDict()
-        # The inline comment in every line in section
-        self._sections_comments = OrderedDict()
         # The comments in the header of the file
-        self._header_comment = []
-
+        self.header_comment = []
+        # The sections in the order of the file, a name may repeat (e.g. [ dihedrals ])
+        self.sections = []
 
         self._read()
-        self._splitItems()
 
     def _read(self):
-        '''Parser the topology file.
-        '''
-        sec_re = r'^\[ (?P<header>[^ ]+) \]'
-        sec_re_obj = re.compile(sec_re)
-        current_sec = None
-        header_comment = False
-        for lineno, line in enumerate(self._file, start=1):
-            # Handle header comments.
-            if (lineno == 1 or header_comment) and line.rstrip().startswith(self._delimiter):
-                header_comment = True
-                self._header_comment.append(line.rstrip())
+        '''Parser the topology file.'''
+        section = None
+        for line in self._file:
+            line = line.rstrip()
+            stripped = line.lstrip()
+            if not stripped:
                 continue
-            else:
-                header_comment = False
-
             # Handle [ moleculetype ], [ bond ], [ angles ], [ dihedrals ], [ dihedrals ], [ exclusions ]
-            match = sec_re_obj.match(line.rstrip())
-            if match != None:
-                current_sec = match.group('header')
-                self._sections_line[current_sec] = []
-                sec_lineno = lineno
-                continue
-            if current_sec == None:
-                print("The first line no comments should be a secion like [ header ].")
-                exit(1)
-            else:
-                if line.rstrip().startswith(self._delimiter):
+            if stripped[0] == '[':
+                match = self.SECTION.match(line)
+                if match is not None:
+                    section = ItpSection(match.group('header'))
+                    self.sections.append(section)
+                    continue
+            if section is None:
+                if stripped[0] not in (self._delimiter, '#'):
+                    raise ValueError('The first line no comments should be a section like [ header ].')
+                self.header_comment.append(line)
+            elif stripped[0] in (self._delimiter, '#'):
+                if stripped[0] == self._delimiter and not (section.data or section.notes or section.header):
                     # Record the sections header
-                    if lineno == sec_lineno + 1:
-                        self._sections_header[current_sec] = line.rstrip()
-                else:
-                    self._sections_line[current_sec].append(line.rstrip())
-        print(self._sections_line)
-        print(self._sections_header)
-
-    def _splitItems(self):
-        '''Split the lines in every section into items.'''
-        for sec in self._sections_line.keys():
-            self._sections_comments[sec] = []
-            self._sections_items[sec] = []
-            for line in self._sections_line[sec]:
-                comment_idx = line.find(self._delimiter) 
-                if comment_idx != -1:
-                    self._sections_comments[sec].append(line[comment_idx:])
+                    section.header = line
                 else:
-                    self._sections_comments[sec].append('')
-                content = line[:comment_idx]
-                self._sections_items[sec].append(content.split())
-        print(self._sections_items)
-        print(self._sections_comments)
+                    section.notes.append((len(section.data), line))
+            else:
+                content, _, comment = line.partition(self._delimiter)
+                section.data.append(content)
+                section.comments.append(comment.strip())
+        for section in self.sections:
+            section._convert()
+
+    def __getitem__(self, name):
+        '''The sections named name, in order.'''
+        return [section for section in self.sections if section.name == name]
+
+    def to_itp(self):
+        '''Text of the topology file.'''
+        out = ['\n'.join(self.header_comment) + '\n'] if self.header_comment else []
+        out += [section.to_itp() for section in self.sections]
+        return '\n'.join(out)
 
+    def write(self, filename):
+        '''Write the topology to filename.'''
+        with open(filename, 'w') as f:
+            f.write(self.to_itp())
 
 
 def __main__():
     import argparse
-    parser = argparse.ArgumentParser(description='According the indics match of a molecule and its fragment, convert the itp file of fragment to molecule to use.')
-    parser.add_argument('-t', '--top', required=True, help='The topology file of the fragment')
+    parser = argparse.ArgumentParser(description='Parse a topology file and write it back in a normalised layout.')
+    parser.add_argument('-t', '--top', required=True, help='The topology file')
     parser.add_argument('-o', '--output', required=True, help='Output file')
     args = parser.parse_args()
-    if args.top:
-        f = open(args.top)
+    with open(args.top) as f:
         itpParser = ItpParser(f)
+    itpParser.write(args.output)
 
 if __name__ == '__main__':
     __main__()
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+'''
+Write the index file of a system without grompp and make_ndx: the default groups of make_ndx plus the groups given
+in the make_ndx syntax, e.g.
+
+    make_index.py -f pdb.gro -p system.top -o system.ndx "r SOL|r NA|r CL" "t HW|t OW"
+
+The topology is only needed for atom type (t) groups. The groups are always in the same order.
+'''
+import argparse
+import sys
+
+from gromacs import indexgroups
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write the default index groups and make_ndx style groups.')
+    parser.add_argument('-f', dest='coordinates', required=True, help='coordinate file, gro or pdb')
+    parser.add_argument('-p', dest='top', help='topology file, for the atom types')
+    parser.add_argument('-I', dest='includedirs', action='append', default=[], help='include directory of the topology')
+    parser.add_argument('-o', dest='output', default='index.ndx', help='output index file')
+    parser.add_argument('groups', nargs='*', help='groups in the make_ndx syntax, e.g. "r SOL|r NA"')
+    args = parser.parse_args()
+
+    try:
+        atoms = indexgroups.SystemAtoms.read(args.coordinates, args.top, args.includedirs)
+        groups = indexgroups.default_groups(atoms.resnames)
+        groups.update(indexgroups.select(atoms, args.groups))
+    except (IOError, ValueError, SyntaxError) as e:
+        sys.exit('make_index.py: {0}'.format(e))
+    indexgroups.write(args.output, groups)
+    for nr, (name, atomnumbers) in enumerate(groups.items()):
+        print('%3d %-20s: %6d atoms' % (nr, name, len(atomnumbers)))
+
+
+if __name__ == '__main__':
+    main()
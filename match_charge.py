@@ -14,46 +14,87 @@
 # @detail
 #
 ##############################################################################
-from decimal import Decimal
 import argparse
-import moltoolkit
+import hashlib
+import os
+
+import numpy
+
+from gromacs.molgraph import read_molecule, graph_hash, match_atoms
+
+
+def ordered_key(mol):
+    '''Hash of the molecular graph in its atom order: files with the same atom order (e.g. conformers) share the atom mapping'''
+    digest = hashlib.sha1()
+    digest.update(repr(list(mol['elements'])).encode())
+    digest.update(numpy.sort(mol['bonds'], axis=1).tobytes())
+    return digest.hexdigest()
+
+
+def read_charges(filename):
+    '''Charges of a charge file, one per line (or the last column of "index charge" lines), "#" lines are comments'''
+    try:
+        return numpy.loadtxt(filename, comments='#', ndmin=2)[:, -1]
+    except ValueError:
+        print("Fatal Error: The format of the charge file is incorrect.")
+        exit(1)
+
+
+def output_name(target, output, many, ext):
+    '''Charge file of a target: the output file for one target, <output>/<target name><ext> for several'''
+    if not many:
+        return output
+    return os.path.join(output, os.path.splitext(os.path.basename(target))[0] + ext)
 
 
 def main():
-    parser = argparse.ArgumentParser(description='Match the charges between two identical molecule and output the new charge file.\n\nThe format of charge file must be like:\nindex\tcharge\nindex\tcharge\n...', formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument('-1', '--molfile1', required=True, help='The first molecule file')
-    parser.add_argument('-2', '--molfile2', required=True, help='The second molecule file')
+    parser = argparse.ArgumentParser(description='Match the charges between identical molecules and output the new charge files.\n\nThe format of charge file must be like:\ncharge\ncharge\n...\n\nMolecules are read from mol2 or mdl/mol files. The atom mapping is computed once per atom order of the targets, so conformers and copies of the same file are cheap.', formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-1', '--molfile1', required=True, help='The first molecule file, whose charges are given')
+    parser.add_argument('-2', '--molfile2', required=True, nargs='+', help='The molecule files to which the charges are matched')
     parser.add_argument('-c', '--chargefile', required=True, help='Charges file for the first molecule')
-    parser.add_argument('-o', '--output', required=True, help='Output file')
+    parser.add_argument('-o', '--output', required=True, help='Output file, or the output directory when several molecules are given to -2')
     args = parser.parse_args()
 
-    mol = moltoolkit.Mol(args.molfile1)
-    match_idx = mol.getSub(args.molfile2)
+    ref = read_molecule(args.molfile1)
+    charges = read_charges(args.chargefile)
+    if len(charges) != len(ref['elements']):
+        print("Fatal Error: %d charges for %d atoms of %s." % (len(charges), len(ref['elements']), args.molfile1))
+        exit(1)
+    ref_hash = graph_hash(ref['elements'], ref['bonds'])
 
-    if len(match_idx) == 0:
-        print("The two molecules is not identical.")
+    many = len(args.molfile2) > 1
+    ext = os.path.splitext(args.chargefile)[1] or '.txt'
+    # targets of the same name in different directories would write the same charge file
+    outputs = {}
+    for target in args.molfile2:
+        outputs.setdefault(output_name(target, args.output, many, ext), []).append(target)
+    clashes = [targets for targets in outputs.values() if len(set(map(os.path.abspath, targets))) > 1]
+    if clashes:
+        print("Fatal Error: %s would be written to the same charge file, rename them or run them separately." %
+              '; '.join(' and '.join(targets) for targets in clashes))
+        exit(1)
+    if many and not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    mappings = {}
+    failed = False
+    for target in args.molfile2:
+        mol = read_molecule(target)
+        key = ordered_key(mol)
+        if key not in mappings:
+            mapping = None
+            if graph_hash(mol['elements'], mol['bonds']) == ref_hash:
+                try:
+                    mapping = match_atoms(ref['elements'], ref['bonds'], mol['elements'], mol['bonds'])
+                except ValueError:
+                    pass
+            mappings[key] = mapping
+        if mappings[key] is None:
+            print("The molecules %s and %s are not identical." % (args.molfile1, target))
+            failed = True
+            continue
+        numpy.savetxt(output_name(target, args.output, many, ext), charges[mappings[key]], fmt='%6.3f')
+    if failed:
         exit(1)
-    mol1 = {}
-    # 原子计数
-    index = 0
-    with open(args.chargefile) as f:
-        for line in f:
-            charge = line.strip()
-            if charge[0] == '#':
-                continue
-            index += 1
-            try:
-                mol1[index] = round(Decimal(charge), 3)
-            except(Decimal.InvalidOperation):
-                print("Fatal Error: The format of the charge file is incorrect.")
-                exit(1)
-    mol2 = {}
-    for (atom1, atom2) in match_idx:
-        mol2[atom2] = mol1[atom1]
-
-    with open(args.output, 'w') as f:
-        for i in sorted(mol2.keys()):
-            f.write(str(mol2[i]).rjust(6) + '\n')
 
 if __name__ == '__main__':
     main()
@@ -5,12 +5,244 @@
         -t, --top       Generate topology file(.top)
         -c, --command   Generate command file(.top)
         -m, --mdp       Generate mdp file(.mdp)
+        -k, --check     Check topology file(.top) against start pdb
 '''
 
 import configparser
 import argparse
 import os.path
-from collections import OrderedDict
+from collections import OrderedDict, namedtuple
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+
+def _non_negative_int(value):
+    value = int(value)
+    if value < 0:
+        raise ValueError(value)
+    return value
+
+
+def _boolean(value):
+    return value.lower() in ('yes', '1', 'true')
+
+
+def _words(value):
+    return tuple(value.split())
+
+
+def _upper_words(value):
+    return tuple(value.upper().split())
+
+
+def _some_words(value):
+    value = _words(value)
+    if not value:
+        raise ValueError('empty')
+    return value
+
+
+def _ints(value):
+    return tuple(int(i) for i in value.split())
+
+
+def _box(value):
+    value = tuple(float(i) for i in value.split())
+    if len(value) not in (3, 9):
+        raise ValueError(value)
+    return value
+
+
+def _rdf(value):
+    '''
+    The rdf will be parsered as:
+        [[{id:type,...}, {id:type, ...}], ...]
+        id is a sign for group, such as HW1, HW2, OW, SDmso etc.
+        type is t or a, t is type for group, a is name for group, e.g. HW1 is one of the names of atom H in spce, and another name is HW2, and the both type is HW.
+        The first () continues groups for rdf analysis. The second () is the only two groups. The dict contains groups will be joined as one group in ndx file.
+    '''
+    rdf = []
+    for pair in value.split(','):
+        groups = []
+        for group in pair.split():
+            ids = OrderedDict()
+            for k in group.split('|'):
+                if k.startswith('a#'):
+                    ids[k[2:]] = 'a'
+                else:
+                    ids[k] = 't'
+            groups.append(ids)
+        if len(groups) > 0:
+            rdf.append(tuple(groups))
+    return tuple(rdf)
+
+
+#: An option of the schema: coerce converts the string of the ini (ValueError if invalid), default is used when the
+#: option is missing (REQUIRED: the option must be given), message is the error for an invalid value.
+Option = namedtuple('Option', 'coerce default message')
+REQUIRED = object()
+
+#: Schema of the sections of configure.ini other than the simulation sections. Options which are not listed are kept
+#: as strings.
+SCHEMA = OrderedDict([
+    ('general', OrderedDict([
+        ('precision', Option(str, REQUIRED, '')),
+        ('nodes', Option(_non_negative_int, REQUIRED, 'The values of the nodes is incorrect.')),
+        ('opt_mpi', Option(_boolean, REQUIRED, '')),
+        ('maxwarn', Option(_non_negative_int, REQUIRED, 'The values of the maxwarn is incorrect.')),
+        ('email', Option(str, '', '')),
+        ('title', Option(str, lambda: os.path.abspath(os.path.curdir)[1:].replace('/', '_'), '')),
+    ])),
+    ('input', OrderedDict([
+        ('forcefield', Option(str, REQUIRED, '')),
+        ('start_pdb', Option(str, REQUIRED, '')),
+        ('top', Option(str, REQUIRED, '')),
+        ('box', Option(_box, REQUIRED, 'The values of box size are incorrect. There must be 3 float values, or 9 for a triclinic box.')),
+        ('center', Option(_boolean, True, '')),
+    ])),
+    ('component', OrderedDict([
+        ('itps', Option(_words, REQUIRED, '')),
+        ('mols_num', Option(_ints, REQUIRED, 'The values of the number of molecule(mols_num) are incorrect. They are must be int.')),
+        ('mols_name', Option(_words, REQUIRED, '')),
+        ('residures', Option(_some_words, REQUIRED, 'The number of residures in system should be bigger than 0')),
+        ('extra_itps', Option(_words, REQUIRED, '')),
+    ])),
+    ('ions', OrderedDict([
+        ('name', Option(_upper_words, REQUIRED, '')),
+        ('num', Option(_ints, REQUIRED, 'The values of ions number are incorrect. They are must be int.')),
+    ])),
+    ('pr', OrderedDict([
+        ('residures', Option(_words, REQUIRED, '')),
+        ('pdbs', Option(_words, REQUIRED, '')),
+        ('itps', Option(_words, REQUIRED, '')),
+    ])),
+    ('md', OrderedDict([
+        ('ems', Option(_some_words, REQUIRED, 'You must supply at least one step of energy minimization in ems option in [md] section.')),
+        ('mds', Option(_some_words, REQUIRED, 'You must supply at least one step of md simulation in mds option in [md] section.')),
+        ('opt_pme_load', Option(str, '0', '')),
+        ('pme_load', Option(str, '0.25', '')),
+    ])),
+    ('analysis', OrderedDict([
+        ('rdf', Option(_rdf, REQUIRED, '')),
+    ])),
+])
+
+#: Options of a section which must have the same number of values.
+SAME_LENGTH = (
+    ('component', ('itps', 'mols_num', 'mols_name'), 'The number of itps, mols_num and mols_name in [component] is not equal.'),
+    ('ions', ('name', 'num'), 'The number of values of ions name and ions num in [ions] is not equal.'),
+    ('pr', ('residures', 'itps', 'pdbs'), 'The number of residures, itps and pdbs in [pr] is not equal.'),
+)
+
+
+def compile_schema(schema):
+    '''Flatten the schema into a tuple of (section, option, coerce, default, message), the order of a loading pass.'''
+    return tuple((section, key) + tuple(option) for section, options in schema.items() for key, option in options.items())
+
+COMPILED_SCHEMA = compile_schema(SCHEMA)
+
+
+def load_sections(parser, compiled=COMPILED_SCHEMA):
+    '''
+    Validate and coerce the schema sections of a ConfigParser in one pass.
+
+    Return: (secs, errors), secs is a dict of section: dict of option: value, errors the list of all the problems found
+    '''
+    secs = {}
+    errors = []
+    for section in SCHEMA:
+        if parser.has_section(section):
+            secs[section] = dict(parser[section].items())
+        else:
+            errors.append('There is no {0} section in ini file.'.format(section))
+    for section, key, coerce, default, message in compiled:
+        if section not in secs:
+            continue
+        options = secs[section]
+        if key not in options:
+            if default is REQUIRED:
+                errors.append('There is no {0} key in {1} section.'.format(key, section))
+            else:
+                options[key] = default() if callable(default) else default
+            continue
+        try:
+            options[key] = coerce(options[key])
+        except ValueError:
+            errors.append(message or 'The value of {0} in [{1}] section is incorrect.'.format(key, section))
+    for section, keys, message in SAME_LENGTH:
+        values = [secs.get(section, {}).get(key) for key in keys]
+        if all(isinstance(value, tuple) for value in values) and len(set(map(len, values))) > 1:
+            errors.append(message)
+    return secs, errors
+
+
+def _freeze(value):
+    if isinstance(value, Mapping):
+        return FrozenConfig(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+def _thaw(value):
+    if isinstance(value, FrozenConfig):
+        return OrderedDict((k, _thaw(v)) for k, v in value.items())
+    if isinstance(value, tuple):
+        return [_thaw(v) for v in value]
+    return value
+
+
+class FrozenConfig(Mapping):
+    '''
+    Immutable and hashable nested mapping of a loaded configuration: mappings are FrozenConfig, lists are tuples.
+
+    Two configurations are equal when they hold the same values, whatever the order of the options in the ini.
+    digest() is a hash of the contents which is stable between runs and machines, to key caches and campaigns on.
+    '''
+    __slots__ = ('_items', '_hash')
+
+    def __init__(self, mapping):
+        self._items = OrderedDict((k, _freeze(v)) for k, v in mapping.items())
+        self._hash = None
+
+    def __getitem__(self, key):
+        return self._items[key]
+
+    def __iter__(self):
+        return iter(self._items)
+
+    def __len__(self):
+        return len(self._items)
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(self._items.items()))
+        return self._hash
+
+    def __eq__(self, other):
+        if not isinstance(other, FrozenConfig):
+            return NotImplemented
+        return self._items == dict(other._items)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return 'FrozenConfig({0!r})'.format(dict(self._items))
+
+    def to_json(self, **kwargs):
+        '''JSON text of the configuration'''
+        import json
+        return json.dumps(_thaw(self), **kwargs)
+
+    def digest(self):
+        '''sha1 hex digest of the JSON text with sorted keys'''
+        import hashlib
+        return hashlib.sha1(self.to_json(sort_keys=True).encode()).hexdigest()
+
 
 
 class ConfigReader(configparser.ConfigParser):
@@ -102,21 +334,12 @@ class ConfigReader(configparser.ConfigParser):
             fail('Error: Key DuplicateKey, please check ini file.' + configparser.DuplicateOptionError.args)
         except:
             fail('Read configuration file Error.')
-        self.__check_ini()
-
-        # get keys and values from every secion
-        secs = ('general', 'input', 'component', 'ions', 'pr', 'md', 'analysis')
-        self.secs = {}
-        for sec in secs:
-            self.secs[sec] = {k: v for (k, v) in self[sec].items()}
-
-        self.__init_general()
-        self.__init_input()
-        self.__init_component()
-        self.__init_ions()
-        self.__init_pr()
-        self.__init_md()
-        self.__init_analysis()
+
+        # get keys and values from every secion, validated and coerced by SCHEMA
+        self.secs, errors = load_sections(self)
+        if errors:
+            fail('\n'.join(errors))
+        self.frozen = None
 
         # simulations
         self.ems = OrderedDict()
@@ -127,127 +350,6 @@ class ConfigReader(configparser.ConfigParser):
                 fail('There is no [{0}] section in ini file. This section is a course in [md] ems values.'.format(md))
             self.__init_simulation(md)
 
-    def __check_ini(self):
-        '''Check the ini file'''
-        # Default sections and keys in every section.
-        secs = {}
-        secs['general'] = ('precision', 'nodes', 'opt_mpi', 'maxwarn')
-        secs['input'] = ('forcefield', 'start_pdb', 'top', 'box')
-        secs['component'] = ('itps', 'mols_num', 'mols_name', 'extra_itps')
-        secs['ions'] = ('name', 'num')
-        secs['pr'] = ('residures', 'itps')
-        secs['md'] = ('ems', 'mds')
-        secs['analysis'] = ('rdf',)
-
-        #检查ini配置文件是否有上述节与键
-        for sec in secs.keys():
-            if not self.has_section(sec):
-                fail('There is no {0} section in ini file.'.format(sec))
-            for key in secs[sec]:
-                if not self.has_option(sec, key):
-                    fail('There is no {0} key in {1} section.'.format(key, sec))
-
-    def __init_general(self):
-        '''Initialize keys in [general]'''
-        try:
-            self.secs['general']['nodes'] = int(self.secs['general']['nodes'])
-            if self.secs['general']['nodes'] < 0:
-                raise ValueError
-        except ValueError:
-            fail('The values of the nodes is incorrect.')
-
-        self.secs['general']['opt_mpi'] = True if self.secs['general']['opt_mpi'].lower() in ('yes', '1', 'true') else False
-
-        try:
-            self.secs['general']['maxwarn'] = int(self.secs['general']['maxwarn'])
-            if self.secs['general']['maxwarn'] < 0:
-                raise ValueError
-        except ValueError:
-            fail('The values of the maxwarn is incorrect.')
-
-        self.secs['general']['email'] = self.secs['general'].get('email', '')
-        self.secs['general']['title'] = self.secs['general'].get('title', os.path.abspath(os.path.curdir)[1:].replace('/', '_'))
-
-    def __init_input(self):
-        '''Initialize keys in [input]'''
-        try:
-            self.secs['input']['box'] = tuple(float(i) for i in self.secs['input']['box'].split())
-        except ValueError:
-            fail('The values of box size are incorrect. They are must be float.')
-        if len(self.secs['input']['box']) != 3:
-            fail('The number of the box size value must be 3.')
-
-    def __init_component(self):
-        '''Initialize keys in [component]'''
-        self.secs['component']['itps'] = tuple(self.secs['component']['itps'].split())
-        try:
-            self.secs['component']['mols_num'] = tuple(int(i) for i in self.secs['component']['mols_num'].split())
-            self.secs['component']['mols_name'] = tuple(i for i in self.secs['component']['mols_name'].split())
-        except ValueError:
-            fail('The values of the number of molecule(mols_num) are incorrect. They are must be int.')
-        if len(self.secs['component']['itps']) != len(self.secs['component']['mols_num']) != len(self.secs['component']['mols_name']):
-            fail('The number of itps, mols_num and mols_name in [component] is not equal.')
-
-        self.secs['component']['residures'] = tuple(self.secs['component']['residures'].split())
-        if len(self.secs['component']['residures']) <= 0:
-            fail('The number of residures in system should be bigger than 0')
-        self.secs['component']['extra_itps'] = tuple(self.secs['component']['extra_itps'].split())
-
-    def __init_ions(self):
-        '''Initialize keys in [component]'''
-        self.secs['ions']['name'] = tuple(self.secs['ions']['name'].upper().split())
-        try:
-            self.secs['ions']['num'] = tuple(int(i) for i in self.secs['ions']['num'].split())
-        except ValueError:
-            fail('The values of ions number are incorrect. They are must be int.')
-
-        if len(self.secs['ions']['name']) != len(self.secs['ions']['num']):
-            fail('The number of values of ions name and ions num in [ions] is not equal.')
-
-    def __init_pr(self):
-        '''Initialize keys in [pr]'''
-        self.secs['pr']['residures'] = tuple(self.secs['pr']['residures'].split())
-        self.secs['pr']['itps'] = tuple(self.secs['pr']['itps'].split())
-        self.secs['pr']['pdbs'] = tuple(self.secs['pr']['pdbs'].split())
-        if len(self.secs['pr']['residures']) != len(self.secs['pr']['itps']) != len(self.secs['pr']['pdbs']):
-            fail('The number of residures, itps and pdbs in [pr] is not equal.')
-
-    def __init_md(self):
-        '''Initialize keys in [md]'''
-        self.secs['md']['ems'] = tuple(self.secs['md']['ems'].split())
-        self.secs['md']['mds'] = tuple(self.secs['md']['mds'].split())
-        if len(self.secs['md']['ems']) == 0:
-            fail('You must supply at least one step of energy minimization in ems option in [md] section.')
-        if len(self.secs['md']['mds']) == 0:
-            fail('You must supply at least one step of md simulation in mds option in [md] section.')
-
-    def __init_analysis(self):
-        '''Initialize options in [analysis]
-
-        The rdf will be parsered as:
-            [[{id:type,...}, {id:type, ...}], ...]
-            id is a sign for group, such as HW1, HW2, OW, SDmso etc.
-            type is t or a, t is type for group, a is name for group, e.g. HW1 is one of the names of atom H in spce, and another name is HW2, and the both type is HW.
-            The first () continues groups for rdf analysis. The second () is the only two groups. The dict contains groups will be joined as one group in ndx file.
-        '''
-        # rdf
-        rdf = []
-        one = [i.split() for i in self.secs['analysis']['rdf'].split(',')]
-        for i in one:
-            inner_1 = []
-            for j in i:
-                two = j.split('|')
-                inner_2 = OrderedDict()
-                for k in two:
-                    if k.startswith('a#'):
-                        inner_2[k[2:]] = 'a'
-                    else:
-                        inner_2[k] = 't'
-                inner_1.append(inner_2)
-            if len(inner_1) > 0:
-                rdf.append(tuple(inner_1))
-        self.secs['analysis']['rdf'] = tuple(rdf)
-
     def __init_simulation(self, section):
         '''
         Initialize sections or simulations in [md] ems and mds values.
@@ -399,6 +501,12 @@ class ConfigReader(configparser.ConfigParser):
         '''Get the dict of molecular simulation sections.'''
         return self.mds
 
+    def freeze(self):
+        '''Get the whole configuration (sections, ems and mds) as a FrozenConfig.'''
+        if self.frozen is None:
+            self.frozen = FrozenConfig(OrderedDict([('sections', self.secs), ('ems', self.ems), ('mds', self.mds)]))
+        return self.frozen
+
 
 class CommandOut:
     '''Output the commands for running simulation'''
@@ -469,10 +577,10 @@ class CommandOut:
                 self.__exec_analysis(i)
 
     def __pdb_conv(self, pdb):
-        '''Output the commands for converting pdb'''
-        editconf = self.__cmd('editconf')
+        '''Output the command for converting pdb to gro in the box'''
         box = ' '.join([str(i) for i in self.secs['input']['box']])
-        self.__write('{0} -f {1} -box {2} -o {3}\n'.format(editconf, pdb, box, self.gro))
+        # pdb2gro.py is a python programm converting pdb without editconf, it must be in the path.
+        self.__write('pdb2gro.py {0} -box {1} -o {2}{3}\n'.format(pdb, box, self.gro, '' if self.secs['input']['center'] else ' -noc'))
 
     def __genion(self):
         '''Output genion commands'''
@@ -507,43 +615,35 @@ class CommandOut:
         self.__write(grompp_cmd + '\n' + genion_cmd + '\n')
 
     def __make_ndx(self, gro):
-        '''Generate index file'''
-        # Generate tpr file
-        grompp = self.__cmd('grompp')
-        mdp = self.ems[list(self.ems.keys())[0]]['mdp']
-        tpr = 'make_ndx.tpr'
-        grompp_cmd = '{} -f {} -c {} -p {} -o make_ndx.tpr'.format(grompp, mdp, gro, self.top)
-        self.__write(grompp_cmd + '\n')
-
+        '''Generate index file with make_index.py, no grompp or make_ndx is needed'''
         ions = self.secs['ions']['name']
-        syntax = '"'
+        groups = []
         # Generate groups including SOL and ions
         if len(ions) > 0:
-            syntax += 'r SOL|r ' + '|r '.join(ions) + r'\n'
-        rdf = self.secs['analysis']['rdf']
-        if len(rdf) > 0:
-            groups = set(tuple(j.items()) for i in rdf for j in i)
-            # remove ions, since there are also ions in ndx
-            groups.difference_update(set(((i, 't'),) for i in ('NA', 'K', 'MG', 'CA', 'ZN', 'CL')))
-            for group in tuple(groups):
-                syntax += '|'.join([i[1] + ' ' + i[0] for i in group]) + r'\n'
-        syntax += r'q\n"'
-        self.__write('echo -e {}| {} -f {} -o {} \n'.format(syntax, self.__cmd('make_ndx'), tpr, self.ndx, tpr))
+            groups.append('r SOL|r ' + '|r '.join(ions))
+        # rdf groups in the order of the configuration, without the ions, since there are also ions in ndx
+        ion_types = set(((i, 't'),) for i in ('NA', 'K', 'MG', 'CA', 'ZN', 'CL'))
+        for pair in self.secs['analysis']['rdf']:
+            for ids in pair:
+                group = '|'.join(kind + ' ' + name for name, kind in ids.items())
+                if tuple(ids.items()) not in ion_types and group not in groups:
+                    groups.append(group)
+        # the topology is only read for the atom types, i.e. if a selection uses t
+        uses_types = any(term.startswith('t ') for group in groups for term in group.split('|'))
+        # make_index.py is a python programm writing the default groups of make_ndx, it must be in the path.
+        self.__write('make_index.py -f {}{} -o {} {}\n'.format(gro, ' -p ' + self.top if uses_types else '', self.ndx,
+                                                           ' '.join('"{}"'.format(i) for i in groups)))
 
     def __genrestr(self):
-        '''Output position restraint itp file'''
-        genrestr = self.__cmd('genrestr')
-
+        '''Output position restraint itp files of all the residures with one genposre.py command'''
         # The residures to be restraint
         resis = self.secs['pr']['residures']
         pdbs = self.secs['pr']['pdbs']
 
-        for i, res in enumerate(resis):
-            make_ndx_cmd = 'echo "q\\n"|{} -f {}.pdb -o {}.ndx'.format(self.__cmd('make_ndx'), pdbs[i], res.lower())
-            # getnr.py is a python programm can get the index of a residure, it must be in the path.
-            genrestr_cmd = 'echo `getnr.py {}.ndx {}`| {} -f {}.pdb -o posre_{}.itp -fc 1000 1000 1000'.format(res.lower(), res, genrestr, pdbs[i], res.lower())
-            self.__write(make_ndx_cmd + '\n')
-            self.__write(genrestr_cmd + '\n')
+        if len(resis) > 0:
+            # genposre.py is a python programm writing posre_<residure>.itp files, it must be in the path.
+            residures = ' '.join('-r {} {}.pdb'.format(res, pdb) for res, pdb in zip(resis, pdbs))
+            self.__write('genposre.py {} -fc 1000 1000 1000\n'.format(residures))
 
     def __convert_tpr(self, sec):
         '''Output convert-tpr command for ext'''
@@ -845,6 +945,24 @@ class TopOut:
             for res, resnum in zip(self.secs['component']['mols_name'], self.secs['component']['mols_num']):
                 f.write(res + '\t\t' + str(resnum) + '\n')
 
+    def check(self):
+        '''Check the topology file against the start pdb before any job is run.
+
+        The atom count, atom names and residue names of the expanded [ molecules ] must match the pdb.
+        The net charge and the total mass of the system are reported.
+        '''
+        # numpy is only needed here, not for generating the files
+        from gromacs.fileformats.top import Topology
+        pdb = self.secs['input']['start_pdb'] + '.pdb'
+        try:
+            top = Topology(self.filename)
+            problems = top.check(pdb)
+        except (IOError, ValueError, SyntaxError) as e:
+            fail('Can not check {0}: {1}'.format(self.filename, e))
+        note('{0}: {1} atoms, net charge {2:.4f}, total mass {3:.3f}'.format(self.filename, top.natoms, top.net_charge, top.total_mass))
+        if problems:
+            fail('{0} does not match {1}:\n{2}'.format(self.filename, pdb, '\n'.join(problems)))
+
 
 class MdpOut:
     '''Output the mdp file.'''
@@ -879,11 +997,18 @@ def main():
     arg_parser.add_argument('-a', '--analysis', action='store_true', help='Generate analysis command file.')
     arg_parser.add_argument('-t', '--top', action='store_true', help='Generate topology file.')
     arg_parser.add_argument('-m', '--mdp', action='store_true', help='Generate mdp files.')
+    arg_parser.add_argument('-k', '--check', action='store_true', help='Check topology file against start pdb.')
+    arg_parser.add_argument('-j', '--json', action='store', help='Write the loaded configuration to this JSON file and print its digest.')
     arg_parser.add_argument('-i', '--input', action='store', required=True, help='Configuration file. INI file is recommended.')
     arg_parser.add_argument('--exec-analysis', action='store_true', help='Execute analysis script after every md process.')
     args = arg_parser.parse_args()
     conf_f = open(args.input)
     reader = ConfigReader(conf_f)
+    if args.json:
+        frozen = reader.freeze()
+        with open(args.json, 'w') as f:
+            f.write(frozen.to_json(indent=1) + '\n')
+        note('Configuration digest: ' + frozen.digest())
     if args.command:
         command_ge = CommandOut(reader, args.command)
         command_ge.generate(args.exec_analysis)
@@ -893,6 +1018,8 @@ def main():
     if args.top:
         top = TopOut(reader)
         top.output()
+    if args.check:
+        TopOut(reader).check()
     if args.mdp:
         mdp = MdpOut(reader)
         mdp.output()
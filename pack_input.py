@@ -3,8 +3,20 @@
 # 用于生成packmol运行所需要的输入文件。程序从ini配置文件中读取数据，并生成inp文件。
 import argparse
 import configparser
+import hashlib
+import json
 import os.path
-import moltoolkit
+import re
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+from gromacs import packcheck
+from gromacs.fileformats import pdb as pdbfile
+
+
+# 堆砌缓存的格式版本，格式改变时增加，旧的缓存即失效
+cacheVersion = 1
 
 
 def echoWarning(string):
@@ -30,11 +42,12 @@ class MolPack():
 
     输出一个种类分子的堆砌信息，可以大盒子分为小格子，其内放入一定数量的分子，也可以将分子限定在一定的水平线之上。
     '''
-    def __init__(self, pack):
+    def __init__(self, pack, align=False):
         '''初始化输出文件，各项信息。
 
         Args:
             f: 输出文件，对象类型为file
+            align: 膜堆砌时是否先旋转分子模板，使其主轴(最长方向)沿z轴，次轴沿y轴，旋转后的模板写入<pdb>_aligned.pdb并用于堆砌
             pack: 一个包含需要堆砌的分子信息的字典结构，结构如：
                     {'pack1':
                         {'pdb':'m',
@@ -89,13 +102,20 @@ class MolPack():
         if self.pack['membrane']:
             if os.path.exists(self.pack['pdb']):
                 # get the smallest and largest coordinates of molecule
-                # moltoolkit可以获取分子的空间体积
-                mol = moltoolkit.Mol(self.pack['pdb'])
+                mol = pdbfile.read(self.pack['pdb'])
             else:
-                echoError('The file', self.pack['pdb'], 'is not exist in current directory')
+                echoError('The file %s is not exist in current directory' % self.pack['pdb'])
                 exit(1)
-            self.pdbSize = mol.most_coordinates
-            self.pdbSize.sort()
+            if align:
+                # 主轴沿z，x, y上的尺寸即为分子的截面
+                mol.align()
+                self.pack = dict(pack, pdb=os.path.splitext(os.path.basename(pack['pdb']))[0] + '_aligned.pdb')
+                mol.write(self.pack['pdb'])
+                echoNote('分子模板已按主轴旋转，写入%s' % self.pack['pdb'])
+                self.pdbSize = [round(v, 3) for v in mol.size().tolist()]
+            else:
+                # 以主轴方向的包围盒计算尺寸，比沿坐标轴的包围盒紧凑
+                self.pdbSize = sorted(round(v, 3) for v in mol.oriented_size().tolist())
             echoNote('分子空间尺寸为{0[0]} {0[1]} {0[2]}, 请检查分配空间是否合理'.format(self.pdbSize))
 
         # 按行排列分子，此時不限定單個分子空間，而限定一行所有分子的空間，這樣可能有更大的靈活性, 默認為False，通過setLine可以更改此值。
@@ -684,18 +704,254 @@ class ReadConfig(configparser.ConfigParser):
         return self.packs
 
 
+def checkPacked(inpFile, maxiter=100):
+    '''
+    检查packmol堆砌结果中不同分子原子间的最小距离是否小于inp中的tolerance，并以刚体平移的方式推开重叠的分子。
+
+    结果写入<output>_relaxed.pdb，重叠报告写入<output>_clash.txt。
+    如果没有剩余的重叠且inp旁有pack_input写的<inp>.packs.json，新堆砌的pack存入缓存。
+
+    Return:
+        剩余的重叠原子对数量
+    '''
+    inp = packcheck.read_inp(inpFile)
+    if inp['output'] is None or not os.path.exists(inp['output']):
+        echoError('%s中的output文件不存在，请先运行packmol' % inpFile)
+        exit(1)
+    try:
+        packed = packcheck.PackedStructure.from_inp(inp)
+    except (IOError, ValueError) as e:
+        echoError(str(e))
+        exit(1)
+    tolerance = inp['tolerance']
+    before = packed.clashes(tolerance)
+    log = []
+    after = packed.relax(tolerance, maxiter, log) if len(before[2]) else before
+    base = os.path.splitext(inp['output'])[0]
+    with open(base + '_clash.txt', 'w') as f:
+        f.write(packcheck.report(packed, tolerance, before, after, log))
+    packed.write(base + '_relaxed.pdb')
+    # 把新堆砌的pack存入缓存
+    sidecar = os.path.splitext(inpFile)[0] + '.packs.json'
+    if not len(after[2]) and os.path.exists(sidecar):
+        atoms = packed.pdb.atoms
+        start = 0
+        with open(sidecar) as f:
+            for entry in json.load(f):
+                if entry['key'] and not entry['cached']:
+                    storePack(entry['key'], atoms[start:start + entry['natoms']])
+                start += entry['natoms']
+    if len(after[2]):
+        echoWarning('仍有%d对原子距离小于%s, 详见%s' % (len(after[2]), tolerance, base + '_clash.txt'))
+    else:
+        echoNote('%d对重叠原子已消除, 结果写入%s' % (len(before[2]), base + '_relaxed.pdb'))
+    return len(after[2])
+
+
+def getCacheDir():
+    '''堆砌结果缓存的目录: $PACK_CACHE或~/.pack_cache'''
+    return os.getenv('PACK_CACHE') or os.path.join(os.path.expanduser('~'), '.pack_cache')
+
+
+def packKey(pack, tolerance, line=False, loose=False, align=False):
+    '''
+    一个pack的缓存键: pdb内容与box, num, alignNum, takeout, 水平线限定, tolerance, 排列方式及是否旋转模板的sha1
+
+    pack必须是实际写入inp的pack，-j时为shrinkBoxes收缩后的盒子，否则不同的堆砌几何会共用一个缓存。
+    '''
+    digest = hashlib.sha1()
+    with open(pack['pdb'], 'rb') as f:
+        digest.update(f.read())
+    spec = dict((k, v) for k, v in pack.items() if k != 'pdb')
+    digest.update(json.dumps([cacheVersion, spec, float(tolerance), line, loose, align], sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+def cachePath(key):
+    '''缓存键对应的pdb'''
+    return os.path.join(getCacheDir(), key[:2], key + '.pdb')
+
+
+def storePack(key, atoms):
+    '''把一个pack堆砌好的原子存入缓存，先写入临时文件再改名，并发运行时不会读到不完整的文件'''
+    path = cachePath(key)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    os.close(fd)
+    pdbfile.write(tmp, atoms)
+    os.rename(tmp, path)
+
+
+def fixText(pdb):
+    '''把pdb作为固定结构的structure部分'''
+    return 'structure ' + pdb + '\n\tnumber 1\n\tfixed 0. 0. 0. 0. 0. 0.\nend structure\n\n'
+
+
+def inpHeader(tolerance, output, loop):
+    '''inp文件的开头部分'''
+    return 'tolerance ' + tolerance + ' \noutput ' + output + '\nfiletype pdb\ndiscale 1.5\nnloop ' + str(loop) + '\n\n'
+
+
+def packAtoms(pdb, text):
+    '''一个pack在inp中structure部分的原子总数'''
+    return len(pdbfile.read(pdb)) * sum(int(n) for n in re.findall(r'number\s+(\d+)', text))
+
+
+def splitRegions(packs):
+    '''
+    按z方向把[pack*]分为互不重叠的区域，z范围有重叠的pack属于同一区域，fix的pack以其pdb的z坐标范围为准。
+
+    Return:
+        区域列表，按z从小到大排列，每个区域为(z1, z2, [pack名, ...])
+    '''
+    ranges = []
+    for name in sorted(packs.keys()):
+        pack = packs[name]
+        if pack['fix']:
+            lower, upper = pdbfile.read(pack['pdb']).bounding_box()
+            ranges.append((lower[2], upper[2], name))
+        else:
+            ranges.append((pack['box'][2], pack['box'][5], name))
+    regions = []
+    for z1, z2, name in sorted(ranges):
+        if regions and z1 < regions[-1][1]:
+            regions[-1][1] = max(regions[-1][1], z2)
+            regions[-1][2].append(name)
+        else:
+            regions.append([z1, z2, [name]])
+    return [tuple(region) for region in regions]
+
+
+def shrinkBoxes(packs, regions, tolerance):
+    '''
+    区域之间相接的面上，把pack盒子的z边界向区域内收缩半个tolerance，使各区域独立堆砌后在边界处不会重叠。
+
+    Return:
+        新的packs字典，盒子已收缩
+    '''
+    packs = dict((name, dict(pack)) for name, pack in packs.items())
+    bottom, top = regions[0][0], regions[-1][1]
+    for z1, z2, names in regions:
+        for name in names:
+            pack = packs[name]
+            if pack['fix']:
+                continue
+            box = list(pack['box'])
+            if box[2] == z1 and z1 > bottom:
+                box[2] += tolerance / 2
+            if box[5] == z2 and z2 < top:
+                box[5] -= tolerance / 2
+            pack['box'] = box
+    return packs
+
+
+def runPackmol(inps, jobs, packmol='packmol'):
+    '''
+    同时运行多个packmol，每个inp的输出写入同名的.log文件。
+
+    Return:
+        各packmol的返回值列表
+    '''
+    def run(inp):
+        with open(inp) as fin, open(os.path.splitext(inp)[0] + '.log', 'w') as flog:
+            return subprocess.call([packmol], stdin=fin, stdout=flog, stderr=subprocess.STDOUT)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(run, inps))
+
+
+def stitchPdbs(blocks, output):
+    '''
+    把各区域堆砌的pdb按原pack顺序拼接为一个pdb，原子序号与残基序号重新连续编号，超过99999个原子时以hybrid-36编号。
+
+    Arguments:
+        blocks: [原子数组, ...]，每个pack的原子，按输出顺序
+        output: 输出pdb文件名
+    '''
+    atoms = numpy.concatenate(blocks)
+    atoms['serial'] = numpy.arange(1, len(atoms) + 1)
+    # 残基序号或残基名改变时，以及每个pack开始时为新的残基
+    new = numpy.ones(len(atoms), dtype=bool)
+    new[1:] = (atoms['resname'][1:] != atoms['resname'][:-1]) | (atoms['resid'][1:] != atoms['resid'][:-1])
+    new[numpy.cumsum([len(block) for block in blocks])[:-1]] = True
+    atoms['resid'] = numpy.cumsum(new)
+    pdbfile.write(output, atoms, title='stitched from the packmol runs of %d regions' % len(blocks))
+
+
+def packRegions(packs, texts, regions, header, inpFile, lastPdb, jobs, packmol, cached=None):
+    '''
+    每个区域写一个inp并行运行packmol，再把各区域的结果按pack顺序拼接为lastPdb。
+
+    Arguments:
+        packs: 所有的pack字典
+        texts: 每个pack在inp中的structure部分
+        regions: splitRegions的结果
+        header: 函数，参数为输出的pdb名，返回inp开头
+        inpFile: 完整inp的文件名，区域的inp和pdb以此命名
+        cached: 使用缓存的pack名: 缓存的pdb，全部来自缓存的区域不再运行packmol
+    '''
+    cached = cached or {}
+    base = os.path.splitext(inpFile)[0]
+    inps, outputs = [], []
+    for k, (z1, z2, names) in enumerate(regions):
+        if all(name in cached for name in names):
+            echoNote('区域%d: z %.1f - %.1f, %s, 全部来自缓存' % (k, z1, z2, ' '.join(names)))
+            continue
+        inps.append('%s_region%d.inp' % (base, k))
+        outputs.append('%s_region%d.pdb' % (base, k))
+        with open(inps[-1], 'w') as f:
+            f.write(header(outputs[-1]))
+            for name in names:
+                f.write(texts[name])
+        echoNote('区域%d: z %.1f - %.1f, %s' % (k, z1, z2, ' '.join(names)))
+    codes = runPackmol(inps, jobs, packmol)
+    for inp, output, code in zip(inps, outputs, codes):
+        if code != 0 or not os.path.exists(output):
+            echoError('packmol运行%s失败，详见%s' % (inp, os.path.splitext(inp)[0] + '.log'))
+            exit(1)
+
+    # 按区域内pack顺序切分原子
+    blocks = dict((name, pdbfile.read(pdb).atoms) for name, pdb in cached.items())
+    outputs = iter(outputs)
+    for z1, z2, names in regions:
+        if all(name in cached for name in names):
+            continue
+        output = next(outputs)
+        atoms = pdbfile.read(output).atoms
+        start = 0
+        for name in names:
+            natoms = packAtoms(cached.get(name, packs[name]['pdb']), texts[name])
+            blocks[name] = atoms[start:start + natoms]
+            start += natoms
+        if start != len(atoms):
+            echoError('%s的原子数量%d与inp中的分子不一致' % (output, len(atoms)))
+            exit(1)
+    stitchPdbs([blocks[name] for name in sorted(packs.keys())], lastPdb)
+
+
 def main():
     arg_parser = argparse.ArgumentParser(
                     description='通过读取ini配置文件，生成packmol所需的配置文件。')
     arg_parser.add_argument('-i', '--input',
-                            type=argparse.FileType('r'), required=True, help='读取ini配置文件')
+                            type=argparse.FileType('r'), help='读取ini配置文件')
     arg_parser.add_argument('-o', '--output',
-                            type=argparse.FileType('w'), required=True, help='生成inp文件')
+                            type=argparse.FileType('w'), help='生成inp文件')
     arg_parser.add_argument('-l', '--loop', type=int, action='store', default=50000, help='nloop值，指最大迭代次数')
     arg_parser.add_argument('-t', '--tolerance', action='store', help='tolerance值，公差，默认值为2.0，减少公差可以使分子结合更紧密，但过小容易让分子堆叠, 此值不建议小于1.5')
     arg_parser.add_argument('--line', action='store_true', help='在堆砌膜時，不以單個分子而按行排列分子，這樣可以有更大的靈活，堆砌時長過長時可以選擇此選項')
     arg_parser.add_argument('--loose', action='store_true', help='在堆砌膜時，不以單個分子而在x,y區域內隨機排列，這樣可以有更大的靈活，而且此時只考慮分子的總數量x*y，而不是分別考慮x, y上的分子數量，堆砌時長過長時可以選擇此選項')
+    arg_parser.add_argument('--align', action='store_true', help='膜堆砌时先将分子模板按主成分旋转，使最长方向沿z轴，再以其x, y尺寸划分格子。默认不旋转，以主轴方向的包围盒尺寸划分')
+    arg_parser.add_argument('-c', '--check', metavar='INP', help='检查此inp的packmol堆砌结果，推开距离小于tolerance的分子，此时不需要-i和-o')
+    arg_parser.add_argument('--maxiter', type=int, default=100, help='检查堆砌结果时推开分子的最大迭代次数')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=0, help='按z方向把盒子分为互不重叠的区域，每个区域一个inp，同时运行此数量的packmol，之后拼接结果并检查重叠')
+    arg_parser.add_argument('--packmol', default='packmol', help='packmol程序，-j时使用')
+    arg_parser.add_argument('--no_cache', action='store_true', help='不使用堆砌缓存。默认以pdb内容、box、num、水平线限定及tolerance为键缓存每个pack的堆砌结果($PACK_CACHE或~/.pack_cache)，相同的pack以fix结构重用')
     args = arg_parser.parse_args()
+    if args.check:
+        checkPacked(args.check, args.maxiter)
+        return
+    if not args.input or not args.output:
+        arg_parser.error('需要-i和-o参数')
     config_reader = ReadConfig(args.input)
 
     f = args.output
@@ -706,14 +962,41 @@ def main():
         tolerance = args.tolerance
 
     packs_dict = config_reader.get_packs()
-    f.write('tolerance ' + tolerance + ' \noutput ' + config_reader.get_pack_last_pdb() + '\nfiletype pdb\ndiscale 1.5\nnloop ' + str(loop) + '\n\n')
+    regions = splitRegions(packs_dict) if args.jobs > 0 else None
+    if regions:
+        packs_dict = shrinkBoxes(packs_dict, regions, float(tolerance))
+    texts = {}
+    cached = {}
+    sidecar = []
+    for i in sorted(list(packs_dict.keys())):
+        key = None
+        if not args.no_cache and not packs_dict[i]['fix']:
+            key = packKey(packs_dict[i], tolerance, args.line, args.loose, args.align)
+            if os.path.exists(cachePath(key)):
+                cached[i] = cachePath(key)
+        if i in cached:
+            echoNote('%s使用缓存的堆砌结果%s' % (i, cached[i]))
+            texts[i] = fixText(cached[i])
+        else:
+            mol_pack = MolPack(packs_dict[i], args.align)
+            if args.line:
+                mol_pack.setLine(args.line)
+            if args.loose:
+                mol_pack.setLoose(args.loose)
+            texts[i] = mol_pack.packMol()
+        sidecar.append({'name': i, 'key': key, 'cached': i in cached,
+                        'natoms': packAtoms(cached.get(i, packs_dict[i]['pdb']), texts[i])})
+    f.write(inpHeader(tolerance, config_reader.get_pack_last_pdb(), loop))
     for i in sorted(list(packs_dict.keys())):
-        mol_pack = MolPack(packs_dict[i])
-        if args.line:
-            mol_pack.setLine(args.line)
-        if args.loose:
-            mol_pack.setLoose(args.loose)
-        f.write(mol_pack.packMol())
+        f.write(texts[i])
+    f.close()
+    with open(os.path.splitext(f.name)[0] + '.packs.json', 'w') as fs:
+        json.dump(sidecar, fs, indent=1)
+
+    if regions:
+        packRegions(packs_dict, texts, regions, lambda output: inpHeader(tolerance, output, loop),
+                    f.name, config_reader.get_pack_last_pdb(), args.jobs, args.packmol, cached)
+        checkPacked(f.name, args.maxiter)
 
 if __name__ == '__main__':
     main()
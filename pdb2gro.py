@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+'''
+Convert pdb files to gro files in a box without editconf, e.g.
+
+    pdb2gro.py start.pdb -box 5.0 5.0 15.0 -o pdb.gro
+    pdb2gro.py *.pdb -box 5 5 15 -o gro/{0}.gro
+
+The box has 3 values or the 9 of a triclinic box in the gro order (v1(x) v2(y) v3(z) v1(y) v1(z) v2(x) v2(z) v3(x)
+v3(y)). The structure is centred in the box as by editconf -box unless -noc is given.
+'''
+import argparse
+import os.path
+import sys
+
+from gromacs.fileformats import gro, pdb
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert pdb files to gro files in a box.')
+    parser.add_argument('pdbs', nargs='+', help='pdb files')
+    parser.add_argument('-box', dest='box', type=float, nargs='+', required=True, help='box, 3 or 9 values (nm)')
+    parser.add_argument('-noc', dest='center', action='store_false', help='keep the coordinates, do not centre')
+    parser.add_argument('-o', dest='output', default='{0}.gro',
+                        help='output file, {0} is replaced by the pdb file name without extension')
+    args = parser.parse_args()
+    if len(args.box) not in (3, 9):
+        parser.error('the box has 3 or 9 values')
+    if len(args.pdbs) > 1 and '{0}' not in args.output:
+        parser.error('-o must contain {0} for more than one pdb')
+
+    for filename in args.pdbs:
+        name = os.path.splitext(os.path.basename(filename))[0]
+        try:
+            structure = pdb.read(filename)
+        except (IOError, ValueError) as e:
+            sys.exit('pdb2gro.py: {0}'.format(e))
+        gro.from_pdb(structure, args.box, args.center, structure.title or name).write(args.output.format(name))
+
+
+if __name__ == '__main__':
+    main()